@@ -0,0 +1,16 @@
+"""
+Microbenchmarks for the hot paths of brewblox-sharemycook
+
+Run an individual benchmark with `python3 -m benchmarks.<name>`
+"""
+import timeit
+from typing import Callable
+
+
+def measure(name: str, func: Callable[[], object], number: int = 10000, repeat: int = 5) -> float:
+    """
+    Time `func`, printing and returning the best time per call in microseconds
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+    print(f'{name:<48} {best:>10.2f} us/call')
+    return best
@@ -0,0 +1,66 @@
+"""
+Columnar export of a multi-day cook, versus the previous loop that appended every value to its column
+"""
+import math
+from array import array
+from typing import Dict, List, Mapping
+
+from benchmarks import measure
+from brewblox_sharemycook.export import to_columns
+
+ONLINE = {
+    'Active': 1,
+    'Fan_Duty[%]': 48,
+    'Targets': {'pit[DegC]': 107, 'food1[DegC]': 97, 'food2[DegC]': 96},
+    'Values': {'pit[DegC]': 105.5, 'food1[DegC]': 60.1, 'food2[DegC]': 58.3},
+}
+OFFLINE = {'Active': 0}
+
+# Three devices, sampled every 10 seconds for a day, that went offline for an hour
+RECORDS = [
+    (f'topic/UltraQ{n % 3}', {'key': 'ShareMyCook', 'data': {f'UltraQ{n % 3}': OFFLINE if n % 1000 < 360 else ONLINE}},
+     1.6e9 + n * 10 / 3)
+    for n in range(3 * 8640)
+]
+
+
+def flatten(sample, prefix=''):
+    for key, value in sample.items():
+        if isinstance(value, Mapping):
+            yield from flatten(value, f'{prefix}{key}/')
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{key}', value
+
+
+def legacy_to_columns(records):
+    devices: List[str] = []
+    times = array('d')
+    fields: Dict[str, array] = {}
+    for _, message, timestamp in records:
+        for device, sample in message['data'].items():
+            row = len(devices)
+            devices.append(device)
+            times.append(math.nan if timestamp is None else timestamp)
+            for name, value in flatten(sample):
+                column = fields.get(name)
+                if column is None:
+                    column = fields[name] = array('d', [math.nan]) * row
+                column.append(value)
+            for column in fields.values():
+                if len(column) == row:
+                    column.append(math.nan)
+    return {'device': devices, 'time': times, **dict(sorted(fields.items()))}
+
+
+def main():
+    legacy = legacy_to_columns(RECORDS)
+    columns = to_columns(RECORDS)
+    assert list(legacy) == list(columns)
+    assert legacy['Values/pit[DegC]'].tolist()[-10:] == columns['Values/pit[DegC]'].tolist()[-10:]
+    print(f'{len(RECORDS)} samples')
+    measure('to_columns (append every value)', lambda: legacy_to_columns(RECORDS), number=5)
+    measure('to_columns (stacked per set of fields)', lambda: to_columns(RECORDS), number=5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Load benchmark of ShareMyCook polling against the local simulator
+
+Reports cycle time, upstream requests per tick and CPU time per device.
+The simulator runs in a subprocess, so its CPU time is not included.
+With `--broadcaster`, every tick is a complete Broadcaster cycle: polling, change detection, aggregation,
+cook analytics and publishing, with a stand-in for the MQTT broker.
+With `--replay`, the simulator serves the responses captured by benchmarks.record.
+
+    python3 -m benchmarks.load --devices 50 --latency 0.2 --session-lifetime 5
+    python3 -m benchmarks.load --broadcaster --analytics-smoothing 300 --replay recording
+"""
+import asyncio
+import logging
+import socket
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from statistics import mean, median
+from typing import Awaitable, Callable, List, Tuple
+from unittest.mock import patch
+
+from aiohttp import ClientSession
+from brewblox_service import mqtt, scheduler, service
+
+from benchmarks.simulator import Recording, SimulatorConfig
+from brewblox_sharemycook.__main__ import create_parser as create_service_parser
+from brewblox_sharemycook.broadcaster import Broadcaster
+from brewblox_sharemycook.share_my_cook import DEFAULT_CONCURRENCY, ShareMyCook, create_connector, create_session
+
+# Cycle time, CPU time and failed polls of a tick
+Tick = Tuple[float, float, int]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def request_counts(session: ClientSession, base_url: str) -> Counter:
+    async with session.get(f'{base_url}/stats') as response:
+        counts = Counter(await response.json())
+    counts.pop('GET /stats', None)
+    return counts
+
+
+async def share_my_cook_ticks(args, session: ClientSession, base_url: str,
+                              measure: Callable[[Callable[[], Awaitable[int]]], Awaitable[None]]) -> None:
+    share_my_cook = ShareMyCook(session, 'username', 'password', args.concurrency, base_url=base_url)
+    await share_my_cook.discover()
+
+    async def tick() -> int:
+        errors = 0
+        for result in await share_my_cook.poll():
+            if result.error is None:
+                result.controller.serialize()
+            else:
+                errors += 1
+        return errors
+
+    for _ in range(args.ticks):
+        await measure(tick)
+        await asyncio.sleep(args.interval)
+
+
+async def broadcaster_ticks(args, session: ClientSession, base_url: str,
+                            measure: Callable[[Callable[[], Awaitable[int]]], Awaitable[None]]) -> Tuple[int, int]:
+    """
+    :return: the number of published messages and missed ticks
+    """
+    app = service.create_app(parser=create_service_parser(), raw_args=[
+        '--username', 'username',
+        '--password', 'password',
+        '--share-my-cook-url', base_url,
+        '--poll-concurrency', str(args.concurrency),
+        '--active-poll-interval', str(args.interval),
+        '--inactive-poll-interval', str(args.interval),
+        '--analytics-smoothing', str(args.analytics_smoothing),
+        '--aggregate-window', str(args.aggregate_window),
+        '--deadband', str(args.deadband),
+        '--cookie-file', '',
+        '--backlog-file', '',
+        '--archive-file', '',
+    ])
+    scheduler.setup(app)
+    published = 0
+
+    async def publish(app, topic, message):
+        nonlocal published
+        published += 1
+
+    caster = Broadcaster(app)
+    with patch.object(mqtt, 'publish', publish):
+        await caster.prepare()
+        await caster.discovered.wait()
+
+        # The cycle ends where run() starts waiting for the next tick
+        cycle_done = asyncio.Event()
+        sleep_until_next_tick = caster.sleep_until_next_tick
+
+        async def sleep():
+            cycle_done.set()
+            await sleep_until_next_tick()
+
+        caster.sleep_until_next_tick = sleep
+
+        running = None
+
+        async def tick() -> int:
+            nonlocal running
+            cycle_done.clear()
+            running = asyncio.create_task(caster.run())
+            await cycle_done.wait()
+            # Devices whose poll failed are due again right away
+            return sum(len(account.device_ids) for account in caster.accounts) - len(caster.poll_deadlines)
+
+        for _ in range(args.ticks):
+            await measure(tick)
+            await running
+        # Let the publisher flush the last tick
+        await asyncio.sleep(0.1)
+        await caster.shutdown(app)
+    return published, caster.missed_ticks
+
+
+async def run(args) -> None:
+    devices = len(Recording.load(args.replay).payloads) if args.replay else args.devices
+    port = free_port()
+    simulator = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'benchmarks.simulator',
+        '--port', str(port),
+        '--devices', str(args.devices),
+        '--latency', str(args.latency),
+        '--error-rate', str(args.error_rate),
+        '--session-lifetime', str(args.session_lifetime),
+        *(['--replay', args.replay] if args.replay else []),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    connector = create_connector()
+    try:
+        await wait_for_port(port)
+        base_url = f'http://localhost:{port}'
+        async with create_session(connector) as session:
+            ticks: List[Tick] = []
+            requests_per_tick = []
+
+            async def measure(tick: Callable[[], Awaitable[int]]) -> None:
+                counts = await request_counts(session, base_url)
+                start, start_cpu = time.monotonic(), time.process_time()
+                errors = await tick()
+                ticks.append((time.monotonic() - start, time.process_time() - start_cpu, errors))
+                requests_per_tick.append(sum((await request_counts(session, base_url) - counts).values()))
+
+            if args.broadcaster:
+                published, missed_ticks = await broadcaster_ticks(args, session, base_url, measure)
+            else:
+                await share_my_cook_ticks(args, session, base_url, measure)
+
+        cycle_times, cpu_times, errors = zip(*ticks)
+        print(f'Devices: {devices}{" (replayed)" if args.replay else ""}, concurrency: {args.concurrency}, '
+              f'latency: {args.latency}s, error rate: {args.error_rate}, session lifetime: {args.session_lifetime}s')
+        print(f'Cycle time:        median {median(cycle_times):.3f}s, max {max(cycle_times):.3f}s')
+        print(f'Requests per tick: mean {mean(requests_per_tick):.1f}, max {max(requests_per_tick)}')
+        print(f'CPU per device:    {mean(cpu_times) / devices * 1000:.3f}ms per tick')
+        print(f'Failed polls:      {sum(errors)} of {devices * args.ticks}')
+        if args.broadcaster:
+            print(f'Missed ticks:      {missed_ticks}')
+            print(f'Published:         {published} messages')
+    finally:
+        await connector.close()
+        simulator.terminate()
+        await simulator.wait()
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--latency', type=float, default=SimulatorConfig.latency)
+    parser.add_argument('--error-rate', type=float, default=SimulatorConfig.error_rate)
+    parser.add_argument('--session-lifetime', type=float, default=SimulatorConfig.session_lifetime)
+    parser.add_argument('--ticks', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.5, help='Seconds between ticks. [%(default)s]')
+    parser.add_argument('--replay', help='Directory with responses captured by benchmarks.record')
+    parser.add_argument('--broadcaster', action='store_true',
+                        help='Run complete Broadcaster cycles instead of only polling')
+    parser.add_argument('--analytics-smoothing', type=float, default=0)
+    parser.add_argument('--aggregate-window', type=float, default=0)
+    parser.add_argument('--deadband', type=float, default=0)
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(create_parser().parse_args()))
+
+
+if __name__ == '__main__':
+    main()
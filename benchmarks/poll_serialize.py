@@ -0,0 +1,75 @@
+"""
+Decode -> from_json -> serialize path for an UltraQ temperatures_read payload
+"""
+import json
+import uuid
+from datetime import datetime
+
+from benchmarks import measure
+from brewblox_sharemycook.controllers import controller_types, decode_controller, TemperatureUnits
+from brewblox_sharemycook.decoding import loads, msgspec
+
+DEVICE_ID = uuid.uuid4()
+
+ULTRA_Q_PAYLOAD = json.dumps({
+    'bbqGuruDeviceModel': 'UltraQ',
+    'customerDeviceName': 'MyDeviceName',
+    'indicateStatus': 'good',
+    'pitActualTemp': 106,
+    'pitTargetTemp': 107,
+    'food1ActualTemp': 67,
+    'food1TargetTemp': 97,
+    'food2ActualTemp': 66,
+    'food2TargetTemp': 96,
+    'food3ActualTemp': -500,
+    'food3TargetTemp': 95,
+    'currentOutputPercent': 78,
+    'lastDeviceCommunicationTimestamp': datetime.now().isoformat(),
+}).encode()
+
+# The same payload, padded with device settings and nested objects no controller uses
+PADDED_PAYLOADS = {
+    'settings': json.dumps({
+        **{f'setting{i}': i if i % 3 else f'value {i}' for i in range(60)},
+        **json.loads(ULTRA_Q_PAYLOAD),
+    }).encode(),
+    'nested': json.dumps({
+        **{f'unused{i}': {'nested': [1, 2, 3], 'text': 'unused' * 3} for i in range(40)},
+        **json.loads(ULTRA_Q_PAYLOAD),
+    }).encode(),
+}
+
+
+def double_decode():
+    model = json.loads(ULTRA_Q_PAYLOAD)['bbqGuruDeviceModel']
+    controller = controller_types[model].from_json(DEVICE_ID, TemperatureUnits.CELSIUS, json.loads(ULTRA_Q_PAYLOAD))
+    return controller.serialize()
+
+
+def single_decode(content: bytes = ULTRA_Q_PAYLOAD):
+    payload = loads(content)
+    controller = controller_types[payload['bbqGuruDeviceModel']].from_json(DEVICE_ID, TemperatureUnits.CELSIUS, payload)
+    return controller.serialize()
+
+
+def schema_decode(content: bytes = ULTRA_Q_PAYLOAD):
+    return decode_controller(DEVICE_ID, TemperatureUnits.CELSIUS, content).serialize()
+
+
+def main():
+    assert double_decode() == single_decode() == schema_decode()
+    print(f'Decoder: {loads.__module__}')
+    print(f'Schema decoder: {"msgspec" if msgspec else "loads"}')
+    measure('json.loads decode', lambda: json.loads(ULTRA_Q_PAYLOAD))
+    measure('decoding.loads decode', lambda: loads(ULTRA_Q_PAYLOAD))
+    measure('poll -> serialize (double json.loads)', double_decode)
+    measure('poll -> serialize (single decoding.loads)', single_decode)
+    measure('poll -> serialize (schema decode)', schema_decode)
+    for name, content in PADDED_PAYLOADS.items():
+        assert single_decode(content) == schema_decode(content)
+        measure(f'{name} padding (single decoding.loads)', lambda: single_decode(content))
+        measure(f'{name} padding (schema decode)', lambda: schema_decode(content))
+
+
+if __name__ == '__main__':
+    main()
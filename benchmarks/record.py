@@ -0,0 +1,68 @@
+"""
+Capture responses from sharemycook.com, to be replayed by the simulator
+
+Saves the devices page, the profile page and `--samples` temperatures_read payloads of every device,
+polled `--interval` seconds apart, to the `--output` directory.
+
+    python3 -m benchmarks.record --username me --password secret --samples 30 --interval 10 --output recording
+    python3 -m benchmarks.load --replay recording
+
+Recordings hold the names of the account and its devices, keep them out of version control.
+"""
+import asyncio
+import logging
+from argparse import ArgumentParser
+
+from benchmarks.simulator import Recording
+from brewblox_sharemycook.share_my_cook import SHARE_MY_COOK, ShareMyCook, create_connector, create_session
+
+
+async def fetch(account: ShareMyCook, path: str) -> bytes:
+    async with await account.get(f'{account.base_url}{path}') as response:
+        return await response.read()
+
+
+async def record(args) -> Recording:
+    connector = create_connector()
+    try:
+        async with create_session(connector) as session:
+            account = ShareMyCook(session, args.username, args.password, base_url=args.share_my_cook_url)
+            device_ids, _ = await account.discover()
+            recording = Recording(
+                await fetch(account, '/account/customerdevice'),
+                await fetch(account, '/Account/Profile'),
+                {device_id: [] for device_id in sorted(device_ids)},
+            )
+            for sample in range(args.samples):
+                if sample:
+                    await asyncio.sleep(args.interval)
+                for device_id, payloads in recording.payloads.items():
+                    payloads.append(await fetch(account, f'/account/customerdevice/temperatures_read?id={device_id}'))
+                print(f'Recorded sample {sample + 1} of {args.samples} for {len(recording.payloads)} device(s)')
+    finally:
+        await connector.close()
+    return recording
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--share-my-cook-url', default=SHARE_MY_COOK)
+    parser.add_argument('--samples', type=int, default=10,
+                        help='Payloads recorded for every device. [%(default)s]')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='Seconds between samples. [%(default)s]')
+    parser.add_argument('--output', default='recording',
+                        help='Directory the recording is saved to. [%(default)s]')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    args = create_parser().parse_args()
+    asyncio.run(record(args)).save(args.output)
+
+
+if __name__ == '__main__':
+    main()
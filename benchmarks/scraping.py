@@ -0,0 +1,63 @@
+"""
+Full tree html.parser scraping versus strained and regex extracted scraping with the preferred parser
+
+The pages are synthetic stand-ins for the sharemycook.com login, devices and profile pages,
+padded with navigation, scripts and tables to a similar size as the real pages.
+"""
+import uuid
+
+from benchmarks import measure
+from brewblox_sharemycook.scraping import bs_ify, bs_ify_elements, get_csrf_token, glean_device_ids
+from brewblox_sharemycook.scraping import glean_temperature_units
+from brewblox_sharemycook.scraping import DEVICE_INFO_LISTS, LOGIN_FORM, PARSER, TEMPERATURE_UNITS
+
+PADDING = ''.join(
+    f'<nav><ul class="menu"><li><a href="/page/{i}">Page {i}</a></li></ul></nav>'
+    f'<script type="text/javascript">var item{i} = {{"id": {i}, "label": "item {i}"}};</script>'
+    f'<table><tr><td>{i}</td><td>Lorem ipsum dolor sit amet</td><td><input name="field{i}" /></td></tr></table>'
+    for i in range(200)
+)
+
+
+def page(body: str) -> str:
+    return f'<!DOCTYPE html><html><head><title>ShareMyCook</title></head><body>{PADDING}{body}{PADDING}</body></html>'
+
+
+LOGIN_PAGE = page("""
+    <form action="/Search" method="get"><input name="q" /></form>
+    <form action="/Login" method="post">
+        <input name="Username" /><input name="Password" type="password" />
+        <input name="__RequestVerificationToken" type="hidden" value="TOKEN" />
+    </form>""")
+
+DEVICES_PAGE = page(''.join(
+    f'<ul class="device-info-list"><li><a href="/account/customerdevice/{uuid.uuid4()}">UltraQ {i}</a></li></ul>'
+    for i in range(12)
+))
+
+PROFILE_PAGE = page("""
+    <input id="TemperatureUnit" name="TemperatureUnit" type="radio" value="Fahrenheit" /> Fahrenheit
+    <input checked="checked" id="TemperatureUnit" name="TemperatureUnit" type="radio" value="Celsius" /> Celsius""")
+
+SCRAPERS = [
+    ('get_csrf_token', get_csrf_token, LOGIN_PAGE, 'form', LOGIN_FORM),
+    ('glean_device_ids', glean_device_ids, DEVICES_PAGE, 'ul', DEVICE_INFO_LISTS),
+    ('glean_temperature_units', glean_temperature_units, PROFILE_PAGE, 'input', TEMPERATURE_UNITS),
+]
+
+
+def main():
+    print(f'Preferred parser: {PARSER}')
+    for name, scraper, content, tag, parse_only in SCRAPERS:
+        expected = scraper(bs_ify(content, features='html.parser'))
+        assert scraper(bs_ify(content, parse_only)) == expected
+        assert scraper(bs_ify_elements(content, tag, parse_only)) == expected
+        measure(f'{name} (full, html.parser)', lambda: scraper(bs_ify(content, features='html.parser')), number=20)
+        measure(f'{name} (strained, html.parser)',
+                lambda: scraper(bs_ify(content, parse_only, features='html.parser')), number=20)
+        measure(f'{name} (strained, {PARSER})', lambda: scraper(bs_ify(content, parse_only)), number=20)
+        measure(f'{name} (extracted, {PARSER})', lambda: scraper(bs_ify_elements(content, tag, parse_only)), number=20)
+
+
+if __name__ == '__main__':
+    main()
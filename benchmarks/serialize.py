@@ -0,0 +1,110 @@
+"""
+Time, allocations and record size of UltraQ.serialize versus the previous dict based implementation
+"""
+import sys
+import tracemalloc
+import uuid
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+from benchmarks import measure
+from brewblox_sharemycook.controllers import State, TemperatureUnits, UltraQ
+
+
+@dataclass
+class LegacyUltraQ:
+    """
+    The UltraQ record and serializer as they were before slots and precomputed probe fields
+    """
+    DISCONNECTED_TEMP = -500
+
+    device_id: uuid.UUID
+    name: str
+    state: State
+    units: TemperatureUnits
+    last_update: datetime
+    pit_temp: float
+    pit_target: float
+    food1_temp: float
+    food1_target: float
+    food2_temp: float
+    food2_target: float
+    food3_temp: float
+    food3_target: float
+    fan_duty: int
+
+    @property
+    def temp_units(self) -> str:
+        return f'Deg{"C" if self.units == TemperatureUnits.CELSIUS else "F"}'
+
+    def serialize(self):
+        values = {}
+        targets = {}
+
+        data = {
+            'Active': 1 if self.state == State.ONLINE else 0,
+        }
+
+        if self.state == State.ONLINE:
+            data['Fan_Duty[%]'] = self.fan_duty if self.state == State.ONLINE else None
+            data['Targets'] = targets
+            data['Values'] = values
+
+            for probe_name in ['pit', 'food1', 'food2', 'food3']:
+                probe_temp = getattr(self, f'{probe_name}_temp')
+                if probe_temp > self.DISCONNECTED_TEMP:
+                    values[f'{probe_name}[{self.temp_units}]'] = probe_temp
+                    targets[f'{probe_name}[{self.temp_units}]'] = getattr(self, f'{probe_name}_target')
+
+        return {self.name: data}
+
+
+FIELDS = dict(
+    device_id=uuid.uuid4(),
+    name='MyDeviceName',
+    state=State.ONLINE,
+    units=TemperatureUnits.CELSIUS,
+    last_update=datetime.now(),
+    pit_temp=106.0,
+    pit_target=107.0,
+    food1_temp=67.0,
+    food1_target=97.0,
+    food2_temp=66.0,
+    food2_target=96.0,
+    food3_temp=-500.0,
+    food3_target=95.0,
+    fan_duty=78,
+)
+
+
+def record_size(record) -> int:
+    return sys.getsizeof(record) + sys.getsizeof(getattr(record, '__dict__', {}))
+
+
+def allocation(func, number=1000) -> float:
+    """
+    :return: bytes allocated per call, with the results kept alive so freelists do not hide them
+    """
+    func()
+    tracemalloc.start()
+    results = [func() for _ in range(number)]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return allocated / number
+
+
+def main():
+    legacy = LegacyUltraQ(**FIELDS)
+    current = UltraQ(**FIELDS)
+    assert [f.name for f in fields(legacy)] == [f.name for f in fields(current)]
+    assert legacy.serialize() == current.serialize()
+
+    for name, record in [('before', legacy), ('after', current)]:
+        print(f'{name}: record size {record_size(record)} bytes, '
+              f'{allocation(record.serialize):.0f} bytes allocated per serialize')
+        measure(f'UltraQ.serialize ({name})', record.serialize, number=100000)
+
+
+if __name__ == '__main__':
+    main()
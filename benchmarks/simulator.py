@@ -0,0 +1,210 @@
+"""
+Local stand-in for sharemycook.com, for load and latency benchmarking
+
+Serves the login page, /Login, /account/customerdevice, temperatures_read and /Account/Profile
+for a configurable number of UltraQ devices, with configurable latency, error rate and session lifetime.
+With `--replay`, the pages and payloads captured from sharemycook.com by benchmarks.record are served instead.
+
+Run standalone with `python3 -m benchmarks.simulator --devices 50`,
+then point the service at it with `--share-my-cook-url http://localhost:8080`.
+"""
+import asyncio
+import random
+import secrets
+import time
+import uuid
+from argparse import ArgumentParser
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+SESSION_COOKIE = '.ASPXAUTH'
+UNITS = ['Fahrenheit', 'Celsius']
+DEVICES_PAGE = 'customerdevice.html'
+PROFILE_PAGE = 'profile.html'
+PAYLOADS_DIR = 'temperatures_read'
+
+
+@dataclass
+class SimulatorConfig:
+    devices: int = 10
+    latency: float = 0.05
+    error_rate: float = 0.0
+    session_lifetime: float = 1200
+    units: str = 'Celsius'
+
+
+@dataclass
+class Recording:
+    """
+    Responses captured from sharemycook.com by benchmarks.record
+
+    Stored in a directory as customerdevice.html, profile.html and temperatures_read/<device id>/<n>.json
+    """
+    devices_page: bytes
+    profile_page: bytes
+    payloads: Dict[uuid.UUID, List[bytes]]
+
+    @classmethod
+    def load(cls, directory: str) -> 'Recording':
+        path = Path(directory)
+        payloads = {}
+        for device in sorted((path / PAYLOADS_DIR).iterdir()):
+            files = sorted(device.glob('*.json'), key=lambda file: int(file.stem))
+            payloads[uuid.UUID(device.name)] = [file.read_bytes() for file in files]
+        return cls((path / DEVICES_PAGE).read_bytes(), (path / PROFILE_PAGE).read_bytes(), payloads)
+
+    def save(self, directory: str) -> None:
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / DEVICES_PAGE).write_bytes(self.devices_page)
+        (path / PROFILE_PAGE).write_bytes(self.profile_page)
+        for device_id, payloads in self.payloads.items():
+            device = path / PAYLOADS_DIR / str(device_id)
+            device.mkdir(parents=True, exist_ok=True)
+            for index, payload in enumerate(payloads):
+                (device / f'{index}.json').write_bytes(payload)
+
+
+@dataclass
+class Simulator:
+    config: SimulatorConfig
+    device_ids: List[uuid.UUID] = field(default_factory=list)
+    sessions: Dict[str, float] = field(default_factory=dict)
+    csrf_token: str = field(default_factory=lambda: secrets.token_hex(16))
+    requests: Counter = field(default_factory=Counter)
+    # Replayed instead of generating responses, every device cycles through its recorded payloads
+    recording: Optional[Recording] = None
+    replayed: Counter = field(default_factory=Counter)
+
+    def __post_init__(self):
+        if self.recording is not None:
+            self.device_ids = list(self.recording.payloads)
+        self.device_ids = self.device_ids or [uuid.uuid4() for _ in range(self.config.devices)]
+
+    def session_valid(self, request: web.Request) -> bool:
+        expires = self.sessions.get(request.cookies.get(SESSION_COOKIE))
+        return expires is not None and expires > time.monotonic()
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests[f'{request.method} {request.path}'] += 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        return await handler(request)
+
+    def require_session(self, request: web.Request) -> None:
+        if not self.session_valid(request):
+            raise web.HTTPFound(f'/Login?ReturnUrl={request.path}')
+
+    async def login_page(self, request: web.Request) -> web.Response:
+        return web.Response(content_type='text/html', text=f"""
+            <html><body>
+                <form action="/Login" method="post">
+                    <input name="Username" /><input name="Password" type="password" />
+                    <input name="__RequestVerificationToken" type="hidden" value="{self.csrf_token}" />
+                </form>
+            </body></html>""")
+
+    async def login(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get('__RequestVerificationToken') != self.csrf_token or not form.get('Username'):
+            return await self.login_page(request)
+        session = secrets.token_hex(16)
+        self.sessions[session] = time.monotonic() + self.config.session_lifetime
+        response = web.HTTPFound('/account/customerdevice')
+        response.set_cookie(SESSION_COOKIE, session)
+        raise response
+
+    async def devices(self, request: web.Request) -> web.Response:
+        self.require_session(request)
+        if self.recording is not None:
+            return web.Response(body=self.recording.devices_page, content_type='text/html', charset='utf-8')
+        links = ''.join(
+            f'<ul class="device-info-list"><li><a href="{request.path}/{device_id}">UltraQ {index}</a></li></ul>'
+            for index, device_id in enumerate(self.device_ids)
+        )
+        return web.Response(content_type='text/html', text=f'<html><body>{links}</body></html>')
+
+    async def temperatures_read(self, request: web.Request) -> web.Response:
+        self.require_session(request)
+        if random.random() < self.config.error_rate:
+            raise web.HTTPInternalServerError()
+        device_id = uuid.UUID(request.query['id'])
+        if self.recording is not None:
+            payloads = self.recording.payloads[device_id]
+            payload = payloads[self.replayed[device_id] % len(payloads)]
+            self.replayed[device_id] += 1
+            return web.Response(body=payload, content_type='application/json')
+        index = self.device_ids.index(device_id)
+        return web.json_response({
+            'bbqGuruDeviceModel': 'UltraQ',
+            'customerDeviceName': f'UltraQ {index}',
+            'indicateStatus': 'good' if index % 2 == 0 else 'offline',
+            'pitActualTemp': round(random.uniform(100, 110), 1),
+            'pitTargetTemp': 107,
+            'food1ActualTemp': round(random.uniform(60, 70), 1),
+            'food1TargetTemp': 95,
+            'food2ActualTemp': round(random.uniform(60, 70), 1),
+            'food2TargetTemp': 96,
+            'food3ActualTemp': -500,
+            'food3TargetTemp': 97,
+            'currentOutputPercent': random.randint(0, 100),
+            'lastDeviceCommunicationTimestamp': datetime.now().isoformat(),
+        })
+
+    async def profile(self, request: web.Request) -> web.Response:
+        self.require_session(request)
+        if self.recording is not None:
+            return web.Response(body=self.recording.profile_page, content_type='text/html', charset='utf-8')
+        inputs = ''.join(
+            f'<input {checked} id="TemperatureUnit" name="TemperatureUnit" type="radio" value="{units}" /> {units}'
+            for units, checked in [(u, 'checked="checked"' if u == self.config.units else '') for u in UNITS]
+        )
+        return web.Response(content_type='text/html', text=f'<html><body>{inputs}</body></html>')
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.requests))
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/', self.login_page)
+        app.router.add_get('/Login', self.login_page)
+        app.router.add_post('/Login', self.login)
+        app.router.add_get('/account/customerdevice', self.devices)
+        app.router.add_get('/account/customerdevice/temperatures_read', self.temperatures_read)
+        app.router.add_get('/Account/Profile', self.profile)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=SimulatorConfig.devices)
+    parser.add_argument('--latency', type=float, default=SimulatorConfig.latency,
+                        help='Seconds added to every response. [%(default)s]')
+    parser.add_argument('--error-rate', type=float, default=SimulatorConfig.error_rate,
+                        help='Fraction of temperatures_read requests that fail. [%(default)s]')
+    parser.add_argument('--session-lifetime', type=float, default=SimulatorConfig.session_lifetime,
+                        help='Seconds after which a login session expires. [%(default)s]')
+    parser.add_argument('--units', choices=UNITS, default=SimulatorConfig.units)
+    parser.add_argument('--replay',
+                        help='Directory with responses captured by benchmarks.record, '
+                        'served instead of generated ones. --devices and --units are ignored.')
+    return parser
+
+
+def main(args: Optional[List[str]] = None):
+    args = create_parser().parse_args(args)
+    config = SimulatorConfig(args.devices, args.latency, args.error_rate, args.session_lifetime, args.units)
+    recording = Recording.load(args.replay) if args.replay else None
+    web.run_app(Simulator(config, recording=recording).create_app(), host='localhost', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ from argparse import ArgumentParser
 
 from brewblox_service import brewblox_logger, http, mqtt, scheduler, service
 
-from brewblox_sharemycook import broadcaster
+from brewblox_sharemycook import broadcaster, metrics
 
 LOGGER = brewblox_logger(__name__)
 
@@ -27,6 +27,118 @@ def create_parser(default_name='brewblox-sharemycook') -> ArgumentParser:
                         help='Interval (in seconds) between polling when no active devices detected. [%(default)s]',
                         type=float,
                         default=300)
+    parser.add_argument('--poll-concurrency',
+                        help='Maximum number of devices polled concurrently. [%(default)s]',
+                        type=int,
+                        default=4)
+    parser.add_argument('--discovery-interval',
+                        help='Interval (in seconds) between refreshing the list of devices. [%(default)s]',
+                        type=float,
+                        default=300)
+    parser.add_argument('--session-keepalive',
+                        help='Interval (in seconds) after which an idle session is renewed in the background. '
+                        '[%(default)s]',
+                        type=float,
+                        default=300)
+    parser.add_argument('--cookie-file',
+                        help='File used to persist session cookies across restarts, suffixed with the username '
+                        'of each account. Empty to disable. [%(default)s]',
+                        default='sharemycook-cookies.pickle')
+    parser.add_argument('--publish-heartbeat',
+                        help='Interval (in seconds) after which an unchanged sample is published again, '
+                        '0 to never publish unchanged samples. [%(default)s]',
+                        type=float,
+                        default=60)
+    parser.add_argument('--deadband',
+                        help='Minimum change of a probe temperature before it is published again, '
+                        'in the units of the account. 0 to publish every change. [%(default)s]',
+                        type=float,
+                        default=0)
+    parser.add_argument('--aggregate-window',
+                        help='Interval (in seconds) over which probe temperatures are aggregated, '
+                        'and published as their mean, minimum and maximum. 0 to publish every sample. [%(default)s]',
+                        type=float,
+                        default=0)
+    parser.add_argument('--analytics-smoothing',
+                        help='Period (in seconds) over which the rate of change of probe temperatures is smoothed '
+                        'for the derived cook analytics. 0 to not publish cook analytics. [%(default)s]',
+                        type=float,
+                        default=0)
+    parser.add_argument('--publish-buffer',
+                        help='Maximum number of messages buffered while the MQTT broker is unavailable. [%(default)s]',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--backlog-file',
+                        help='File in which samples that could not be published are kept, '
+                        'so they survive longer broker outages and restarts. '
+                        'Leave empty to only buffer --publish-buffer messages in memory. [%(default)s]',
+                        default='sharemycook-backlog.ring')
+    parser.add_argument('--backlog-size',
+                        help='Size of the backlog file in bytes, the oldest samples are dropped when it is full. '
+                        '[%(default)s]',
+                        type=int,
+                        default=4 * 1024 * 1024)
+    parser.add_argument('--backlog-replay-rate',
+                        help='Maximum number of backlogged samples published per second. [%(default)s]',
+                        type=float,
+                        default=20)
+    parser.add_argument('--archive-file',
+                        help='File in which the most recent samples are kept, published or not, '
+                        'to be exported with `python3 -m brewblox_sharemycook.export`. '
+                        'Leave empty to not archive samples. [%(default)s]',
+                        default='sharemycook-archive.ring')
+    parser.add_argument('--archive-size',
+                        help='Size of the archive file in bytes, the oldest samples are dropped when it is full. '
+                        '[%(default)s]',
+                        type=int,
+                        default=32 * 1024 * 1024)
+    parser.add_argument('--share-my-cook-url',
+                        help='Base URL of ShareMyCook, override to point at a local simulator. [%(default)s]',
+                        default='https://sharemycook.com')
+    parser.add_argument('--http-pool-size',
+                        help='Maximum number of simultaneous connections to ShareMyCook. [%(default)s]',
+                        type=int,
+                        default=10)
+    parser.add_argument('--http-keepalive',
+                        help='Seconds an idle connection to ShareMyCook is kept open for reuse. [%(default)s]',
+                        type=float,
+                        default=60)
+    parser.add_argument('--http-dns-ttl',
+                        help='Seconds a DNS lookup of ShareMyCook is cached. [%(default)s]',
+                        type=float,
+                        default=300)
+    parser.add_argument('--http-connect-timeout',
+                        help='Seconds to wait for a connection to ShareMyCook, including the TLS handshake. '
+                        '[%(default)s]',
+                        type=float,
+                        default=10)
+    parser.add_argument('--http-read-timeout',
+                        help='Seconds to wait for data from an open connection to ShareMyCook. [%(default)s]',
+                        type=float,
+                        default=30)
+    parser.add_argument('--units-ttl',
+                        help='Seconds after which the temperature units are looked up again in the background. '
+                        '[%(default)s]',
+                        type=float,
+                        default=600)
+    parser.add_argument('--breaker-threshold',
+                        help='Consecutive failed requests after which requests to ShareMyCook are suspended. '
+                        '[%(default)s]',
+                        type=int,
+                        default=5)
+    parser.add_argument('--breaker-min-backoff',
+                        help='Seconds requests are suspended after the first failure streak, '
+                        'doubled for every streak that follows. [%(default)s]',
+                        type=float,
+                        default=5)
+    parser.add_argument('--breaker-max-backoff',
+                        help='Maximum number of seconds requests are suspended. [%(default)s]',
+                        type=float,
+                        default=600)
+    parser.add_argument('--accounts-file',
+                        help='JSON file with a list of {"username": ..., "password": ...} accounts to poll, '
+                        'instead of --username/--password. [%(default)s]',
+                        default='')
     parser.add_argument('--username', help='Share My Cook Username')
     parser.add_argument('--password', help='Share My Cook Password')
 
@@ -40,6 +152,7 @@ def main() -> None:
     mqtt.setup(app)
     http.setup(app)
     broadcaster.setup(app)
+    metrics.setup(app)
 
     service.furnish(app)
     service.run(app)
@@ -0,0 +1,60 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, List, Mapping, Optional
+
+
+@dataclass
+class Account:
+    username: str
+    password: str
+    cookie_file: Optional[str] = None
+
+
+def account_cookie_file(cookie_file: str, username: str) -> Optional[str]:
+    """
+    Derive a per account cookie file from the --cookie-file setting, so accounts never share cookies,
+    and a changed username does not resume the session of the previous account
+    """
+    if not cookie_file:
+        return None
+    root, ext = os.path.splitext(cookie_file)
+    return f'{root}-{username}{ext}'
+
+
+def load_accounts(config: Mapping[str, Any]) -> List[Account]:
+    """
+    Load the accounts to poll from the --accounts-file JSON file, a list of objects with
+    `username`, `password` and optionally `cookie_file` keys.
+
+    Without an accounts file, the single account given by --username/--password
+    or the USERNAME/PASSWORD environment variables is used.
+    """
+    accounts_file = config['accounts_file']
+    if not accounts_file:
+        username = config.get('username') or os.environ['USERNAME']
+        return [Account(
+            username=username,
+            password=config.get('password') or os.environ['PASSWORD'],
+            cookie_file=account_cookie_file(config['cookie_file'], username),
+        )]
+
+    with open(accounts_file) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f'{accounts_file} must contain a non-empty list of accounts')
+
+    accounts = []
+    for index, entry in enumerate(entries):
+        try:
+            username = entry['username']
+            password = entry['password']
+        except (KeyError, TypeError):
+            raise ValueError(f'Account {index} in {accounts_file} must have a username and password')
+        cookie_file = entry.get('cookie_file') or account_cookie_file(config['cookie_file'], username)
+        accounts.append(Account(username, password, cookie_file))
+
+    usernames = [account.username for account in accounts]
+    if len(set(usernames)) != len(usernames):
+        raise ValueError(f'{accounts_file} contains duplicate usernames')
+    return accounts
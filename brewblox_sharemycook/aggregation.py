@@ -0,0 +1,136 @@
+"""
+Optional downsampling of the samples published to the history service
+"""
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Mapping, Optional
+
+from brewblox_sharemycook.metrics import AGGREGATED
+
+# Fields holding probe temperatures, which are subject to the deadband
+TEMPERATURE_FIELDS = ('Values', 'Min', 'Max')
+
+Sample = Mapping[str, Any]
+
+
+@dataclass
+class Window:
+    start: float
+    latest: Optional[Sample] = None
+    counts: Dict[str, int] = field(default_factory=dict)
+    totals: Dict[str, float] = field(default_factory=dict)
+    minima: Dict[str, float] = field(default_factory=dict)
+    maxima: Dict[str, float] = field(default_factory=dict)
+
+    def add(self, values: Mapping[str, float]) -> None:
+        for key, value in values.items():
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.totals[key] = self.totals.get(key, 0) + value
+            self.minima[key] = min(self.minima.get(key, value), value)
+            self.maxima[key] = max(self.maxima.get(key, value), value)
+
+    def aggregate(self, latest: Sample) -> Sample:
+        """
+        The latest sample, with its values replaced by the window means and Min and Max added
+        """
+        return {
+            **latest,
+            'Values': {key: self.totals[key] / count for key, count in self.counts.items()},
+            'Min': self.minima,
+            'Max': self.maxima,
+        }
+
+
+class Aggregator:
+    """
+    Reduces the samples of online devices before they are published
+
+    With a `window`, the probe values of a device are collected for that many seconds
+    and published once, as their mean along with their Min and Max.
+    With a `deadband`, a probe temperature is only published after it moved at least `deadband` degrees
+    from the last published temperature. Other fields are only published when they changed.
+    Every `heartbeat` seconds a complete sample is published regardless.
+    """
+
+    def __init__(self, deadband: float, window: float, heartbeat: float = 0) -> None:
+        self.deadband = deadband
+        self.window = window
+        self.heartbeat = heartbeat
+        self.windows: Dict[uuid.UUID, Window] = {}
+        self.published: Dict[uuid.UUID, Dict[Any, Any]] = {}
+        self.complete_published: Dict[uuid.UUID, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.deadband or self.window)
+
+    def add(self, device_id: uuid.UUID, data: Mapping[str, Sample], now: float) -> List[Mapping[str, Sample]]:
+        """
+        Add a serialized sample of a device
+
+        :return: the messages to publish now, if any
+        """
+        if not self.enabled:
+            return [data]
+        (name, sample), = data.items()
+        reduced = [self.apply_deadband(device_id, s, now) for s in self.apply_window(device_id, sample, now)]
+        messages = [{name: s} for s in reduced if s]
+        if not messages:
+            AGGREGATED.inc()
+        return messages
+
+    def apply_window(self, device_id: uuid.UUID, sample: Sample, now: float) -> List[Sample]:
+        if not self.window:
+            return [sample]
+        window = self.windows.get(device_id)
+        if 'Values' not in sample:
+            # Offline, close the current window right away
+            self.windows.pop(device_id, None)
+            return [sample] if window is None else [window.aggregate(window.latest), sample]
+
+        if window is None:
+            window = self.windows[device_id] = Window(now)
+        window.add(sample['Values'])
+        window.latest = sample
+        if now - window.start < self.window:
+            return []
+        del self.windows[device_id]
+        return [window.aggregate(sample)]
+
+    def apply_deadband(self, device_id: uuid.UUID, sample: Sample, now: float) -> Optional[Sample]:
+        if not self.deadband:
+            return sample
+        last_complete = self.complete_published.get(device_id)
+        complete = last_complete is None or bool(self.heartbeat and now - last_complete >= self.heartbeat)
+        if complete:
+            self.complete_published[device_id] = now
+
+        published = self.published.setdefault(device_id, {})
+        reduced = {}
+        for name, value in sample.items():
+            if isinstance(value, Mapping):
+                threshold = self.deadband if name in TEMPERATURE_FIELDS else 0
+                changed = {k: v for k, v in value.items() if self.moved(published, (name, k), v, threshold, complete)}
+                if changed:
+                    reduced[name] = changed
+            elif self.moved(published, name, value, 0, complete):
+                reduced[name] = value
+        return reduced
+
+    @staticmethod
+    def moved(published: Dict[Any, Any], key: Any, value: Any, threshold: float, force: bool) -> bool:
+        """
+        Whether a value differs enough from its last published value, recording it as published if so
+        """
+        previous = published.get(key)
+        if not force and previous is not None:
+            unchanged = abs(value - previous) < threshold if threshold else value == previous
+            if unchanged:
+                return False
+        published[key] = value
+        return True
+
+    def forget(self, device_id: uuid.UUID) -> None:
+        self.windows.pop(device_id, None)
+        self.published.pop(device_id, None)
+        self.complete_published.pop(device_id, None)
@@ -0,0 +1,121 @@
+"""
+Cook analytics derived from the samples of a device as they come in, without reading back history
+
+Every probe keeps a constant amount of state, and every sample updates it in constant time.
+"""
+import math
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+from brewblox_sharemycook.controllers import TemperatureUnits
+
+# Thresholds in degrees Celsius, scaled for accounts using Fahrenheit
+SCALE_FACTOR = {
+    TemperatureUnits.CELSIUS: 1,
+    TemperatureUnits.FAHRENHEIT: 1.8,
+}
+# Probes rising slower than this (degrees per minute) are not heating up
+STALL_RATE = 0.05
+# ... after having risen at least this fast
+COOKING_RATE = 0.2
+# ... for at least this long (seconds)
+STALL_DURATION = 900
+# ... while at least this far below target (degrees)
+STALL_MARGIN = 5
+
+
+@dataclass
+class ProbeTrend:
+    temp: float
+    time: float
+    # Exponentially weighted rate of change, in degrees per minute
+    rate: Optional[float] = None
+    peak_rate: float = 0
+    slow_since: Optional[float] = None
+
+    def update(self, temp: float, time: float, smoothing: float, stall_rate: float) -> None:
+        elapsed = time - self.time
+        if elapsed <= 0:
+            return
+        rate = (temp - self.temp) / elapsed * 60
+        if self.rate is None:
+            self.rate = rate
+        else:
+            # Weighted by elapsed time, so irregular sample intervals are smoothed over the same period
+            self.rate += (1 - math.exp(-elapsed / smoothing)) * (rate - self.rate)
+        self.temp = temp
+        self.time = time
+        self.peak_rate = max(self.peak_rate, self.rate)
+        if self.rate >= stall_rate:
+            self.slow_since = None
+        elif self.slow_since is None:
+            self.slow_since = time
+
+    def minutes_to(self, target: float, stall_rate: float) -> Optional[float]:
+        """
+        Estimated minutes until the probe reaches `target` at its current rate, if it is heating towards it
+        """
+        if self.rate is None or self.rate < stall_rate or self.temp >= target:
+            return None
+        return (target - self.temp) / self.rate
+
+    def stalled(self, target: float, scale: float) -> bool:
+        return (
+            self.peak_rate >= COOKING_RATE * scale
+            and self.slow_since is not None
+            and self.time - self.slow_since >= STALL_DURATION
+            and self.temp < target - STALL_MARGIN * scale
+        )
+
+
+@dataclass
+class CookAnalytics:
+    """
+    Rate of change, time to target and stall state of the probes of a single device
+    """
+    smoothing: float
+    probes: Dict[str, ProbeTrend] = field(default_factory=dict)
+
+    def annotate(self, units: TemperatureUnits, time: float, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Update the estimates with a serialized sample, and add them to it
+
+        :param units: temperature units of the sample
+        :param time: timestamp (in seconds) at which the device took the sample
+        :param data: the serialized sample, samples without values are returned as is
+        """
+        (name, sample), = data.items()
+        values = sample.get('Values')
+        if values is None:
+            return data
+
+        scale = SCALE_FACTOR[units]
+        stall_rate = STALL_RATE * scale
+        targets = sample.get('Targets', {})
+        # Disconnected probes start over when they are connected again
+        self.probes = {key: self.probes[key] for key in values if key in self.probes}
+
+        rates = {}
+        times_to_target = {}
+        stalled = {}
+        for key, temp in values.items():
+            probe = self.probes.get(key)
+            if probe is None:
+                probe = self.probes[key] = ProbeTrend(temp, time)
+            probe.update(temp, time, self.smoothing, stall_rate)
+            if probe.rate is None:
+                continue
+            probe_name, _, unit = key.partition('[')
+            rates[f'{probe_name}[{unit[:-1]}/min]'] = round(probe.rate, 2)
+            if key in targets:
+                minutes = probe.minutes_to(targets[key], stall_rate)
+                if minutes is not None:
+                    times_to_target[f'{probe_name}[min]'] = round(minutes, 1)
+                stalled[probe_name] = int(probe.stalled(targets[key], scale))
+
+        derived = {
+            'Rate': rates,
+            'Time_To_Target': times_to_target,
+            'Stalled': stalled,
+        }
+        return {name: {**sample, **{k: v for k, v in derived.items() if v}}}
@@ -1,11 +1,23 @@
 import asyncio
-import os
+import datetime
+import time
+import uuid
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
 
-from aiohttp import web
-from brewblox_service import (brewblox_logger, features, mqtt, repeater, http)
+from aiohttp import TCPConnector, web
+from brewblox_service import (brewblox_logger, features, repeater, scheduler, strex)
 
+from brewblox_sharemycook.accounts import load_accounts
+from brewblox_sharemycook.aggregation import Aggregator
+from brewblox_sharemycook.analytics import CookAnalytics
+from brewblox_sharemycook.circuit_breaker import BreakerSettings
+from brewblox_sharemycook.change_detection import ChangeDetector
 from brewblox_sharemycook.controllers import State, Controller
-from brewblox_sharemycook.share_my_cook import ShareMyCook
+from brewblox_sharemycook.metrics import DEVICE_STALENESS, MISSED_TICKS, TICK_OVERRUN
+from brewblox_sharemycook.publishing import Publisher
+from brewblox_sharemycook.ring_buffer import RingBuffer
+from brewblox_sharemycook.share_my_cook import create_connector, create_session, ShareMyCook
 
 LOGGER = brewblox_logger(__name__)
 
@@ -19,8 +31,26 @@ class Broadcaster(repeater.RepeaterFeature):
         self.inactive_interval = None
         self.current_interval = None
         self.topic = None
-        self.share_my_cook = None
+        self.concurrency = None
+        self.discovery_interval = None
+        self.session_keepalive = None
+        self.change_detector = None
+        self.aggregator = None
+        self.publisher = None
+        self.breaker_settings = None
+        self.tasks: List[asyncio.Task] = []
+        self.connector: Optional[TCPConnector] = None
+        self.accounts: List[ShareMyCook] = []
+        self.discovered = asyncio.Event()
         self.device_states = {}
+        self.analytics_smoothing = None
+        self.device_analytics: Dict[uuid.UUID, CookAnalytics] = {}
+        # The name of each device, and the name its samples are published under
+        self.device_names: Dict[uuid.UUID, Tuple[str, str]] = {}
+        self.poll_deadlines: Dict[uuid.UUID, float] = {}
+        self.last_updates: Dict[uuid.UUID, Tuple[datetime.datetime, float]] = {}
+        self.next_tick: Optional[float] = None
+        self.missed_ticks = 0
 
     async def prepare(self):
         self.name = self.app['config']['name']
@@ -28,15 +58,140 @@ class Broadcaster(repeater.RepeaterFeature):
         self.inactive_interval = self.app['config']['inactive_poll_interval']
         self.current_interval = self.inactive_interval
         self.topic = f'{self.app["config"]["history_topic"]}/share-my-cook'
+        self.concurrency = self.app['config']['poll_concurrency']
+        self.discovery_interval = self.app['config']['discovery_interval']
+        self.session_keepalive = self.app['config']['session_keepalive']
+        self.change_detector = ChangeDetector(self.app['config']['publish_heartbeat'])
+        self.analytics_smoothing = self.app['config']['analytics_smoothing']
+        self.aggregator = Aggregator(
+            self.app['config']['deadband'],
+            self.app['config']['aggregate_window'],
+            self.app['config']['publish_heartbeat'],
+        )
+        backlog_file = self.app['config']['backlog_file']
+        archive_file = self.app['config']['archive_file']
+        self.publisher = Publisher(
+            self.app,
+            self.app['config']['publish_buffer'],
+            RingBuffer(backlog_file, self.app['config']['backlog_size']) if backlog_file else None,
+            self.app['config']['backlog_replay_rate'],
+            RingBuffer(archive_file, self.app['config']['archive_size']) if archive_file else None,
+        )
+        self.breaker_settings = BreakerSettings(
+            threshold=self.app['config']['breaker_threshold'],
+            min_backoff=self.app['config']['breaker_min_backoff'],
+            max_backoff=self.app['config']['breaker_max_backoff'],
+        )
 
-        username = self.app['config'].get('username') or os.environ['USERNAME']
-        password = self.app['config'].get('password') or os.environ['PASSWORD']
-        self.share_my_cook = ShareMyCook(http.session(self.app), username, password)
+        # Every account has its own session and cookie jar, but they all share one connection pool
+        config = self.app['config']
+        self.connector = create_connector(config['http_pool_size'], config['http_keepalive'], config['http_dns_ttl'])
+        for index, account in enumerate(load_accounts(config)):
+            share_my_cook = ShareMyCook(
+                create_session(self.connector, config['http_connect_timeout'], config['http_read_timeout']),
+                account.username,
+                account.password,
+                self.concurrency,
+                account.cookie_file,
+                config['share_my_cook_url'],
+                self.breaker_settings,
+                config['units_ttl'],
+                account_index=index,
+            )
+            share_my_cook.load_cookies()
+            self.accounts.append(share_my_cook)
 
+        LOGGER.info(f'Accounts: {", ".join(account.username for account in self.accounts)}')
         LOGGER.info(f'Polling intervals: Active {self.active_interval}s, Inactive {self.inactive_interval}s')
+        LOGGER.info(f'Poll concurrency: {self.concurrency}')
+        LOGGER.info(f'Discovery interval: {self.discovery_interval}s')
+        LOGGER.info(f'Session keep-alive: {self.session_keepalive}s')
+        LOGGER.info(f'Publish heartbeat: {self.change_detector.heartbeat}s')
+        if self.analytics_smoothing:
+            LOGGER.info(f'Cook analytics smoothing: {self.analytics_smoothing}s')
+        if self.aggregator.enabled:
+            LOGGER.info(f'Aggregation: deadband {self.aggregator.deadband}, window {self.aggregator.window}s')
+        LOGGER.info(f'Publish buffer: {self.publisher.buffer.maxlen} messages')
+        if self.publisher.backlog is not None:
+            LOGGER.info(f'Publish backlog: {backlog_file} ({self.app["config"]["backlog_size"]} bytes)')
+        if self.publisher.archive is not None:
+            LOGGER.info(f'Sample archive: {archive_file} ({self.app["config"]["archive_size"]} bytes)')
         LOGGER.info(f'name: {self.name}')
         LOGGER.info(f'topic: {self.topic}')
 
+        self.tasks = [await scheduler.create(self.app, self.publisher.run())]
+        for account in self.accounts:
+            self.tasks += [
+                await scheduler.create(self.app, self.start_account(account)),
+                await scheduler.create(self.app, self.every(
+                    self.session_keepalive, partial(self.keep_alive, account),
+                    f'Session keep-alive for {account.username}')),
+            ]
+
+    async def shutdown(self, app: web.Application):
+        # Stop polling first, so no poll runs against closed sessions, and no sample is queued after the backlog closed
+        await super().shutdown(app)
+        for task in self.tasks:
+            await scheduler.cancel(app, task)
+        self.tasks = []
+        for account in self.accounts:
+            account.save_cookies()
+            await account.close()
+        self.accounts = []
+        if self.connector is not None:
+            await self.connector.close()
+            self.connector = None
+        if self.publisher is not None:
+            self.publisher.close()
+
+    async def start_account(self, account: ShareMyCook) -> None:
+        """
+        Login and discover devices as soon as possible, so the first samples are published right after discovery
+        """
+        try:
+            await account.start()
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            LOGGER.warning(f'Login for {account.username} failed: {strex(ex)}')
+        await self.every(self.discovery_interval, partial(self.discover, account),
+                         f'Device discovery for {account.username}')
+
+    async def every(self, interval: float, func: Callable[[], Awaitable[None]], description: str) -> None:
+        """
+        Call `func` in the background every `interval` seconds, errors are logged and retried on the next interval
+        """
+        while True:
+            try:
+                await func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOGGER.warning(f'{description} failed: {strex(ex)}')
+            await asyncio.sleep(interval)
+
+    async def discover(self, account: ShareMyCook) -> None:
+        """
+        Refresh the device set in the background so polling never waits on the devices page
+        """
+        _, retired = await account.discover()
+        self.discovered.set()
+        for device_id in retired:
+            self.device_states.pop(device_id, None)
+            self.device_analytics.pop(device_id, None)
+            self.poll_deadlines.pop(device_id, None)
+            self.last_updates.pop(device_id, None)
+            self.change_detector.forget(device_id)
+            self.aggregator.forget(device_id)
+            if self.device_names.pop(device_id, None) is not None:
+                DEVICE_STALENESS.remove(str(device_id))
+
+    async def keep_alive(self, account: ShareMyCook) -> None:
+        """
+        Renew the session in the background so polling never pays for a login
+        """
+        await account.keep_alive(self.session_keepalive)
+
     @property
     def active_devices(self) -> bool:
         return State.ONLINE in self.device_states.values()
@@ -46,6 +201,8 @@ class Broadcaster(repeater.RepeaterFeature):
         """
         If devices are offline, reduce the polling interval to self.inactive_interval
 
+        This is the interval between ticks, each device is only polled on the ticks it is due, see self.device_interval
+
         :return: poll interval
         """
         new_interval = self.active_interval if self.active_devices else self.inactive_interval
@@ -54,17 +211,119 @@ class Broadcaster(repeater.RepeaterFeature):
             self.current_interval = new_interval
         return self.current_interval
 
+    def device_interval(self, device_data: Controller, tick: float) -> float:
+        """
+        Devices that are offline, or online but no longer reporting new data,
+        are polled at self.inactive_interval, all others at self.active_interval
+
+        :return: interval until the device should be polled again
+        """
+        device_id = device_data.device_id
+        last_update = self.last_updates.get(device_id)
+        if last_update is None or last_update[0] != device_data.last_update:
+            last_update = self.last_updates[device_id] = (device_data.last_update, tick)
+
+        if device_data.state == State.ONLINE and tick - last_update[1] < self.inactive_interval:
+            return self.active_interval
+        return self.inactive_interval
+
+    def due_devices(self, account: ShareMyCook, tick: float) -> List[uuid.UUID]:
+        """
+        Devices of an account that are due to be polled on this tick, new devices are always due
+        """
+        # Allow for floating point drift between the tick and poll deadlines
+        tick += self.interval / 2
+        return [device_id for device_id in account.device_ids
+                if self.poll_deadlines.get(device_id, tick) <= tick]
+
+    async def sleep_until_next_tick(self) -> None:
+        """
+        Sleep until the next tick deadline, keeping an even period regardless of how long polling took
+
+        Ticks whose deadline already passed are skipped and counted in self.missed_ticks instead of being run late.
+        """
+        interval = self.interval
+        now = time.monotonic()
+        self.next_tick = (self.next_tick or now) + interval
+        TICK_OVERRUN.observe(max(0.0, now - self.next_tick))
+        if self.next_tick < now:
+            missed = int((now - self.next_tick) // interval) + 1
+            self.missed_ticks += missed
+            MISSED_TICKS.inc(missed)
+            self.next_tick += missed * interval
+            LOGGER.warning(f'Polling took longer than the {interval}s interval, skipped {missed} tick(s)')
+        await asyncio.sleep(self.next_tick - now)
+
     async def run(self) -> None:
 
         try:
-            for device_data in await self.share_my_cook.poll():
+            await self.discovered.wait()
+            if self.next_tick is None:
+                self.next_tick = time.monotonic()
+            tick = self.next_tick
+            polls = await asyncio.gather(*(account.poll(self.due_devices(account, tick)) for account in self.accounts))
+            results = [(account, result) for account, results in zip(self.accounts, polls) for result in results]
+            for account, result in results:
+                if result.error is not None:
+                    # Retry on the next tick
+                    self.poll_deadlines.pop(result.device_id, None)
+                    continue
+                device_data = result.controller
+                LOGGER.debug(f'Polled {device_data.name}({result.device_id}) in {result.duration:.3f}s')
                 self.report_device_state_changes(device_data)
-                device_topic = f'{self.topic}/{device_data.name}'
-                data = device_data.serialize()
-                LOGGER.debug(f'Publishing to {device_topic}: {data}')
-                await mqtt.publish(self.app, device_topic, {'key': 'ShareMyCook', 'data': data})
+                self.report_staleness(device_data)
+                self.poll_deadlines[result.device_id] = tick + self.device_interval(device_data, tick)
+                name = self.published_name(account, device_data)
+                device_topic = f'{self.topic}/{name}'
+                (_, sample), = device_data.serialize().items()
+                data = self.annotate(device_data, {name: sample})
+                if not self.change_detector.should_publish(device_data, data, tick):
+                    LOGGER.debug(f'Suppressed unchanged sample for {device_topic}')
+                    continue
+                for message in self.aggregator.add(result.device_id, data, tick):
+                    LOGGER.debug(f'Publishing to {device_topic}: {message}')
+                    self.publisher.enqueue(device_topic, {'key': 'ShareMyCook', 'data': message},
+                                           device_data.last_update.timestamp())
         finally:
-            await asyncio.sleep(self.interval)
+            await self.sleep_until_next_tick()
+
+    def annotate(self, device_data: Controller, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Add the cook analytics of the device to a serialized sample, if enabled
+        """
+        if not self.analytics_smoothing:
+            return data
+        analytics = self.device_analytics.get(device_data.device_id)
+        if analytics is None:
+            analytics = self.device_analytics[device_data.device_id] = CookAnalytics(self.analytics_smoothing)
+        return analytics.annotate(device_data.units, device_data.last_update.timestamp(), data)
+
+    def published_name(self, account: ShareMyCook, device_data: Controller) -> str:
+        """
+        The name the samples of a device are published under, unique across all accounts
+
+        Devices keep the name they were first published under until they are renamed.
+        A device named like one that is already published is prefixed with the position of its account,
+        e.g. `account1-UltraQ`, or suffixed with its id if that is taken as well.
+        """
+        device_id = device_data.device_id
+        name, published = self.device_names.get(device_id, (None, None))
+        if name == device_data.name:
+            return published
+        taken = {published for other_id, (_, published) in self.device_names.items() if other_id != device_id}
+        candidates = [device_data.name, f'account{account.account_index}-{device_data.name}']
+        published = next((c for c in candidates if c not in taken), f'{device_data.name}-{device_id}')
+        if published != device_data.name:
+            LOGGER.warning(f'Device {device_data.name}({device_id}) of {account.username} is published as {published}, '
+                           'another device has the same name')
+        self.device_names[device_id] = (device_data.name, published)
+        return published
+
+    def report_staleness(self, device_data: Controller) -> None:
+        # Labeled by id, device names are not unique across accounts
+        now = datetime.datetime.now(device_data.last_update.tzinfo)
+        DEVICE_STALENESS.labels(device=str(device_data.device_id)).set(
+            (now - device_data.last_update).total_seconds())
 
     def report_device_state_changes(self, device_data: Controller) -> None:
         device_id = device_data.device_id
@@ -0,0 +1,57 @@
+import datetime
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping
+
+from brewblox_sharemycook.controllers import Controller
+from brewblox_sharemycook.metrics import PUBLISHED, SUPPRESSED
+
+
+@dataclass
+class PublishedSample:
+    last_update: datetime.datetime
+    digest: int
+    published_at: float
+
+
+class ChangeDetector:
+    """
+    Suppresses publishing samples a device already published, as happens when polling faster than it uploads
+    """
+
+    def __init__(self, heartbeat: float) -> None:
+        """
+        :param heartbeat: unchanged samples are published again after this many seconds, 0 to never publish them
+        """
+        self.heartbeat = heartbeat
+        self.published: Dict[uuid.UUID, PublishedSample] = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_publish(self, device_data: Controller, data: Mapping[str, Any], now: float) -> bool:
+        """
+        Decide whether a serialized sample should be published, recording it as published if so
+
+        :param device_data: the polled device
+        :param data: the serialized sample
+        :param now: monotonic time of the sample
+        """
+        digest = hash(repr(data))
+        previous = self.published.get(device_data.device_id)
+        if (
+            previous is not None
+            and previous.last_update == device_data.last_update
+            and previous.digest == digest
+            and not (self.heartbeat and now - previous.published_at >= self.heartbeat)
+        ):
+            self.suppressed += 1
+            SUPPRESSED.inc()
+            return False
+
+        self.published[device_data.device_id] = PublishedSample(device_data.last_update, digest, now)
+        self.sent += 1
+        PUBLISHED.inc()
+        return True
+
+    def forget(self, device_id: uuid.UUID) -> None:
+        self.published.pop(device_id, None)
@@ -0,0 +1,133 @@
+"""
+Circuit breakers that back off from a failing upstream with jittered exponential delays
+"""
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterator, Optional
+
+from brewblox_service import brewblox_logger
+
+from brewblox_sharemycook.metrics import CIRCUIT_STATE
+
+LOGGER = brewblox_logger(__name__)
+
+
+class CircuitState(Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class BreakerSettings:
+    threshold: int = 5
+    min_backoff: float = 5
+    max_backoff: float = 600
+    jitter: float = 0.5
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures, and stays open for an exponentially growing backoff.
+
+    Once the backoff has passed, a single half-open probe is let through:
+    its success closes the circuit, its failure opens it again with a doubled backoff.
+    """
+
+    def __init__(self, name: str, settings: BreakerSettings = BreakerSettings()) -> None:
+        self.name = name
+        self.settings = settings
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at: Optional[float] = None
+        self.probing = False
+        CIRCUIT_STATE.labels(circuit=self.name).set(self.state.value)
+
+    def set_state(self, state: CircuitState) -> None:
+        self.state = state
+        CIRCUIT_STATE.labels(circuit=self.name).set(state.value)
+
+    def backoff(self) -> float:
+        """
+        Delay before the next probe, doubled for every consecutive trip, with up to `jitter` of it randomly left out
+        so that clients recovering from the same outage do not probe in lockstep
+        """
+        delay = min(self.settings.max_backoff, self.settings.min_backoff * 2 ** (self.trips - 1))
+        return random.uniform(delay * (1 - self.settings.jitter), delay)
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """
+        Whether a request may be sent now, moving an open circuit to half-open once its backoff has passed
+        """
+        if self.state == CircuitState.CLOSED:
+            return True
+        now = time.monotonic() if now is None else now
+        if self.state == CircuitState.OPEN and now >= self.retry_at:
+            LOGGER.info(f'Circuit {self.name} is half-open, probing')
+            self.set_state(CircuitState.HALF_OPEN)
+        if self.state == CircuitState.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def check(self, now: Optional[float] = None) -> None:
+        """
+        Like `allow()`, but raises CircuitOpenError when the request may not be sent
+        """
+        if not self.allow(now):
+            raise CircuitOpenError(f'Circuit {self.name} is open')
+
+    @contextmanager
+    def protect(self) -> Iterator[None]:
+        """
+        Guard a request: refuse it while the circuit is open, and record its outcome.
+
+        Requests refused by another circuit or cancelled count as neither success nor failure.
+        """
+        self.check()
+        try:
+            yield
+        except CircuitOpenError:
+            self.probing = False
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.probing = False
+            raise
+        self.record_success()
+
+    def record_success(self) -> None:
+        if self.state != CircuitState.CLOSED:
+            LOGGER.info(f'Circuit {self.name} closed')
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        self.set_state(CircuitState.CLOSED)
+
+    def record_failure(self, now: Optional[float] = None) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.state == CircuitState.CLOSED and self.failures < self.settings.threshold:
+            return
+        now = time.monotonic() if now is None else now
+        self.trips += 1
+        delay = self.backoff()
+        self.retry_at = now + delay
+        LOGGER.warning(f'Circuit {self.name} opened after {self.failures} failure(s), retrying in {delay:.1f}s')
+        self.set_state(CircuitState.OPEN)
+
+    def remove(self) -> None:
+        """
+        Stop reporting the state of a circuit that is no longer used
+        """
+        CIRCUIT_STATE.remove(self.name)
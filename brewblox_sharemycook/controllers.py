@@ -1,15 +1,45 @@
+import dataclasses
 import datetime
+import re
 import uuid
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import Enum
-from typing import Mapping, Union, Any
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, ClassVar, Mapping, NamedTuple, Optional, Sequence, Set, Union, Any, Tuple
+
+from brewblox_service import brewblox_logger
+
+from brewblox_sharemycook.decoding import ModelDecoder
+
+LOGGER = brewblox_logger(__name__)
 
 controller_types = {}
+# Models without a controller type that were already reported
+unknown_models: Set[str] = set()
+
+# JSON keys shared by all models
+MODEL_KEY = 'bbqGuruDeviceModel'
+NAME_KEY = 'customerDeviceName'
+STATUS_KEY = 'indicateStatus'
+TIMESTAMP_KEY = 'lastDeviceCommunicationTimestamp'
+FAN_DUTY_KEY = 'currentOutputPercent'
+COMMON_TYPES = {NAME_KEY: str, STATUS_KEY: str, TIMESTAMP_KEY: str}
+
+# Decodes only the fields registered controller types read from a response
+model_decoder = ModelDecoder(MODEL_KEY)
 
 
 def controller(cls):
+    """
+    Register a controller type for the model of the same name, compiling its schema
+    """
+    field_order = [f.name for f in dataclasses.fields(cls) if f.name not in Controller.__slots__]
+    cls.DECODE_FIELDS = cls.SCHEMA.decode_fields(field_order)
+    cls.ENCODE_FIELDS = cls.SCHEMA.encode_fields()
     controller_types[cls.__name__] = cls
+    model_decoder.register(cls.__name__, cls.SCHEMA.json_types())
     return cls
 
 
@@ -23,8 +53,39 @@ class TemperatureUnits(Enum):
     FAHRENHEIT = 'FAHRENHEIT'
 
 
+TEMP_UNITS = {
+    TemperatureUnits.CELSIUS: 'DegC',
+    TemperatureUnits.FAHRENHEIT: 'DegF',
+}
+
+SCALES = (
+    lambda celsius: celsius * 9 / 5 + 32,
+    lambda fahrenheit: (fahrenheit - 32) * 5 / 9,
+)
+
+
+def scale_converted(previous: Sequence[float], current: Sequence[float], tolerance: float = 1) -> bool:
+    """
+    Whether all temperatures changed as if they were converted between Celsius and Fahrenheit
+    """
+    if not previous or len(previous) != len(current) or tuple(previous) == tuple(current):
+        return False
+    return any(all(abs(convert(p) - c) <= tolerance for p, c in zip(previous, current)) for convert in SCALES)
+
+
+# (temperature accessor, target accessor, MQTT key) per probe
+ProbeFields = Tuple[Tuple[Callable[[Any], float], Callable[[Any], float], str], ...]
+# (JSON key, conversion) per field, in the order of the fields
+DecodeFields = Tuple[Tuple[str, Callable[[Any], Any]], ...]
+# (field accessor, MQTT key) per encoded field other than probes
+EncodeFields = Tuple[Tuple[Callable[[Any], Any], str], ...]
+
+
 @dataclass
 class Controller(ABC):
+    # Slotted, so a controller record carries no per-instance __dict__
+    __slots__ = ('device_id', 'name', 'state', 'units', 'last_update')
+
     DISCONNECTED_TEMP = -500
 
     device_id: uuid.UUID
@@ -35,7 +96,7 @@ class Controller(ABC):
 
     @property
     def temp_units(self) -> str:
-        return f'Deg{"C" if self.units == TemperatureUnits.CELSIUS else "F"}'
+        return TEMP_UNITS[self.units]
 
     @classmethod
     @abstractmethod
@@ -46,6 +107,12 @@ class Controller(ABC):
         Instantiate an instance from ShareMyCook JSON data
         """
 
+    def targets(self) -> Tuple[float, ...]:
+        """
+        Target temperatures, used to detect that the temperature units were changed
+        """
+        return ()
+
     @abstractmethod
     def serialize(self) -> Mapping[str, Any]:  # pragma: nocov
         """
@@ -53,57 +120,222 @@ class Controller(ABC):
         """
 
 
-@controller
+class Probe(NamedTuple):
+    """
+    A probe, decoded from `temp_key` and `target_key` into the `<name>_temp` and `<name>_target` fields,
+    and published as `<name>[<units>]` under Values and Targets
+    """
+    name: str
+    temp_key: str
+    target_key: str
+
+
+class Field(NamedTuple):
+    """
+    Any other value, decoded from `json_key` into `field`, and published as `mqtt_key`
+    """
+    json_key: str
+    field: str
+    mqtt_key: str
+    convert: Callable[[Any], Any] = lambda value: value
+
+
+@dataclass(frozen=True)
+class Schema:
+    """
+    Declares how a controller model maps ShareMyCook JSON keys to fields, and fields to MQTT keys
+    """
+    probes: Tuple[Probe, ...]
+    fields: Tuple[Field, ...] = ()
+
+    def decode_fields(self, field_order: Sequence[str]) -> DecodeFields:
+        """
+        :param field_order: the fields of the controller type, other than the common fields
+        """
+        decoders = {
+            **{f'{probe.name}_{kind}': (key, float)
+               for probe in self.probes for kind, key in [('temp', probe.temp_key), ('target', probe.target_key)]},
+            **{field.field: (field.json_key, field.convert) for field in self.fields},
+        }
+        if set(decoders) != set(field_order):
+            raise TypeError(f'Schema fields {", ".join(sorted(decoders))} '
+                            f'do not match the controller fields {", ".join(sorted(field_order))}')
+        return tuple(decoders[field] for field in field_order)
+
+    def encode_fields(self) -> EncodeFields:
+        return tuple((attrgetter(field.field), field.mqtt_key) for field in self.fields)
+
+    def json_types(self) -> Mapping[str, Any]:
+        """
+        The type of every JSON key the controller reads, other keys are not decoded
+        """
+        return {
+            **COMMON_TYPES,
+            **{key: float for probe in self.probes for key in [probe.temp_key, probe.target_key]},
+            **{field.json_key: Any for field in self.fields},
+        }
+
+
+def common_fields(json: Mapping[str, Any]) -> Tuple[str, State, datetime.datetime]:
+    """
+    The name, state and last update of any model
+    """
+    return (
+        json[NAME_KEY],
+        State.ONLINE if 'good' in json[STATUS_KEY].lower() else State.OFFLINE,
+        datetime.datetime.fromisoformat(json[TIMESTAMP_KEY]),
+    )
+
+
 @dataclass
-class UltraQ(Controller):
-    pit_temp: float
-    pit_target: float
-    food1_temp: float
-    food1_target: float
-    food2_temp: float
-    food2_target: float
-    food3_temp: float
-    food3_target: float
-    fan_duty: int
+class SchemaController(Controller):
+    """
+    A controller decoded and encoded as declared by its SCHEMA
+
+    The schema is compiled into DECODE_FIELDS and ENCODE_FIELDS once, when the type is registered with @controller.
+    """
+    __slots__ = ()
+
+    SCHEMA = Schema(probes=())
+    DECODE_FIELDS: ClassVar[DecodeFields] = ()
+    ENCODE_FIELDS: ClassVar[EncodeFields] = ()
 
     @classmethod
     def from_json(
         cls, device_id: uuid.UUID, units: TemperatureUnits, json: Mapping[str, Union[str, int]]
-    ) -> 'UltraQ':
-        return cls(
-            device_id=device_id,
-            name=json['customerDeviceName'],
-            state=State.ONLINE if 'good' in json['indicateStatus'].lower() else State.OFFLINE,
-            units=units,
-            pit_temp=float(json['pitActualTemp']),
-            pit_target=float(json['pitTargetTemp']),
-            food1_temp=float(json['food1ActualTemp']),
-            food1_target=float(json['food1TargetTemp']),
-            food2_temp=float(json['food2ActualTemp']),
-            food2_target=float(json['food2TargetTemp']),
-            food3_temp=float(json['food3ActualTemp']),
-            food3_target=float(json['food3TargetTemp']),
-            fan_duty=json['currentOutputPercent'],
-            last_update=datetime.datetime.fromisoformat(json['lastDeviceCommunicationTimestamp'])
+    ) -> 'SchemaController':
+        name, state, last_update = common_fields(json)
+        fields = [convert(json[key]) for key, convert in cls.DECODE_FIELDS]
+        return cls(device_id, name, state, units, last_update, *fields)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def probe_fields(cls, units: TemperatureUnits) -> ProbeFields:
+        """
+        Field accessors and MQTT keys for each probe, built once per controller type and units
+        """
+        return tuple(
+            (attrgetter(f'{probe.name}_temp'), attrgetter(f'{probe.name}_target'), f'{probe.name}[{TEMP_UNITS[units]}]')
+            for probe in cls.SCHEMA.probes
         )
 
+    def targets(self) -> Tuple[float, ...]:
+        return tuple(get_target(self) for _, get_target, _ in self.probe_fields(self.units))
+
     def serialize(self) -> Mapping[str, Any]:
+        if self.state != State.ONLINE:
+            return {self.name: {'Active': 0}}
+
         values = {}
         targets = {}
+        for get_temp, get_target, key in self.probe_fields(self.units):
+            probe_temp = get_temp(self)
+            if probe_temp > self.DISCONNECTED_TEMP:
+                values[key] = probe_temp
+                targets[key] = get_target(self)
 
-        data = {
-            'Active': 1 if self.state == State.ONLINE else 0,
-        }
+        data = {'Active': 1}
+        for get_value, key in self.ENCODE_FIELDS:
+            data[key] = get_value(self)
+        data['Targets'] = targets
+        data['Values'] = values
+        return {self.name: data}
 
-        if self.state == State.ONLINE:
-            data['Fan_Duty[%]'] = self.fan_duty if self.state == State.ONLINE else None
-            data['Targets'] = targets
-            data['Values'] = values
 
-            for probe_name in ['pit', 'food1', 'food2', 'food3']:
-                probe_temp = getattr(self, f'{probe_name}_temp')
-                if probe_temp > self.DISCONNECTED_TEMP:
-                    values[f'{probe_name}[{self.temp_units}]'] = probe_temp
-                    targets[f'{probe_name}[{self.temp_units}]'] = getattr(self, f'{probe_name}_target')
+@dataclass
+class GenericController(Controller):
+    """
+    Fallback for models without a controller type, publishing every `<probe>ActualTemp` with its `<probe>TargetTemp`
+    """
+    __slots__ = ('probes', 'fan_duty')
 
-        return {self.name: data}
+    PROBE_KEY = re.compile(r'^(\w+)ActualTemp$')
+
+    # (name, temperature, target) per probe
+    probes: Tuple[Tuple[str, float, Optional[float]], ...]
+    fan_duty: Optional[int]
+
+    @classmethod
+    def from_json(
+        cls, device_id: uuid.UUID, units: TemperatureUnits, json: Mapping[str, Union[str, int]]
+    ) -> 'GenericController':
+        probes = []
+        for key, value in json.items():
+            match = cls.PROBE_KEY.match(key)
+            if match is not None:
+                target = json.get(f'{match.group(1)}TargetTemp')
+                probes.append((match.group(1), float(value), None if target is None else float(target)))
+        name, state, last_update = common_fields(json)
+        return cls(device_id, name, state, units, last_update, tuple(probes), json.get(FAN_DUTY_KEY))
+
+    def targets(self) -> Tuple[float, ...]:
+        return tuple(target for _, _, target in self.probes if target is not None)
+
+    def serialize(self) -> Mapping[str, Any]:
+        if self.state != State.ONLINE:
+            return {self.name: {'Active': 0}}
+
+        values = {}
+        targets = {}
+        for name, temp, target in self.probes:
+            if temp > self.DISCONNECTED_TEMP:
+                key = f'{name}[{self.temp_units}]'
+                values[key] = temp
+                if target is not None:
+                    targets[key] = target
+
+        data = {'Active': 1}
+        if self.fan_duty is not None:
+            data['Fan_Duty[%]'] = self.fan_duty
+        return {self.name: {**data, 'Targets': targets, 'Values': values}}
+
+
+def decode_controller(device_id: uuid.UUID, units: TemperatureUnits, content: bytes) -> Controller:
+    """
+    Instantiate a controller from a ShareMyCook temperatures_read response, decoding only the fields it uses
+
+    Models without a controller type are decoded in full by GenericController.
+    """
+    json = model_decoder.decode(content)
+    model = json.get(MODEL_KEY)
+    controller_type = controller_types.get(model)
+    if controller_type is None:
+        if model not in unknown_models:
+            unknown_models.add(model)
+            LOGGER.warning(f'Unknown controller model {model}, publishing its probes generically')
+        controller_type = GenericController
+    return controller_type.from_json(device_id, units, json)
+
+
+@controller
+@dataclass
+class UltraQ(SchemaController):
+    __slots__ = (
+        'pit_temp', 'pit_target',
+        'food1_temp', 'food1_target',
+        'food2_temp', 'food2_target',
+        'food3_temp', 'food3_target',
+        'fan_duty',
+    )
+
+    SCHEMA = Schema(
+        probes=(
+            Probe('pit', 'pitActualTemp', 'pitTargetTemp'),
+            Probe('food1', 'food1ActualTemp', 'food1TargetTemp'),
+            Probe('food2', 'food2ActualTemp', 'food2TargetTemp'),
+            Probe('food3', 'food3ActualTemp', 'food3TargetTemp'),
+        ),
+        fields=(
+            Field(FAN_DUTY_KEY, 'fan_duty', 'Fan_Duty[%]'),
+        ),
+    )
+
+    pit_temp: float
+    pit_target: float
+    food1_temp: float
+    food1_target: float
+    food2_temp: float
+    food2_target: float
+    food3_temp: float
+    food3_target: float
+    fan_duty: int
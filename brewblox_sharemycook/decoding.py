@@ -0,0 +1,70 @@
+"""
+Decoding of ShareMyCook API responses, and encoding of buffered messages
+
+orjson is used when it is installed, falling back to the standard library json module.
+msgspec is used when it is installed to decode only the fields a controller declares, see ModelDecoder.
+"""
+from typing import Any, Dict, Mapping, Optional, Union
+
+try:
+    from orjson import dumps, loads
+except ImportError:  # pragma: no cover
+    import json
+    from json import loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+__all__ = ['dumps', 'loads', 'ModelDecoder']
+
+
+class ModelDecoder:
+    """
+    Decodes JSON objects that are tagged with their model in `tag_field`,
+    keeping only the top-level fields registered for that model.
+
+    Unregistered fields are skipped without being built, so the cost of a decode depends on the fields used
+    rather than on the size of the response.
+    Without msgspec, for unregistered models, and for missing fields or values of another type,
+    the whole object is decoded with loads().
+    """
+
+    def __init__(self, tag_field: str) -> None:
+        self.tag_field = tag_field
+        self.schemas: Dict[str, Mapping[str, Any]] = {}
+        self.decoder = None
+
+    def register(self, tag: str, fields: Mapping[str, Any]) -> None:
+        """
+        :param fields: the type of each field, values of another type are decoded with loads()
+        """
+        self.schemas[tag] = {k: v for k, v in fields.items() if k != self.tag_field}
+        # Compiled again on the next decode
+        self.decoder = None
+
+    def compile(self) -> Optional['msgspec.json.Decoder']:
+        if msgspec is None or not self.schemas:  # pragma: no cover
+            return None
+        types = tuple(
+            msgspec.defstruct(tag, list(fields.items()), tag_field=self.tag_field, tag=tag)
+            for tag, fields in self.schemas.items()
+        )
+        return msgspec.json.Decoder(Union[types])
+
+    def decode(self, content: bytes) -> Mapping[str, Any]:
+        if self.decoder is None:
+            self.decoder = self.compile()
+            if self.decoder is None:  # pragma: no cover
+                return loads(content)
+        try:
+            decoded = self.decoder.decode(content)
+        except msgspec.DecodeError:
+            return loads(content)
+        values = msgspec.structs.asdict(decoded)
+        values[self.tag_field] = decoded.__struct_config__.tag
+        return values
@@ -0,0 +1,194 @@
+"""
+Export archived, backlogged or replayed samples to columnar files, for analysis of long cooks
+
+Run with `python3 -m brewblox_sharemycook.export sharemycook-archive.ring cook.npz`.
+
+The input is either a ring buffer file (see --archive-file and --backlog-file),
+or a replay file with one JSON record per line:
+`[topic, message, timestamp]` as kept in the ring buffers, or just the published message.
+Every sample becomes a row: `device` and `time` (seconds since epoch, if known),
+followed by a float column per published field, e.g. `Values/pit[DegC]`, with NaN where a sample lacks it.
+
+Exports require numpy, which is installed with the `export` extra, and .parquet files also require pyarrow.
+"""
+import os
+from argparse import ArgumentParser
+from operator import itemgetter
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from brewblox_sharemycook.decoding import loads
+from brewblox_sharemycook.ring_buffer import MAGIC, RingBuffer
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+Record = Tuple[str, Mapping[str, Any], Optional[float]]
+Columns = Dict[str, 'numpy.ndarray']
+
+
+def is_ring_buffer(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def parse_record(raw: Any) -> Record:
+    if isinstance(raw, Mapping):
+        return '', raw, None
+    topic, message, *rest = raw
+    return topic, message, rest[0] if rest else None
+
+
+def read_records(path: str) -> Iterator[Record]:
+    if is_ring_buffer(path):
+        ring = RingBuffer(path, os.path.getsize(path), readonly=True)
+        try:
+            for record in ring:
+                yield parse_record(loads(record))
+        finally:
+            ring.close()
+    else:
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield parse_record(loads(line))
+
+
+def walk(sample: Dict[str, Any], leaves: List[Any]) -> Tuple:
+    """
+    Append the values of a sample, and of the samples nested in it, to `leaves`
+
+    :return: the keys of the sample and of its nested samples, the same for all samples with the same fields
+    """
+    keys = []
+    for key, value in sample.items():
+        if isinstance(value, dict):
+            keys.append((key, walk(value, leaves)))
+        else:
+            keys.append(key)
+            leaves.append(value)
+    return tuple(keys)
+
+
+def leaf_names(keys: Tuple, prefix: str = '') -> Iterator[str]:
+    """
+    The names of the values appended by walk(), nested fields are named `<key>/<nested key>`
+    """
+    for key in keys:
+        if isinstance(key, tuple):
+            yield from leaf_names(key[1], f'{prefix}{key[0]}/')
+        else:
+            yield f'{prefix}{key}'
+
+
+def stack(rows: List[List[Any]], positions: List[int]) -> 'numpy.ndarray':
+    """
+    The values at `positions` in every row as a float array, with NaN for values that are not numbers
+    """
+    picked = [[row[p] for p in positions] for row in rows] if len(positions) == 1 \
+        else list(map(itemgetter(*positions), rows))
+    try:
+        stacked = numpy.array(picked)
+    except ValueError:
+        stacked = None
+    if stacked is not None and stacked.dtype.kind in 'biuf':
+        return stacked.astype(float)
+    return numpy.array([[v if isinstance(v, (int, float)) else numpy.nan for v in row] for row in picked])
+
+
+def to_columns(records: Iterable[Record]) -> Columns:
+    """
+    Collect the samples in the records into one array per field
+
+    Samples with the same fields, usually all samples of a device in the same state, are stacked into one array,
+    whose columns are copied into the field columns at once.
+    Which fields are numbers, and their names, are only looked up once for those samples.
+    """
+    devices: List[str] = []
+    times: List[float] = []
+    # The rows and values of the samples, per set of fields
+    shapes: Dict[Tuple, Tuple[List[int], List[List[Any]]]] = {}
+    for _, message, timestamp in records:
+        for device, sample in message['data'].items():
+            leaves: List[Any] = []
+            rows, values = shapes.setdefault(walk(sample, leaves), ([], []))
+            rows.append(len(devices))
+            values.append(leaves)
+            devices.append(device)
+            times.append(numpy.nan if timestamp is None else timestamp)
+
+    fields: Columns = {}
+    for keys, (rows, values) in shapes.items():
+        numeric = [(position, name) for position, (name, value) in enumerate(zip(leaf_names(keys), values[0]))
+                   if isinstance(value, (int, float))]
+        if not numeric:
+            continue
+        stacked = stack(values, [position for position, _ in numeric])
+        for index, (_, name) in enumerate(numeric):
+            column = fields.get(name)
+            if column is None:
+                column = fields[name] = numpy.full(len(devices), numpy.nan)
+            column[rows] = stacked[:, index]
+    return {
+        'device': numpy.array(devices, dtype=str),
+        'time': numpy.array(times, dtype=float),
+        **dict(sorted(fields.items())),
+    }
+
+
+def write_npz(columns: Columns, path: str) -> None:
+    numpy.savez_compressed(path, **columns)
+
+
+def write_parquet(columns: Columns, path: str) -> None:
+    try:
+        from pyarrow import parquet, table
+    except ImportError:
+        raise SystemExit('pyarrow is required to export to .parquet files')
+    parquet.write_table(table(columns), path)  # pragma: no cover
+
+
+WRITERS = {
+    '.npz': write_npz,
+    '.parquet': write_parquet,
+}
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input',
+                        help='Archive file (see --archive-file), backlog file (see --backlog-file) or replay file')
+    parser.add_argument('output',
+                        help=f'Columnar file to write, one of {", ".join(WRITERS)}')
+    parser.add_argument('--drain',
+                        action='store_true',
+                        help='Remove the exported samples from the archive or backlog, '
+                        'only when the service is stopped')
+    return parser
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    args = create_parser().parse_args(args)
+    if numpy is None:  # pragma: no cover
+        raise SystemExit('numpy is required to export samples, install the export extra')
+    writer = WRITERS.get(os.path.splitext(args.output)[1])
+    if writer is None:
+        raise SystemExit(f'Unable to export to {args.output}, use one of {", ".join(WRITERS)}')
+    if args.drain and not is_ring_buffer(args.input):
+        raise SystemExit(f'Only archive and backlog files can be drained, {args.input} is not one')
+
+    records = list(read_records(args.input))
+    columns = to_columns(records)
+    writer(columns, args.output)
+    print(f'Exported {len(columns["device"])} sample(s) with {len(columns) - 2} field(s) to {args.output}')
+
+    if args.drain:
+        ring = RingBuffer(args.input, os.path.getsize(args.input))
+        for _ in range(min(len(records), len(ring))):
+            ring.pop()
+        ring.close()
+
+
+if __name__ == '__main__':  # pragma: nocov
+    main()
@@ -0,0 +1,54 @@
+"""
+Prometheus instrumentation of the poll and publish paths, served on the /metrics endpoint
+"""
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+
+routes = web.RouteTableDef()
+
+UPSTREAM_LATENCY = Histogram(
+    'sharemycook_upstream_request_seconds', 'Latency of requests to sharemycook.com', ['method', 'path'])
+RELOGINS = Counter(
+    'sharemycook_relogins', 'Requests that found the session expired and required a login')
+PARSE_TIME = Histogram(
+    'sharemycook_parse_seconds', 'Time spent parsing upstream responses', ['page'])
+PAGE_CACHE_HITS = Counter(
+    'sharemycook_page_cache_hits', 'Upstream pages that were not parsed again because they did not change', ['page'])
+PUBLISH_LATENCY = Histogram(
+    'sharemycook_publish_seconds', 'Latency of publishing a message to the MQTT broker')
+PUBLISHED = Counter(
+    'sharemycook_samples_published', 'Samples handed to the publisher')
+SUPPRESSED = Counter(
+    'sharemycook_samples_suppressed', 'Unchanged samples that were not published')
+AGGREGATED = Counter(
+    'sharemycook_samples_aggregated', 'Samples that were held back or reduced to nothing by aggregation')
+DROPPED = Counter(
+    'sharemycook_messages_dropped', 'Messages dropped because the publish buffer was full')
+TICK_OVERRUN = Histogram(
+    'sharemycook_tick_overrun_seconds', 'Time by which a poll cycle overran its tick deadline')
+MISSED_TICKS = Counter(
+    'sharemycook_missed_ticks', 'Ticks skipped because a poll cycle overran')
+DEVICE_STALENESS = Gauge(
+    'sharemycook_device_staleness_seconds', 'Time since the device last reported to sharemycook.com, by device id',
+    ['device'])
+BACKLOG_SIZE = Gauge(
+    'sharemycook_backlog_messages', 'Messages in the on-disk publish backlog')
+CIRCUIT_STATE = Gauge(
+    'sharemycook_circuit_state', 'State of a circuit breaker: 0 closed, 1 half-open, 2 open', ['circuit'])
+
+
+@routes.get('/metrics')
+async def metrics_handler(request: web.Request) -> web.Response:
+    """
+    ---
+    summary: Prometheus metrics
+    tags:
+    - ShareMyCook
+    produces:
+    - text/plain
+    """
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def setup(app: web.Application) -> None:
+    app.router.add_routes(routes)
@@ -0,0 +1,60 @@
+"""
+Least recently used cache of parsed upstream pages, so pages that did not change are not parsed again
+
+Pages are revalidated with a conditional request when upstream sent an ETag or Last-Modified header,
+and otherwise by comparing a hash of the elements that are scraped from them.
+"""
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_SIZE = 32
+
+
+def content_digest(content: bytes) -> bytes:
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+@dataclass
+class CachedPage:
+    digest: bytes
+    value: Any
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Headers that make upstream answer 304 Not Modified if the page did not change
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PageCache:
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE) -> None:
+        """
+        :param max_entries: the least recently used pages are evicted beyond this many
+        """
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[str, CachedPage]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        page = self.entries.get(url)
+        if page is not None:
+            self.entries.move_to_end(url)
+        return page
+
+    def put(self, url: str, page: CachedPage) -> None:
+        self.entries[url] = page
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
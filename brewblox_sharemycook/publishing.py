@@ -0,0 +1,237 @@
+import asyncio
+from collections import deque
+from itertools import groupby
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Mapping, Optional, Tuple
+
+from aiohttp import web
+from brewblox_service import brewblox_logger, mqtt, strex
+
+from brewblox_sharemycook.decoding import dumps, loads
+from brewblox_sharemycook.metrics import BACKLOG_SIZE, DROPPED, PUBLISH_LATENCY
+from brewblox_sharemycook.ring_buffer import RingBuffer
+
+LOGGER = brewblox_logger(__name__)
+
+# Retries start fast, so the first samples are not held back when the broker connection is still being set up
+RETRY_MIN_INTERVAL_S = 0.1
+RETRY_INTERVAL_S = 5
+DEFAULT_REPLAY_RATE = 20
+
+# Topic, message and the time at which the device took the sample
+Message = Tuple[str, Mapping[str, Any], Optional[float]]
+
+
+def encode(message: Message) -> bytes:
+    """
+    A message as a ring buffer record, `[topic, message]` or `[topic, message, timestamp]`
+    """
+    topic, data, timestamp = message
+    return dumps([topic, data] if timestamp is None else [topic, data, timestamp])
+
+
+class Publisher:
+    """
+    Publishes MQTT messages in the background, decoupled from polling
+
+    Messages are buffered up to `buffer_size`, so a short broker outage does not block polling or lose samples.
+    When the buffer overflows the oldest messages are dropped.
+
+    With a `backlog`, messages that could not be published, or that overflow the buffer,
+    are written to the on-disk ring buffer instead of being dropped, so they also survive restarts.
+    The backlog built up during a broker outage is replayed in order, at no more than `replay_rate` messages
+    per second, once the broker is available again.
+    History stamps messages when it receives them, so new messages for a topic that still has messages
+    in the backlog are queued behind them, and the samples of a device are always published in order.
+    Other topics are published right away.
+
+    With an `archive`, every message is also written to that ring buffer, which keeps the most recent messages
+    for exports, whether they were published or not.
+    """
+
+    def __init__(
+        self,
+        app: web.Application,
+        buffer_size: int,
+        backlog: Optional[RingBuffer] = None,
+        replay_rate: float = DEFAULT_REPLAY_RATE,
+        archive: Optional[RingBuffer] = None,
+    ) -> None:
+        self.app = app
+        self.buffer: Deque[Message] = deque(maxlen=buffer_size)
+        self.backlog = backlog
+        self.replay_rate = replay_rate
+        self.archive = archive
+        self.pending = asyncio.Event()
+        self.replay_pending = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        # Records appended to the backlog, and the index of the last record of every topic
+        self.appended = 0
+        self.last_backlogged: Dict[str, int] = {}
+        if backlog is not None:
+            for index, record in enumerate(backlog):
+                self.last_backlogged[loads(record)[0]] = index
+            self.appended = len(backlog)
+            BACKLOG_SIZE.set(len(backlog))
+            if len(backlog):
+                self.replay_pending.set()
+
+    def enqueue(self, topic: str, message: Mapping[str, Any], timestamp: Optional[float] = None) -> None:
+        """
+        :param timestamp: when the device took the sample, kept in the archive and backlog for exports
+        """
+        if self.archive is not None:
+            self.archive.append(encode((topic, message, timestamp)))
+        if len(self.buffer) == self.buffer.maxlen:
+            if self.backlog is not None:
+                self.write_backlog([self.buffer.popleft()])
+            else:
+                self.dropped += 1
+                DROPPED.inc()
+                LOGGER.warning(f'Publish buffer full, dropped the oldest message ({self.dropped} dropped in total)')
+        self.buffer.append((topic, message, timestamp))
+        self.pending.set()
+
+    def write_backlog(self, messages: List[Message]) -> None:
+        """
+        Keep messages in the backlog, to be replayed once the broker is available
+        """
+        for message in messages:
+            evicted = self.backlog.append(encode(message))
+            self.last_backlogged[message[0]] = self.appended
+            self.appended += 1
+            if evicted:
+                self.dropped += evicted
+                DROPPED.inc(evicted)
+                LOGGER.warning(f'Publish backlog full, dropped the {evicted} oldest message(s)')
+        BACKLOG_SIZE.set(len(self.backlog))
+        self.replay_pending.set()
+
+    def held(self, topic: str) -> bool:
+        """
+        Whether older messages for `topic` are still in the backlog, and new messages must be queued behind them
+        """
+        index = self.last_backlogged.get(topic)
+        if index is None:
+            return False
+        # Replayed and evicted records are removed from the front of the backlog
+        if index >= self.appended - len(self.backlog):
+            return True
+        del self.last_backlogged[topic]
+        return False
+
+    async def run(self) -> None:
+        if self.backlog is None:
+            await self.retry(self.pending, self.flush)
+        else:
+            await asyncio.gather(self.retry(self.pending, self.flush), self.retry(self.replay_pending, self.replay))
+
+    @staticmethod
+    async def retry(pending: asyncio.Event, publish: Callable[[], Awaitable[bool]]) -> None:
+        """
+        Call `publish` whenever `pending` is set, and again with a growing interval until it succeeds
+        """
+        retry_interval = RETRY_MIN_INTERVAL_S
+        while True:
+            await pending.wait()
+            pending.clear()
+            if await publish():
+                retry_interval = RETRY_MIN_INTERVAL_S
+            else:
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, RETRY_INTERVAL_S)
+                pending.set()
+
+    async def flush(self) -> bool:
+        """
+        Publish all buffered messages, concurrently across topics and in order within a topic
+
+        Messages that could not be published are returned to the front of the buffer, or written to the backlog.
+        Messages for topics that are held by the backlog are written to the backlog.
+
+        :return: whether all messages were published
+        """
+        batch = list(self.buffer)
+        self.buffer.clear()
+        if self.backlog is not None:
+            held_topics = {topic for topic, _, _ in batch if self.held(topic)}
+            if held_topics:
+                self.write_backlog([message for message in batch if message[0] in held_topics])
+                batch = [message for message in batch if message[0] not in held_topics]
+        by_topic = [list(messages) for _, messages in groupby(sorted(batch, key=lambda m: m[0]), key=lambda m: m[0])]
+        failed = [message
+                  for messages in await asyncio.gather(*(self.publish_in_order(messages) for messages in by_topic))
+                  for message in messages]
+        if not failed:
+            return True
+        if self.backlog is not None:
+            self.write_backlog(failed)
+            return False
+
+        retained = failed + list(self.buffer)
+        overflow = len(retained) - self.buffer.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+            DROPPED.inc(overflow)
+            LOGGER.warning(f'Publish buffer full, dropped the {overflow} oldest message(s)')
+        self.buffer = deque(retained, maxlen=self.buffer.maxlen)
+        return False
+
+    async def publish_in_order(self, messages: List[Message]) -> List[Message]:
+        """
+        :return: the messages that were not published
+        """
+        for index, (topic, message, _) in enumerate(messages):
+            try:
+                with PUBLISH_LATENCY.time():
+                    await mqtt.publish(self.app, topic, message)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                retained = messages[index:]
+                LOGGER.warning(f'Unable to publish to {topic}, {len(retained)} message(s) retained: {strex(ex)}')
+                return retained
+        return []
+
+    async def replay(self) -> bool:
+        """
+        Publish the backlog in order, at most `replay_rate` messages per second,
+        without holding back new messages for other topics
+
+        A message is only removed from the backlog once it was published.
+
+        :return: whether the backlog was emptied
+        """
+        while len(self.backlog):
+            topic, message, *_ = loads(self.backlog.peek())
+            try:
+                with PUBLISH_LATENCY.time():
+                    await mqtt.publish(self.app, topic, message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOGGER.warning(f'Unable to publish to {topic}, '
+                               f'{len(self.backlog)} message(s) retained in the backlog: {strex(ex)}')
+                return False
+            self.backlog.pop()
+            self.sent += 1
+            BACKLOG_SIZE.set(len(self.backlog))
+            if len(self.backlog):
+                await asyncio.sleep(1 / self.replay_rate)
+        return True
+
+    def close(self) -> None:
+        """
+        Write the messages that were not published yet to the backlog, so they are published after a restart
+        """
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.backlog is None:
+            return
+        if self.buffer:
+            self.write_backlog(list(self.buffer))
+            self.buffer.clear()
+        self.backlog.close()
+        self.backlog = None
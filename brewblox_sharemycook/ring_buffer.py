@@ -0,0 +1,173 @@
+"""
+Bounded, append-only ring buffer of records in a memory-mapped file
+
+The file has a fixed size, so memory and disk use stay fixed no matter how long the backlog grows:
+when a new record does not fit, the oldest records are evicted.
+Records survive a restart of the service, but are not synced to disk on every write.
+"""
+import mmap
+import os
+import struct
+from typing import Iterator, Optional, Tuple
+
+from brewblox_service import brewblox_logger
+
+LOGGER = brewblox_logger(__name__)
+
+MAGIC = b'SMCRING1'
+# Magic, head offset, tail offset, record count
+HEADER = struct.Struct('<8sQQQ')
+LENGTH = struct.Struct('<I')
+# Marks that the next record starts at the beginning of the data area
+WRAP = 0xFFFFFFFF
+
+
+class RingBuffer:
+
+    def __init__(self, path: str, size: int, readonly: bool = False) -> None:
+        """
+        :param path: file backing the buffer, created when it does not exist
+        :param size: size of the file in bytes, including a small header
+        :param readonly: only read the records of an existing buffer, which may be in use by another process
+        """
+        if size <= HEADER.size + LENGTH.size:
+            raise ValueError(f'Ring buffer size must be larger than {HEADER.size + LENGTH.size} bytes')
+        self.path = path
+        self.size = size - HEADER.size
+        self.head = 0
+        self.tail = 0
+        self.count = 0
+        self.readonly = readonly
+
+        if readonly:
+            self.file = open(path, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.mm) != size or not self.load():
+                self.close()
+                raise ValueError(f'{path} is not a ring buffer of {size} bytes')
+            return
+
+        exists = os.path.exists(path)
+        resized = exists and os.path.getsize(path) != size
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists or resized:
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+        if exists and not resized and self.load():
+            LOGGER.info(f'Restored {self.count} record(s) from {path}')
+        else:
+            if exists:
+                LOGGER.warning(f'Discarded the unreadable or resized ring buffer {path}')
+            self.save()
+
+    def load(self) -> bool:
+        """
+        :return: whether a valid header was read
+        """
+        magic, head, tail, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or head > self.size or tail > self.size:
+            return False
+        self.head, self.tail, self.count = head, tail, count
+        return True
+
+    def save(self) -> None:
+        HEADER.pack_into(self.mm, 0, MAGIC, self.head, self.tail, self.count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[bytes]:
+        pos = self.head
+        for _ in range(self.count):
+            pos, length = self.locate(pos)
+            yield self.read(pos, length)
+            pos += LENGTH.size + length
+
+    def locate(self, pos: int) -> Tuple[int, int]:
+        """
+        :return: the offset and length of the record at or wrapped around from `pos`
+        """
+        if self.size - pos < LENGTH.size:
+            pos = 0
+        length, = LENGTH.unpack_from(self.mm, HEADER.size + pos)
+        if length == WRAP:
+            pos = 0
+            length, = LENGTH.unpack_from(self.mm, HEADER.size)
+        return pos, length
+
+    def read(self, pos: int, length: int) -> bytes:
+        start = HEADER.size + pos + LENGTH.size
+        return self.mm[start:start + length]
+
+    def write(self, pos: int, record: bytes) -> None:
+        start = HEADER.size + pos
+        LENGTH.pack_into(self.mm, start, len(record))
+        self.mm[start + LENGTH.size:start + LENGTH.size + len(record)] = record
+        self.tail = pos + LENGTH.size + len(record)
+        self.count += 1
+
+    def append(self, record: bytes) -> int:
+        """
+        Append a record, evicting the oldest records when it does not fit
+
+        :return: the number of evicted records
+        """
+        needed = LENGTH.size + len(record)
+        if needed > self.size:
+            raise ValueError(f'Record of {len(record)} bytes does not fit in the ring buffer')
+
+        evicted = 0
+        while True:
+            if self.count == 0:
+                self.head = self.tail = 0
+            if self.count == 0 or self.tail > self.head:
+                # Free space at the end, and before the head at the start
+                if self.size - self.tail >= needed:
+                    self.write(self.tail, record)
+                    break
+                if self.head >= needed:
+                    if self.size - self.tail >= LENGTH.size:
+                        LENGTH.pack_into(self.mm, HEADER.size + self.tail, WRAP)
+                    self.write(0, record)
+                    break
+            elif self.head - self.tail >= needed:
+                # Free space between the tail and the head
+                self.write(self.tail, record)
+                break
+            self.discard()
+            evicted += 1
+
+        self.save()
+        return evicted
+
+    def peek(self) -> Optional[bytes]:
+        """
+        :return: the oldest record, without removing it
+        """
+        if self.count == 0:
+            return None
+        return self.read(*self.locate(self.head))
+
+    def pop(self) -> Optional[bytes]:
+        """
+        Remove and return the oldest record
+        """
+        record = self.peek()
+        if record is not None:
+            self.discard()
+            self.save()
+        return record
+
+    def discard(self) -> None:
+        pos, length = self.locate(self.head)
+        self.head = pos + LENGTH.size + length
+        self.count -= 1
+        if self.count == 0:
+            self.head = self.tail = 0
+
+    def close(self) -> None:
+        if not self.readonly:
+            self.mm.flush()
+        self.mm.close()
+        self.file.close()
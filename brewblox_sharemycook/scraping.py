@@ -1,22 +1,103 @@
+"""
+Scrapers for the ShareMyCook HTML pages
+
+BeautifulSoup and its parser backends are only imported when the first page is parsed,
+so they do not slow down the startup of the service.
+"""
+import re
 import uuid
-from typing import Set
+from importlib.util import find_spec
+from typing import TYPE_CHECKING, Optional, Pattern, Set
 
 from brewblox_service import repeater
-from bs4 import BeautifulSoup
+
+if TYPE_CHECKING:  # pragma: no cover
+    from bs4 import BeautifulSoup, SoupStrainer
+
+PARSER = 'lxml' if find_spec('lxml') else 'html.parser'
+
+
+class Strainer:
+    """
+    Arguments for a bs4 SoupStrainer, which is built on first use
+
+    :param start_tag: regex matching the start tags of the same elements, to select them without parsing
+    """
+
+    def __init__(self, name: str, start_tag: str, **kwargs) -> None:
+        self.name = name
+        self.start_tag = re.compile(start_tag, re.IGNORECASE)
+        self.kwargs = kwargs
+        self.strainer: Optional['SoupStrainer'] = None
+
+    def build(self) -> 'SoupStrainer':
+        if self.strainer is None:
+            from bs4 import SoupStrainer
+            self.strainer = SoupStrainer(self.name, **self.kwargs)
+        return self.strainer
+
+
+# Only the subtrees the scrapers below look at are parsed into the tree
+LOGIN_FORM = Strainer('form', r'<form\b[^>]*\saction=["\']?/Login["\'\s>]', action='/Login')
+DEVICE_INFO_LISTS = Strainer(
+    'ul', r'<ul\b[^>]*\sclass=["\'][^"\']*\bdevice-info-list\b',
+    attrs={'class': re.compile(r'(^|\s)device-info-list(\s|$)')})
+TEMPERATURE_UNITS = Strainer('input', r'<input\b[^>]*\sid=["\']?TemperatureUnit["\'\s/>]', id='TemperatureUnit')
+
+
+VOID_ELEMENTS = {'input'}
+COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+
+
+def bs_ify(content: str, parse_only: Optional[Strainer] = None, features: str = PARSER) -> 'BeautifulSoup':
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, features=features, parse_only=parse_only and parse_only.build())
+
+
+def extract_elements(content: str, tag: str, select: Optional[Pattern] = None) -> Optional[str]:
+    """
+    Cut every `tag` element out of a page with a regex, so only those fragments need parsing
+
+    :param select: only keep the elements whose start tag matches
+    :return: the concatenated elements, or None when that can not be done reliably (unclosed or nested elements)
+    """
+    content = COMMENT.sub('', content)
+    if tag in VOID_ELEMENTS:
+        element = re.compile(rf'<{tag}\b[^>]*>', re.IGNORECASE)
+    else:
+        element = re.compile(rf'<{tag}\b.*?</{tag}\s*>', re.IGNORECASE | re.DOTALL)
+    fragments = element.findall(content)
+    if not fragments or len(fragments) != len(re.findall(rf'<{tag}\b', content, re.IGNORECASE)):
+        return None
+    if select is not None:
+        fragments = [fragment for fragment in fragments if select.match(fragment)]
+    return ''.join(fragments)
+
+
+def strain_elements(content: str, parse_only: Strainer) -> str:
+    """
+    The elements matched by `parse_only`, or the whole page when they can not be cut out reliably
+    """
+    fragments = extract_elements(content, parse_only.name, parse_only.start_tag)
+    return content if fragments is None else fragments
 
 
-def bs_ify(content: str) -> BeautifulSoup:
-    return BeautifulSoup(content, features='html.parser')
+def bs_ify_elements(content: str, tag: str, parse_only: Strainer, features: str = PARSER) -> 'BeautifulSoup':
+    """
+    Parse only the `tag` elements matched by `parse_only`, falling back to a strained parse of the whole page
+    """
+    fragments = extract_elements(content, tag, parse_only.start_tag)
+    return bs_ify(content if fragments is None else fragments, parse_only, features)
 
 
-def get_login_form(soup: BeautifulSoup) -> BeautifulSoup:
+def get_login_form(soup: 'BeautifulSoup') -> 'BeautifulSoup':
     for form in soup.find_all('form'):
         if form.get('action') == '/Login':
             return form
     raise repeater.RepeaterCancelled('Unable to discover login form')
 
 
-def get_csrf_token(soup: BeautifulSoup) -> str:
+def get_csrf_token(soup: 'BeautifulSoup') -> str:
     login_form = get_login_form(soup)
     for _input in login_form.find_all('input'):
         if _input.get('name') == '__RequestVerificationToken':
@@ -24,7 +105,7 @@ def get_csrf_token(soup: BeautifulSoup) -> str:
     raise repeater.RepeaterCancelled('Unable to discover CSRF token')
 
 
-def glean_device_ids(soup: BeautifulSoup) -> Set[uuid.UUID]:
+def glean_device_ids(soup: 'BeautifulSoup') -> Set[uuid.UUID]:
     device_ids = set()
     for ul in soup.find_all('ul', {'class': 'device-info-list'}):
         for a in ul.find_all('a'):
@@ -38,7 +119,7 @@ def glean_device_ids(soup: BeautifulSoup) -> Set[uuid.UUID]:
     return device_ids
 
 
-def glean_temperature_units(soup: BeautifulSoup) -> str:
+def glean_temperature_units(soup: 'BeautifulSoup') -> str:
     _input = soup.find(id='TemperatureUnit', checked='checked')
     if _input:
         return _input.get('value')
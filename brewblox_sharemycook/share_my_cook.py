@@ -1,86 +1,386 @@
+import asyncio
+import os
+import time
 import uuid
-from typing import Set, Sequence
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, Mapping, Optional, Set, Sequence, Tuple, TypeVar
+from urllib.parse import urlsplit
 
-from aiohttp import ClientResponse
+from aiohttp import ClientResponse, ClientTimeout, TCPConnector
 from aiohttp.client import ClientSession
-from brewblox_service import brewblox_logger, repeater
-from cached_property import cached_property
+from brewblox_service import brewblox_logger, repeater, strex
 
-from brewblox_sharemycook.controllers import controller_types, Controller, TemperatureUnits
-from brewblox_sharemycook.scraping import glean_device_ids, get_csrf_token, bs_ify, glean_temperature_units
+from brewblox_sharemycook.circuit_breaker import BreakerSettings, CircuitBreaker, CircuitOpenError
+from brewblox_sharemycook.controllers import decode_controller, scale_converted, Controller, TemperatureUnits
+from brewblox_sharemycook.metrics import PAGE_CACHE_HITS, PARSE_TIME, RELOGINS, UPSTREAM_LATENCY
+from brewblox_sharemycook.page_cache import content_digest, CachedPage, PageCache, DEFAULT_CACHE_SIZE
+from brewblox_sharemycook.scraping import glean_device_ids, get_csrf_token, bs_ify, bs_ify_elements, strain_elements
+from brewblox_sharemycook.scraping import glean_temperature_units, Strainer
+from brewblox_sharemycook.scraping import DEVICE_INFO_LISTS, LOGIN_FORM, TEMPERATURE_UNITS
 
 LOGGER = brewblox_logger(__name__)
 
 SHARE_MY_COOK = 'https://sharemycook.com'
+DEFAULT_CONCURRENCY = 4
+DEFAULT_UNITS_TTL = 600
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+DEFAULT_DNS_TTL = 300
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+
+T = TypeVar('T')
 
 
 def authenticate(func):
     async def wrapper(self, *args, **kwargs):
+        login_generation = self.login_generation
         response = await func(self, *args, **kwargs)
         # If you are not logged in, there will be a redirect to the login page, check for it, login, retry
         if response.history:
             if response.history[0].status == 302:
                 if response.history[0].headers.get('Location').startswith('/Login'):
-                    await self.login()
+                    RELOGINS.inc()
+                    response.release()
+                    await self.relogin(login_generation)
                     response = await func(self, *args, **kwargs)
 
+        self.last_authenticated = time.monotonic()
         return response
 
     return wrapper
 
 
+def create_connector(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+    dns_ttl: float = DEFAULT_DNS_TTL,
+) -> TCPConnector:
+    """
+    Connection pool for sharemycook.com, keeping connections and DNS lookups around between polls
+
+    :param pool_size: the maximum number of simultaneous connections
+    :param keepalive_timeout: seconds an idle connection is kept open for reuse
+    :param dns_ttl: seconds a DNS lookup is cached
+    """
+    return TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        keepalive_timeout=keepalive_timeout,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_ttl,
+    )
+
+
+def create_session(
+    connector: TCPConnector,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+) -> ClientSession:
+    """
+    Client session with its own cookie jar on top of a shared connection pool
+
+    :param connect_timeout: seconds to wait for a connection, including the TLS handshake
+    :param read_timeout: seconds to wait for data from an open connection
+    """
+    return ClientSession(
+        connector=connector,
+        connector_owner=False,
+        raise_for_status=True,
+        timeout=ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout),
+    )
+
+
+def parse_device_ids(elements: str) -> FrozenSet[uuid.UUID]:
+    return frozenset(glean_device_ids(bs_ify(elements, DEVICE_INFO_LISTS)))
+
+
+def parse_temperature_units(elements: str) -> TemperatureUnits:
+    return TemperatureUnits(glean_temperature_units(bs_ify(elements, TEMPERATURE_UNITS)).upper())
+
+
+@dataclass
+class PollResult:
+    device_id: uuid.UUID
+    duration: float
+    controller: Optional[Controller] = None
+    error: Optional[Exception] = None
+
+
 class ShareMyCook:
 
-    def __init__(self, session: ClientSession, username: str, password: str) -> None:
+    def __init__(
+        self,
+        session: ClientSession,
+        username: str,
+        password: str,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        cookie_file: Optional[str] = None,
+        base_url: str = SHARE_MY_COOK,
+        breaker_settings: BreakerSettings = BreakerSettings(),
+        units_ttl: float = DEFAULT_UNITS_TTL,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        account_index: int = 0,
+    ) -> None:
         self.session = session
+        self.base_url = base_url
         self.username = username
         self.password = password
+        self.account_index = account_index
+        self.cookie_file = cookie_file
+        self.last_authenticated: Optional[float] = None
+        self.login_lock = asyncio.Lock()
+        self.login_generation = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.device_ids: Set[uuid.UUID] = set()
+        self.discovered = asyncio.Event()
+        # Backs off from sharemycook.com as a whole, consecutive failures of any request trip it.
+        # Named after the position of the account, so usernames are not exposed in metrics.
+        self.breaker_settings = breaker_settings
+        self.breaker = CircuitBreaker(f'account/{account_index}', breaker_settings)
+        # Backs off from single devices that keep failing while others are fine
+        self.device_breakers: Dict[uuid.UUID, CircuitBreaker] = {}
+        self.units: Optional[TemperatureUnits] = None
+        self.units_ttl = units_ttl
+        self.units_checked: Optional[float] = None
+        self.units_task: Optional[asyncio.Task] = None
+        # Per device: the units and target temperatures of the previous sample
+        self.last_targets: Dict[uuid.UUID, Tuple[TemperatureUnits, Tuple[float, ...]]] = {}
+        self.page_cache = PageCache(cache_size)
+
+    async def poll(self, device_ids: Optional[Iterable[uuid.UUID]] = None) -> Sequence[PollResult]:
+        """
+        Poll devices concurrently, at most `concurrency` requests are in flight at any time
+
+        :param device_ids: the devices to poll, all discovered devices if omitted
+        """
+        device_ids = list(self.device_ids if device_ids is None else device_ids)
+        return await asyncio.gather(*(self.timed_poll_device(device_id) for device_id in device_ids))
 
-    async def poll(self) -> Sequence[Controller]:
-        results = []
-        for device_id in await self.device_ids:
-            results.append(await self.poll_device(device_id))
-        return results
+    async def timed_poll_device(self, device_id: uuid.UUID) -> PollResult:
+        """
+        Poll a single device, errors are captured in the result so they do not abort the rest of the batch
+        """
+        breaker = self.device_breakers.get(device_id)
+        if breaker is None:
+            breaker = self.device_breakers[device_id] = CircuitBreaker(f'device/{device_id}', self.breaker_settings)
 
-    @cached_property
-    async def device_ids(self) -> Set[uuid.UUID]:
-        devices_page = await self.get(f'{SHARE_MY_COOK}/account/customerdevice')
-        device_ids = glean_device_ids(bs_ify(await devices_page.text()))
+        async with self.semaphore:
+            start = time.monotonic()
+            try:
+                with breaker.protect():
+                    controller = await self.poll_device(device_id)
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpenError as ex:
+                LOGGER.debug(f'Skipped polling device {device_id}: {strex(ex)}')
+                return PollResult(device_id=device_id, duration=time.monotonic() - start, error=ex)
+            except Exception as ex:
+                LOGGER.warning(f'Unable to poll device {device_id}: {strex(ex)}')
+                return PollResult(device_id=device_id, duration=time.monotonic() - start, error=ex)
+            return PollResult(device_id=device_id, duration=time.monotonic() - start, controller=controller)
+
+    async def discover(self) -> Tuple[Set[uuid.UUID], Set[uuid.UUID]]:
+        """
+        Refresh the known device ids from the account devices page
+
+        :return: the device ids that were added and retired since the previous discovery
+        """
+        device_ids = await self.get_page(f'{self.base_url}/account/customerdevice', 'customerdevice',
+                                         DEVICE_INFO_LISTS, parse_device_ids)
         LOGGER.debug(f'Discovered {len(device_ids)} device(s): {", ".join(sorted(str(u) for u in device_ids))}')
-        return device_ids
+
+        added = device_ids - self.device_ids
+        retired = self.device_ids - device_ids
+        for device_id in sorted(added):
+            LOGGER.info(f'Added device {device_id}')
+        for device_id in sorted(retired):
+            LOGGER.info(f'Retired device {device_id}')
+            if device_id in self.device_breakers:
+                self.device_breakers.pop(device_id).remove()
+            self.last_targets.pop(device_id, None)
+
+        self.device_ids = set(device_ids)
+        self.discovered.set()
+        return added, retired
 
     @authenticate
-    async def get(self, url: str) -> ClientResponse:
+    async def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> ClientResponse:
         LOGGER.debug(f'GET {url}')
-        return await self.session.get(url)
+        with self.breaker.protect(), UPSTREAM_LATENCY.labels(method='GET', path=urlsplit(url).path).time():
+            return await self.session.get(url, headers=headers)
+
+    async def get_page(self, url: str, page: str, parse_only: Strainer, parse: Callable[[str], T]) -> T:
+        """
+        Get and parse a page, reusing the previous result when the page did not change since it was last parsed
+
+        Only the elements matched by `parse_only` are compared, so tokens elsewhere on the page
+        that change with every request do not force it to be parsed again.
+
+        :param page: name of the page in metrics
+        :param parse_only: the elements of the page that `parse` reads
+        :param parse: turns those elements into the result, which is cached and must not be modified
+        """
+        cached = self.page_cache.get(url)
+        async with await self.get(url, cached and cached.validators()) as response:
+            if cached is not None and response.status == 304:
+                PAGE_CACHE_HITS.labels(page=page).inc()
+                return cached.value
+            content = await response.read()
+            encoding = response.get_encoding()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        elements = strain_elements(content.decode(encoding), parse_only)
+        digest = content_digest(elements.encode())
+        if cached is not None and cached.digest == digest:
+            PAGE_CACHE_HITS.labels(page=page).inc()
+            value = cached.value
+        else:
+            with PARSE_TIME.labels(page=page).time():
+                value = parse(elements)
+        self.page_cache.put(url, CachedPage(digest, value, etag, last_modified))
+        return value
 
     async def poll_device(self, device_id: uuid.UUID) -> Controller:
-        response = await self.get(f'{SHARE_MY_COOK}/account/customerdevice/temperatures_read?id={device_id}')
-        json = await response.json()
-        return controller_types[json['bbqGuruDeviceModel']].from_json(
-            device_id, await self.temperature_units, await response.json()
-        )
+        if self.units is None:
+            # Look up the units alongside the first poll
+            self.refresh_units()
+        url = f'{self.base_url}/account/customerdevice/temperatures_read?id={device_id}'
+        async with await self.get(url) as response:
+            content = await response.read()
+        units = await self.temperature_units()
+        with PARSE_TIME.labels(page='temperatures_read').time():
+            controller = decode_controller(device_id, units, content)
+
+        targets = controller.targets()
+        last_units, last_targets = self.last_targets.get(device_id, (None, ()))
+        if last_units == units and scale_converted(last_targets, targets):
+            LOGGER.info(f'Temperatures of {controller.name} were converted to another scale, '
+                        'refreshing temperature units')
+            controller.units = await self.refresh_units()
+        self.last_targets[device_id] = (controller.units, targets)
+        return controller
 
-    @cached_property
     async def temperature_units(self) -> TemperatureUnits:
-        profile_page = await self.get(f'{SHARE_MY_COOK}/Account/Profile')
-        raw_units = glean_temperature_units(bs_ify(await profile_page.text()))
-        units = TemperatureUnits(raw_units.upper())
-        LOGGER.info(f'Temperature units are in {units.value}')
+        """
+        The temperature units of the account, revalidated in the background once they are older than `units_ttl`
+
+        Only the very first lookup is waited for.
+        """
+        if self.units is None:
+            return await self.refresh_units()
+        if time.monotonic() - self.units_checked >= self.units_ttl:
+            self.refresh_units()
+        return self.units
+
+    def refresh_units(self) -> 'asyncio.Task[TemperatureUnits]':
+        """
+        Start looking up the temperature units, unless a lookup is already running
+        """
+        if self.units_task is None or self.units_task.done():
+            self.units_task = asyncio.create_task(self.fetch_temperature_units())
+            self.units_task.add_done_callback(self.units_fetched)
+        return self.units_task
+
+    def units_fetched(self, task: asyncio.Task) -> None:
+        # Only the first lookup has callers waiting for its result, later failures are logged here
+        if not task.cancelled() and task.exception() is not None and self.units is not None:
+            LOGGER.warning(f'Unable to refresh temperature units: {strex(task.exception())}')
+
+    async def fetch_temperature_units(self) -> TemperatureUnits:
+        try:
+            units = await self.get_page(f'{self.base_url}/Account/Profile', 'profile',
+                                        TEMPERATURE_UNITS, parse_temperature_units)
+        finally:
+            # Failed lookups are retried once the TTL passed again
+            self.units_checked = time.monotonic()
+        if self.units is None:
+            LOGGER.info(f'Temperature units are in {units.value}')
+        elif self.units != units:
+            LOGGER.info(f'Temperature units changed from {self.units.value} to {units.value}')
+        self.units = units
         return units
 
+    def load_cookies(self) -> None:
+        """
+        Restore the session cookies saved by a previous run, saving a login round trip on startup
+        """
+        if not self.cookie_file or not os.path.exists(self.cookie_file):
+            return
+        try:
+            self.session.cookie_jar.load(self.cookie_file)
+            LOGGER.info(f'Restored session cookies from {self.cookie_file}')
+        except Exception as ex:
+            LOGGER.warning(f'Unable to restore session cookies from {self.cookie_file}: {strex(ex)}')
+
+    def save_cookies(self) -> None:
+        if not self.cookie_file:
+            return
+        try:
+            self.session.cookie_jar.save(self.cookie_file)
+            LOGGER.debug(f'Saved session cookies to {self.cookie_file}')
+        except Exception as ex:
+            LOGGER.warning(f'Unable to save session cookies to {self.cookie_file}: {strex(ex)}')
+
+    async def start(self) -> None:
+        """
+        Login right away if no session cookies were restored, instead of after the first request was redirected
+        """
+        if not len(self.session.cookie_jar):
+            await self.relogin(self.login_generation)
+
+    async def keep_alive(self, max_idle: float) -> bool:
+        """
+        Renew the session when it has not been used for `max_idle` seconds, logging in again if it already expired
+
+        :return: whether the session was renewed
+        """
+        if self.last_authenticated is not None and time.monotonic() - self.last_authenticated < max_idle:
+            return False
+        LOGGER.debug(f'Renewing session for {self.username}')
+        # The profile page holds the temperature units, so renewing the session revalidates them as well
+        await self.refresh_units()
+        return True
+
+    async def close(self) -> None:
+        if self.units_task is not None:
+            self.units_task.cancel()
+        await self.session.close()
+
+    async def relogin(self, login_generation: int) -> None:
+        """
+        Login again after a request found the session expired
+
+        Concurrent callers are coalesced into a single login: callers whose request was sent before
+        a login that has since completed simply retry with the new session.
+
+        :param login_generation: the login generation at the time the expired request was sent
+        """
+        async with self.login_lock:
+            if login_generation == self.login_generation:
+                await self.login()
+
     async def login(self) -> None:
-        login_page = await self.session.get(SHARE_MY_COOK)
-        login_response = await self.session.post(
-            f'{SHARE_MY_COOK}/Login',
-            data={
-                'Username': self.username,
-                'Password': self.password,
-                '__RequestVerificationToken': get_csrf_token(bs_ify(await login_page.text())),
-            }
-        )
+        with self.breaker.protect(), UPSTREAM_LATENCY.labels(method='GET', path='/').time():
+            async with await self.session.get(self.base_url) as login_page:
+                content = await login_page.text()
+        with PARSE_TIME.labels(page='login').time():
+            csrf_token = get_csrf_token(bs_ify_elements(content, 'form', LOGIN_FORM))
+        with self.breaker.protect(), UPSTREAM_LATENCY.labels(method='POST', path='/Login').time():
+            async with await self.session.post(
+                f'{self.base_url}/Login',
+                data={
+                    'Username': self.username,
+                    'Password': self.password,
+                    '__RequestVerificationToken': csrf_token,
+                }
+            ) as login_response:
+                await login_response.read()
         if login_response.history and login_response.history[0].status == 302:
-            LOGGER.info(f'Successfully logged in {self.username} to {SHARE_MY_COOK}')
+            LOGGER.info(f'Successfully logged in {self.username} to {self.base_url}')
+            self.login_generation += 1
+            self.save_cookies()
             return
         LOGGER.error(f'Unable to login with {self.username}/{"*" * len(self.password)}')
         raise repeater.RepeaterCancelled()
@@ -29,6 +29,31 @@ def app_config() -> dict:
         'debug': False,
         'active_poll_interval': 0.01,
         'inactive_poll_interval': 0.05,
+        'poll_concurrency': 4,
+        'discovery_interval': 0.05,
+        'session_keepalive': 0.05,
+        'cookie_file': '',
+        'publish_heartbeat': 0.05,
+        'deadband': 0,
+        'aggregate_window': 0,
+        'analytics_smoothing': 0,
+        'publish_buffer': 100,
+        'share_my_cook_url': 'https://sharemycook.com',
+        'accounts_file': '',
+        'http_pool_size': 10,
+        'http_keepalive': 60,
+        'http_dns_ttl': 300,
+        'http_connect_timeout': 1,
+        'http_read_timeout': 1,
+        'units_ttl': 600,
+        'breaker_threshold': 5,
+        'backlog_file': '',
+        'backlog_size': 4096,
+        'backlog_replay_rate': 1000,
+        'archive_file': '',
+        'archive_size': 4096,
+        'breaker_min_backoff': 0.05,
+        'breaker_max_backoff': 1,
         'history_topic': 'brewcast/history',
         'username': 'my_username',
         'password': 'my_password',
@@ -44,6 +69,31 @@ def sys_args(app_config) -> list:
         '--port', app_config['port'],
         '--active-poll-interval', app_config['active_poll_interval'],
         '--inactive-poll-interval', app_config['inactive_poll_interval'],
+        '--poll-concurrency', app_config['poll_concurrency'],
+        '--discovery-interval', app_config['discovery_interval'],
+        '--session-keepalive', app_config['session_keepalive'],
+        '--cookie-file', app_config['cookie_file'],
+        '--publish-heartbeat', app_config['publish_heartbeat'],
+        '--deadband', app_config['deadband'],
+        '--aggregate-window', app_config['aggregate_window'],
+        '--analytics-smoothing', app_config['analytics_smoothing'],
+        '--publish-buffer', app_config['publish_buffer'],
+        '--share-my-cook-url', app_config['share_my_cook_url'],
+        '--accounts-file', app_config['accounts_file'],
+        '--http-pool-size', app_config['http_pool_size'],
+        '--http-keepalive', app_config['http_keepalive'],
+        '--http-dns-ttl', app_config['http_dns_ttl'],
+        '--http-connect-timeout', app_config['http_connect_timeout'],
+        '--http-read-timeout', app_config['http_read_timeout'],
+        '--units-ttl', app_config['units_ttl'],
+        '--breaker-threshold', app_config['breaker_threshold'],
+        '--backlog-file', app_config['backlog_file'],
+        '--backlog-size', app_config['backlog_size'],
+        '--backlog-replay-rate', app_config['backlog_replay_rate'],
+        '--archive-file', app_config['archive_file'],
+        '--archive-size', app_config['archive_size'],
+        '--breaker-min-backoff', app_config['breaker_min_backoff'],
+        '--breaker-max-backoff', app_config['breaker_max_backoff'],
         '--history-topic', app_config['history_topic'],
         '--username', app_config['username'],
         '--password', app_config['password'],
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from brewblox_sharemycook.accounts import Account, account_cookie_file, load_accounts
+
+
+@pytest.fixture
+def config():
+    return {
+        'username': 'my_username',
+        'password': 'my_password',
+        'cookie_file': 'cookies.pickle',
+        'accounts_file': '',
+    }
+
+
+def write_accounts(tmp_path, config, accounts):
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps(accounts))
+    config['accounts_file'] = str(path)
+
+
+def test_single_account(config, monkeypatch):
+    assert load_accounts(config) == [Account('my_username', 'my_password', 'cookies-my_username.pickle')]
+
+    # A different account does not resume the session of the previous one
+    config['username'] = 'other_username'
+    assert load_accounts(config)[0].cookie_file == 'cookies-other_username.pickle'
+
+    monkeypatch.setenv('USERNAME', 'env_username')
+    monkeypatch.setenv('PASSWORD', 'env_password')
+    config.update(username=None, password=None, cookie_file='')
+    assert load_accounts(config) == [Account('env_username', 'env_password', None)]
+
+
+def test_accounts_file(config, tmp_path):
+    write_accounts(tmp_path, config, [
+        {'username': 'alice', 'password': 'secret'},
+        {'username': 'bob', 'password': 'hunter2', 'cookie_file': 'bob.pickle'},
+    ])
+    assert load_accounts(config) == [
+        Account('alice', 'secret', 'cookies-alice.pickle'),
+        Account('bob', 'hunter2', 'bob.pickle'),
+    ]
+
+    config['cookie_file'] = ''
+    assert load_accounts(config)[0].cookie_file is None
+
+
+def test_account_cookie_file():
+    assert account_cookie_file('', 'alice') is None
+    assert account_cookie_file('data/cookies.pickle', 'alice') == 'data/cookies-alice.pickle'
+    assert account_cookie_file('cookies', 'alice') == 'cookies-alice'
+
+
+@pytest.mark.parametrize('accounts', [
+    [],
+    {'username': 'alice', 'password': 'secret'},
+    [{'username': 'alice'}],
+    ['alice'],
+    [{'username': 'alice', 'password': 'secret'}, {'username': 'alice', 'password': 'other'}],
+])
+def test_invalid_accounts_file(config, tmp_path, accounts):
+    write_accounts(tmp_path, config, accounts)
+    with pytest.raises(ValueError):
+        load_accounts(config)
@@ -0,0 +1,124 @@
+import uuid
+
+import pytest
+
+from brewblox_sharemycook.aggregation import Aggregator
+
+
+@pytest.fixture
+def device_id():
+    return uuid.uuid4()
+
+
+def sample(pit, food=60, fan=50, target=107):
+    return {
+        'MyDeviceName': {
+            'Active': 1,
+            'Fan_Duty[%]': fan,
+            'Targets': {'pit[DegC]': target},
+            'Values': {'pit[DegC]': pit, 'food1[DegC]': food},
+        }
+    }
+
+
+OFFLINE = {'MyDeviceName': {'Active': 0}}
+
+
+def test_disabled(device_id):
+    aggregator = Aggregator(deadband=0, window=0)
+    assert not aggregator.enabled
+    assert aggregator.add(device_id, sample(100), now=0) == [sample(100)]
+    assert aggregator.add(device_id, sample(100), now=1) == [sample(100)]
+
+
+def test_deadband(device_id):
+    aggregator = Aggregator(deadband=1, window=0)
+    assert aggregator.enabled
+
+    # The first sample is published complete
+    assert aggregator.add(device_id, sample(100), now=0) == [sample(100)]
+    # Nothing changed enough
+    assert aggregator.add(device_id, sample(100.5, food=60.9), now=1) == []
+    # Measured against the last published value, not the last sample
+    assert aggregator.add(device_id, sample(101, food=60.9), now=2) == [
+        {'MyDeviceName': {'Values': {'pit[DegC]': 101}}}
+    ]
+    assert aggregator.add(device_id, sample(100.5, food=59), now=3) == [
+        {'MyDeviceName': {'Values': {'food1[DegC]': 59}}}
+    ]
+    # Other fields are published on any change
+    assert aggregator.add(device_id, sample(100.5, food=59, fan=51, target=108), now=4) == [
+        {'MyDeviceName': {'Fan_Duty[%]': 51, 'Targets': {'pit[DegC]': 108}}}
+    ]
+    assert aggregator.add(device_id, OFFLINE, now=5) == [{'MyDeviceName': {'Active': 0}}]
+
+
+def test_deadband_heartbeat(device_id):
+    aggregator = Aggregator(deadband=1, window=0, heartbeat=10)
+    assert aggregator.add(device_id, sample(100), now=0) == [sample(100)]
+    assert aggregator.add(device_id, sample(100), now=9) == []
+    assert aggregator.add(device_id, sample(100), now=10) == [sample(100)]
+
+
+def test_window(device_id):
+    aggregator = Aggregator(deadband=0, window=10)
+
+    assert aggregator.add(device_id, sample(100, food=60), now=0) == []
+    assert aggregator.add(device_id, sample(104, food=62), now=5) == []
+    assert aggregator.add(device_id, sample(102, fan=70), now=10) == [{
+        'MyDeviceName': {
+            'Active': 1,
+            'Fan_Duty[%]': 70,
+            'Targets': {'pit[DegC]': 107},
+            'Values': {'pit[DegC]': 102, 'food1[DegC]': pytest.approx(60.667, abs=0.001)},
+            'Min': {'pit[DegC]': 100, 'food1[DegC]': 60},
+            'Max': {'pit[DegC]': 104, 'food1[DegC]': 62},
+        }
+    }]
+    # A new window starts with the next sample
+    assert aggregator.add(device_id, sample(90), now=12) == []
+    assert device_id in aggregator.windows
+
+
+def test_window_offline(device_id):
+    aggregator = Aggregator(deadband=0, window=10)
+
+    assert aggregator.add(device_id, OFFLINE, now=0) == [OFFLINE]
+    assert aggregator.add(device_id, sample(100), now=1) == []
+
+    # Going offline publishes the unfinished window right away
+    [window, offline] = aggregator.add(device_id, OFFLINE, now=2)
+    assert window['MyDeviceName']['Min'] == {'pit[DegC]': 100, 'food1[DegC]': 60}
+    assert offline == OFFLINE
+    assert device_id not in aggregator.windows
+
+
+def test_window_deadband(device_id):
+    aggregator = Aggregator(deadband=1, window=2)
+
+    assert aggregator.add(device_id, sample(100), now=0) == []
+    assert aggregator.add(device_id, sample(100), now=2) == [{
+        'MyDeviceName': {
+            **sample(100)['MyDeviceName'],
+            'Min': {'pit[DegC]': 100, 'food1[DegC]': 60},
+            'Max': {'pit[DegC]': 100, 'food1[DegC]': 60},
+        }
+    }]
+    assert aggregator.add(device_id, sample(100), now=3) == []
+    assert aggregator.add(device_id, sample(103), now=5) == [{
+        'MyDeviceName': {
+            'Values': {'pit[DegC]': 101.5},
+            'Max': {'pit[DegC]': 103},
+        }
+    }]
+
+
+def test_forget(device_id):
+    aggregator = Aggregator(deadband=1, window=10)
+
+    aggregator.add(device_id, sample(100), now=0)
+    aggregator.forget(device_id)
+    aggregator.forget(device_id)
+    assert not aggregator.windows
+    assert not aggregator.published
+    assert not aggregator.complete_published
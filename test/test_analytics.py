@@ -0,0 +1,84 @@
+import pytest
+
+from brewblox_sharemycook.analytics import CookAnalytics, ProbeTrend, STALL_DURATION
+from brewblox_sharemycook.controllers import TemperatureUnits
+
+
+def sample(food, pit=110, food_target=95, pit_target=110):
+    return {
+        'MyDeviceName': {
+            'Active': 1,
+            'Targets': {'pit[DegC]': pit_target, 'food1[DegC]': food_target},
+            'Values': {'pit[DegC]': pit, 'food1[DegC]': food},
+        }
+    }
+
+
+def test_first_sample():
+    analytics = CookAnalytics(smoothing=300)
+    assert analytics.annotate(TemperatureUnits.CELSIUS, 0, sample(20)) == sample(20)
+    # Samples the device already reported do not change the estimates
+    assert analytics.annotate(TemperatureUnits.CELSIUS, 0, sample(21)) == sample(21)
+
+
+def test_offline():
+    analytics = CookAnalytics(smoothing=300)
+    offline = {'MyDeviceName': {'Active': 0}}
+    assert analytics.annotate(TemperatureUnits.CELSIUS, 0, offline) is offline
+
+
+def test_rate_and_time_to_target():
+    analytics = CookAnalytics(smoothing=300)
+    analytics.annotate(TemperatureUnits.CELSIUS, 0, sample(20))
+    data = analytics.annotate(TemperatureUnits.CELSIUS, 60, sample(21))['MyDeviceName']
+    assert data['Rate'] == {'pit[DegC/min]': 0, 'food1[DegC/min]': 1}
+    assert data['Time_To_Target'] == {'food1[min]': 74}
+    assert data['Stalled'] == {'pit': 0, 'food1': 0}
+
+    # The rate is smoothed over time
+    data = analytics.annotate(TemperatureUnits.CELSIUS, 120, sample(23))['MyDeviceName']
+    assert 1 < data['Rate']['food1[DegC/min]'] < 2
+
+    # Probes that were disconnected start over
+    del analytics.probes['food1[DegC]']
+    data = analytics.annotate(TemperatureUnits.CELSIUS, 180, sample(23))['MyDeviceName']
+    assert 'food1[DegC/min]' not in data['Rate']
+
+    # Probes without a target only have a rate
+    data = analytics.annotate(TemperatureUnits.CELSIUS, 240, {'MyDeviceName': {'Values': {'pit[DegC]': 110}}})
+    assert data == {'MyDeviceName': {'Values': {'pit[DegC]': 110}, 'Rate': {'pit[DegC/min]': 0}}}
+
+
+def test_stall():
+    probe = ProbeTrend(temp=20, time=0)
+    stall_rate = 0.05
+
+    # Heating up at 1 degree per minute
+    for minute in range(1, 46):
+        probe.update(20 + minute, minute * 60, smoothing=60, stall_rate=stall_rate)
+    assert probe.minutes_to(95, stall_rate) == pytest.approx(30, abs=1)
+    assert not probe.stalled(95, scale=1)
+
+    # Flat for longer than the stall duration
+    start = 45 * 60
+    for second in range(60, STALL_DURATION + 600, 60):
+        probe.update(65, start + second, smoothing=60, stall_rate=stall_rate)
+    assert probe.minutes_to(95, stall_rate) is None
+    assert probe.stalled(95, scale=1)
+    # Not below target by a wide enough margin
+    assert not probe.stalled(68, scale=1)
+
+    # Heating up again
+    probe.update(67, start + STALL_DURATION + 660, smoothing=60, stall_rate=stall_rate)
+    assert not probe.stalled(95, scale=1)
+    assert probe.minutes_to(66, stall_rate) is None
+
+
+def test_fahrenheit_thresholds():
+    probe = ProbeTrend(temp=150, time=0)
+    # Rising 0.06 degrees per minute is a stall in Fahrenheit, but not in Celsius
+    probe.update(150.06, 60, smoothing=60, stall_rate=0.05 * 1.8)
+    assert probe.slow_since == 60
+    probe = ProbeTrend(temp=150, time=0)
+    probe.update(150.06, 60, smoothing=60, stall_rate=0.05)
+    assert probe.slow_since is None
@@ -1,22 +1,31 @@
+import asyncio
+import dataclasses
+import time
 import uuid
 from datetime import datetime
 
 import pytest
 from brewblox_service import http, scheduler
 from mock import AsyncMock, MagicMock
+from prometheus_client import REGISTRY
 
 from brewblox_sharemycook import broadcaster
+from brewblox_sharemycook.decoding import loads
 from brewblox_sharemycook.controllers import UltraQ, State, TemperatureUnits
-from brewblox_sharemycook.share_my_cook import ShareMyCook
+from brewblox_sharemycook.share_my_cook import PollResult, ShareMyCook
 
 pytestmark = [pytest.mark.asyncio]
 
 TESTED = broadcaster.__name__
 
 
+def staleness(device_id):
+    return REGISTRY.get_sample_value('sharemycook_device_staleness_seconds', {'device': str(device_id)})
+
+
 @pytest.fixture
 def m_publish(mocker):
-    m = mocker.patch(TESTED + '.mqtt.publish', AsyncMock())
+    m = mocker.patch('brewblox_sharemycook.publishing.mqtt.publish', AsyncMock())
     return m
 
 
@@ -24,7 +33,24 @@ def m_publish(mocker):
 def m_share_my_cook(monkeypatch):
     mock_share_my_cook = MagicMock(ShareMyCook)
     monkeypatch.setattr(f'{TESTED}.ShareMyCook', mock_share_my_cook)
-    return mock_share_my_cook.return_value
+    m = mock_share_my_cook.return_value
+    m.start = AsyncMock()
+
+    async def close():
+        await m.session.close()
+
+    m.close = AsyncMock(side_effect=close)
+    m.discover = AsyncMock(return_value=(set(), set()))
+    m.keep_alive = AsyncMock(return_value=True)
+    m.device_ids = set()
+
+    def create(session, username, *args, **kwargs):
+        m.session = session
+        m.username = username
+        return m
+
+    mock_share_my_cook.side_effect = create
+    return m
 
 
 @pytest.fixture
@@ -34,6 +60,13 @@ def app(app, m_publish):
     return app
 
 
+@pytest.fixture
+async def caster(app, m_share_my_cook):
+    caster = broadcaster.Broadcaster(app)
+    yield caster
+    await caster.shutdown(app)
+
+
 @pytest.fixture
 def device_id():
     return uuid.uuid4()
@@ -79,12 +112,17 @@ def inactive_device(device_id):
     )
 
 
-async def test_run(app, m_publish, m_share_my_cook, active_device, caplog):
-    def device_polls():
-        yield active_device
+def poll_result(device):
+    return PollResult(device_id=device.device_id, duration=0.1, controller=device)
+
+
+async def test_run(app, caster, m_publish, m_share_my_cook, active_device, caplog):
+    def device_polls(device_ids):
+        assert device_ids == [active_device.device_id]
+        return [poll_result(active_device)]
 
     m_share_my_cook.poll = AsyncMock(side_effect=device_polls)
-    caster = broadcaster.Broadcaster(app)
+    m_share_my_cook.device_ids = {active_device.device_id}
     await caster.prepare()
     await caster.run()
 
@@ -112,20 +150,23 @@ async def test_run(app, m_publish, m_share_my_cook, active_device, caplog):
     )
 
     assert 'Polling intervals: Active 0.01s, Inactive 0.05s' in caplog.messages
+    assert 'Poll concurrency: 4' in caplog.messages
+    assert 'Discovery interval: 0.05s' in caplog.messages
+    assert 'Session keep-alive: 0.05s' in caplog.messages
+    assert 'Publish heartbeat: 0.05s' in caplog.messages
+    assert 'Publish buffer: 100 messages' in caplog.messages
     assert 'name: test_app' in caplog.messages
     assert 'topic: brewcast/history/share-my-cook' in caplog.messages
 
 
-async def test_device_state_change(app, m_share_my_cook, active_device, inactive_device, device_id, caplog):
+async def test_device_state_change(caster, m_share_my_cook, active_device, inactive_device, device_id, caplog):
     responses = (
-        [inactive_device],
-        [active_device],
-        [inactive_device],
+        [poll_result(inactive_device)],
+        [poll_result(active_device)],
+        [poll_result(inactive_device)],
     )
     m_share_my_cook.poll = AsyncMock(side_effect=responses)
 
-    caster = broadcaster.Broadcaster(app)
-
     await caster.prepare()
     await caster.run()
     assert f'New device MyDeviceName({device_id}) is OFFLINE' in caplog.messages
@@ -139,3 +180,323 @@ async def test_device_state_change(app, m_share_my_cook, active_device, inactive
     await caster.run()
     assert f'Device MyDeviceName({device_id}) transitioned from ONLINE to OFFLINE' in caplog.messages
     assert 'Changing polling interval from 0.01s to 0.05s' in caplog.messages
+
+
+async def test_run_skips_failed_devices(caster, m_publish, m_share_my_cook, active_device):
+    failed = PollResult(device_id=uuid.uuid4(), duration=0.1, error=RuntimeError('boom'))
+    m_share_my_cook.poll = AsyncMock(return_value=[failed, poll_result(active_device)])
+    m_share_my_cook.device_ids = {failed.device_id, active_device.device_id}
+
+    await caster.prepare()
+    await caster.run()
+
+    m_publish.assert_awaited_once()
+    assert caster.device_states == {active_device.device_id: State.ONLINE}
+    # The failed device is retried on the next tick
+    assert failed.device_id in caster.due_devices(m_share_my_cook, caster.next_tick)
+
+
+async def test_discovery(caster, m_share_my_cook, active_device, device_id, caplog):
+    m_share_my_cook.discover = AsyncMock(side_effect=[
+        ({device_id}, set()),
+        RuntimeError('Devices page unavailable'),
+        (set(), {device_id, uuid.uuid4()}),
+    ])
+    m_share_my_cook.poll = AsyncMock(return_value=[poll_result(active_device)])
+
+    await caster.prepare()
+    await caster.run()
+    assert caster.device_states == {device_id: State.ONLINE}
+    assert staleness(device_id) is not None
+
+    await asyncio.sleep(0.12)
+    assert 'Device discovery for my_username failed: RuntimeError(Devices page unavailable)' in caplog.messages
+    assert caster.device_states == {}
+    assert staleness(device_id) is None
+
+    await caster.shutdown(caster.app)
+    assert caster.tasks == []
+
+
+@pytest.mark.parametrize('blocked', ['start', 'discover'])
+async def test_discovery_cancelled(caster, m_share_my_cook, blocked):
+    setattr(m_share_my_cook, blocked, AsyncMock(side_effect=asyncio.Event().wait))
+
+    await caster.prepare()
+    await asyncio.sleep(0.01)
+    task = caster.tasks[1]
+    await caster.shutdown(caster.app)
+    assert task.cancelled()
+
+
+async def test_start_account(caster, m_share_my_cook, caplog):
+    m_share_my_cook.start = AsyncMock(side_effect=RuntimeError('Login page unavailable'))
+
+    await caster.prepare()
+    await asyncio.sleep(0.01)
+    m_share_my_cook.start.assert_awaited_once_with()
+    assert 'Login for my_username failed: RuntimeError(Login page unavailable)' in caplog.messages
+    # Devices are discovered regardless, logging in on the first redirect to the login page
+    m_share_my_cook.discover.assert_awaited()
+    assert caster.discovered.is_set()
+
+
+async def test_session_keep_alive(caster, m_share_my_cook):
+    await caster.prepare()
+    m_share_my_cook.load_cookies.assert_called_once_with()
+
+    await asyncio.sleep(0.01)
+    m_share_my_cook.keep_alive.assert_awaited_with(0.05)
+
+    await caster.shutdown(caster.app)
+    m_share_my_cook.save_cookies.assert_called_once_with()
+
+
+async def test_shutdown_order(app, caster, m_share_my_cook, active_device):
+    polling = asyncio.Event()
+    closed_during_poll = []
+
+    async def poll(device_ids):
+        polling.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            closed_during_poll.append(m_share_my_cook.session.closed)
+
+    m_share_my_cook.device_ids = {active_device.device_id}
+    m_share_my_cook.discover = AsyncMock(return_value=({active_device.device_id}, set()))
+    m_share_my_cook.poll = AsyncMock(side_effect=poll)
+    await caster.start()
+    await asyncio.wait_for(polling.wait(), 1)
+
+    # The poll is cancelled before the session and publisher are closed
+    session = m_share_my_cook.session
+    await caster.shutdown(app)
+    assert closed_during_poll == [False]
+    assert session.closed
+    assert not caster.active
+
+
+async def test_shutdown_unprepared(caster):
+    await caster.shutdown(caster.app)
+    assert caster.accounts == []
+
+
+async def test_multiple_accounts(app, caster, monkeypatch, tmp_path, m_publish, active_device):
+    accounts_file = tmp_path / 'accounts.json'
+    accounts_file.write_text('[{"username": "alice", "password": "a"}, {"username": "bob", "password": "b"}]')
+    app['config']['accounts_file'] = str(accounts_file)
+
+    # Both accounts have a device with the same name
+    other_device = dataclasses.replace(active_device, device_id=uuid.uuid4())
+    devices = {'alice': active_device, 'bob': other_device}
+
+    def create(session, username, *args, account_index):
+        m = MagicMock(ShareMyCook)
+        m.session = session
+        m.username = username
+        m.account_index = account_index
+        m.device_ids = {devices[username].device_id}
+        m.start = AsyncMock()
+        m.close = AsyncMock(side_effect=session.close)
+        m.discover = AsyncMock(return_value=(set(), set()))
+        m.keep_alive = AsyncMock(return_value=True)
+        m.poll = AsyncMock(return_value=[poll_result(devices[username])])
+        return m
+
+    monkeypatch.setattr(f'{TESTED}.ShareMyCook', MagicMock(side_effect=create))
+    await caster.prepare()
+    alice, bob = caster.accounts
+    assert alice.session is not bob.session
+    assert alice.session.connector is bob.session.connector is caster.connector
+    assert [alice.account_index, bob.account_index] == [0, 1]
+
+    await caster.run()
+    alice.poll.assert_awaited_once_with([active_device.device_id])
+    bob.poll.assert_awaited_once_with([other_device.device_id])
+    assert [(call.args[1], list(call.args[2]['data'])) for call in m_publish.await_args_list] == [
+        ('brewcast/history/share-my-cook/MyDeviceName', ['MyDeviceName']),
+        ('brewcast/history/share-my-cook/account1-MyDeviceName', ['account1-MyDeviceName']),
+    ]
+    assert staleness(active_device.device_id) is not None
+    assert staleness(other_device.device_id) is not None
+
+    sessions = [alice.session, bob.session]
+    await caster.shutdown(app)
+    assert all(session.closed for session in sessions)
+    assert caster.connector is None
+
+
+async def test_published_name(caster, m_share_my_cook, active_device, caplog):
+    m_share_my_cook.account_index = 1
+    m_share_my_cook.username = 'bob'
+    first = dataclasses.replace(active_device, device_id=uuid.uuid4())
+    second = dataclasses.replace(active_device, device_id=uuid.uuid4())
+    third = dataclasses.replace(active_device, device_id=uuid.uuid4())
+
+    assert caster.published_name(m_share_my_cook, active_device) == 'MyDeviceName'
+    assert caster.published_name(m_share_my_cook, first) == 'account1-MyDeviceName'
+    assert f'Device MyDeviceName({first.device_id}) of bob is published as account1-MyDeviceName, ' \
+        'another device has the same name' in caplog.messages
+    assert caster.published_name(m_share_my_cook, second) == f'MyDeviceName-{second.device_id}'
+    # Devices keep their name
+    assert caster.published_name(m_share_my_cook, first) == 'account1-MyDeviceName'
+    assert caster.published_name(m_share_my_cook, active_device) == 'MyDeviceName'
+
+    # Renamed devices free their name
+    renamed = dataclasses.replace(active_device, name='Renamed')
+    assert caster.published_name(m_share_my_cook, renamed) == 'Renamed'
+    assert caster.published_name(m_share_my_cook, third) == 'MyDeviceName'
+
+
+async def test_publish_backlog(app, caster, tmp_path, m_publish, m_share_my_cook, active_device, caplog):
+    app['config']['backlog_file'] = str(tmp_path / 'backlog.ring')
+    app['config']['archive_file'] = str(tmp_path / 'archive.ring')
+    m_share_my_cook.device_ids = {active_device.device_id}
+    m_share_my_cook.poll = AsyncMock(return_value=[poll_result(active_device)])
+    m_publish.side_effect = ConnectionError('Broker unavailable')
+
+    await caster.prepare()
+    assert f'Publish backlog: {tmp_path / "backlog.ring"} (4096 bytes)' in caplog.messages
+    assert f'Sample archive: {tmp_path / "archive.ring"} (4096 bytes)' in caplog.messages
+    await caster.run()
+    await asyncio.sleep(0.01)
+    backlog = caster.publisher.backlog
+    archive = caster.publisher.archive
+    assert len(backlog) == len(archive) == 1
+    # Kept along with the time of the sample, for exports
+    assert loads(backlog.peek())[2] == loads(archive.peek())[2] == active_device.last_update.timestamp()
+
+    await caster.shutdown(app)
+    assert caster.publisher.backlog is None
+    assert backlog.mm.closed
+    assert archive.mm.closed
+
+
+async def test_tick_schedule(caster, m_share_my_cook):
+    await caster.prepare()
+    m_share_my_cook.poll = AsyncMock(return_value=[])
+
+    await caster.run()
+    first_tick = caster.next_tick
+    await caster.run()
+    assert caster.next_tick == pytest.approx(first_tick + caster.inactive_interval)
+    assert caster.missed_ticks == 0
+
+    # Time spent polling is deducted from the sleep
+    caster.next_tick = time.monotonic() - 0.04
+    start = time.monotonic()
+    await caster.sleep_until_next_tick()
+    assert time.monotonic() - start < 0.04
+    assert caster.missed_ticks == 0
+
+
+async def test_missed_ticks(caster, caplog):
+    await caster.prepare()
+
+    caster.next_tick = time.monotonic() - 0.12
+    await caster.sleep_until_next_tick()
+    assert caster.missed_ticks == 2
+    assert caster.next_tick <= time.monotonic()
+    assert 'Polling took longer than the 0.05s interval, skipped 2 tick(s)' in caplog.messages
+
+
+async def test_per_device_intervals(caster, m_share_my_cook, active_device):
+    offline_device = dataclasses.replace(active_device, device_id=uuid.uuid4(), state=State.OFFLINE)
+    devices = {d.device_id: d for d in [active_device, offline_device]}
+    m_share_my_cook.device_ids = set(devices)
+
+    def poll(device_ids):
+        # The active device keeps reporting new data, so it never goes stale
+        active_device.last_update = datetime.now()
+        return [poll_result(devices[d]) for d in device_ids]
+
+    m_share_my_cook.poll = AsyncMock(side_effect=poll)
+
+    await caster.prepare()
+    for _ in range(7):
+        await caster.run()
+
+    polled = [set(call.args[0]) for call in m_share_my_cook.poll.await_args_list]
+    assert all(active_device.device_id in device_ids for device_ids in polled)
+    # Polled on the first tick and again once the inactive interval (5 ticks) has passed
+    assert [offline_device.device_id in device_ids for device_ids in polled] == [
+        True, False, False, False, False, True, False
+    ]
+
+
+async def test_device_interval_stale(caster, active_device):
+    await caster.prepare()
+
+    assert caster.device_interval(active_device, 0) == caster.active_interval
+    assert caster.device_interval(active_device, 0.04) == caster.active_interval
+    # Online, but no new data for longer than the inactive interval
+    assert caster.device_interval(active_device, 0.05) == caster.inactive_interval
+
+    active_device.last_update = datetime.now()
+    assert caster.device_interval(active_device, 0.06) == caster.active_interval
+
+
+async def test_suppress_unchanged_samples(caster, m_publish, m_share_my_cook, active_device):
+    m_share_my_cook.device_ids = {active_device.device_id}
+    m_share_my_cook.poll = AsyncMock(return_value=[poll_result(active_device)])
+
+    await caster.prepare()
+    await caster.run()
+    await caster.run()
+    assert m_publish.await_count == 1
+    assert (caster.change_detector.sent, caster.change_detector.suppressed) == (1, 1)
+
+    active_device.last_update = datetime.now()
+    await caster.run()
+    assert m_publish.await_count == 2
+
+
+async def test_aggregate_samples(app, caster, m_publish, m_share_my_cook, active_device, device_id, caplog):
+    app['config']['deadband'] = 1
+    app['config']['publish_heartbeat'] = 0
+    m_share_my_cook.device_ids = {device_id}
+    m_share_my_cook.poll = AsyncMock(return_value=[poll_result(active_device)])
+
+    await caster.prepare()
+    assert 'Aggregation: deadband 1, window 0.0s' in caplog.messages
+    await caster.run()
+    assert m_publish.await_count == 1
+
+    # New, but not different enough
+    active_device.last_update = datetime.now()
+    active_device.pit_temp += 0.5
+    await caster.run()
+    assert m_publish.await_count == 1
+
+    active_device.last_update = datetime.now()
+    active_device.pit_temp += 0.5
+    await caster.run()
+    assert m_publish.await_count == 2
+    assert m_publish.await_args.args[2]['data'] == {'MyDeviceName': {'Values': {'pit[DegC]': 51}}}
+
+    m_share_my_cook.discover.return_value = (set(), {device_id})
+    await caster.discover(m_share_my_cook)
+    assert device_id not in caster.aggregator.published
+
+
+async def test_cook_analytics(app, caster, m_publish, m_share_my_cook, active_device, device_id, caplog):
+    app['config']['analytics_smoothing'] = 300
+    m_share_my_cook.device_ids = {device_id}
+    m_share_my_cook.poll = AsyncMock(return_value=[poll_result(active_device)])
+
+    await caster.prepare()
+    assert 'Cook analytics smoothing: 300s' in caplog.messages
+    await caster.run()
+    assert 'Rate' not in m_publish.await_args.args[2]['data']['MyDeviceName']
+
+    active_device.last_update = datetime.fromtimestamp(active_device.last_update.timestamp() + 60)
+    active_device.food1_temp += 1
+    await caster.run()
+    data = m_publish.await_args.args[2]['data']['MyDeviceName']
+    assert data['Rate']['food1[DegC/min]'] == 1
+    assert data['Time_To_Target'] == {'food1[min]': 29}
+
+    m_share_my_cook.discover.return_value = (set(), {device_id})
+    await caster.discover(m_share_my_cook)
+    assert device_id not in caster.device_analytics
@@ -0,0 +1,58 @@
+import uuid
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+
+from brewblox_sharemycook.change_detection import ChangeDetector
+from brewblox_sharemycook.controllers import Controller
+
+
+@pytest.fixture
+def device_data():
+    device_data = MagicMock(Controller)
+    device_data.device_id = uuid.uuid4()
+    device_data.last_update = datetime.now()
+    return device_data
+
+
+def test_suppress_unchanged(device_data):
+    detector = ChangeDetector(heartbeat=0)
+    data = {'MyDeviceName': {'Active': 1}}
+
+    assert detector.should_publish(device_data, data, now=0)
+    assert not detector.should_publish(device_data, data, now=1000)
+    assert not detector.should_publish(device_data, dict(data), now=2000)
+    assert (detector.sent, detector.suppressed) == (1, 2)
+
+
+def test_publish_changes(device_data):
+    detector = ChangeDetector(heartbeat=0)
+
+    assert detector.should_publish(device_data, {'MyDeviceName': {'Active': 1}}, now=0)
+    assert detector.should_publish(device_data, {'MyDeviceName': {'Active': 0}}, now=1)
+
+    device_data.last_update += timedelta(seconds=2)
+    assert detector.should_publish(device_data, {'MyDeviceName': {'Active': 0}}, now=2)
+    assert (detector.sent, detector.suppressed) == (3, 0)
+
+
+def test_heartbeat(device_data):
+    detector = ChangeDetector(heartbeat=10)
+    data = {'MyDeviceName': {'Active': 1}}
+
+    assert detector.should_publish(device_data, data, now=0)
+    assert not detector.should_publish(device_data, data, now=9)
+    assert detector.should_publish(device_data, data, now=10)
+    assert not detector.should_publish(device_data, data, now=19)
+    assert (detector.sent, detector.suppressed) == (2, 2)
+
+
+def test_forget(device_data):
+    detector = ChangeDetector(heartbeat=0)
+    data = {'MyDeviceName': {'Active': 1}}
+
+    assert detector.should_publish(device_data, data, now=0)
+    detector.forget(device_data.device_id)
+    detector.forget(device_data.device_id)
+    assert detector.should_publish(device_data, data, now=1)
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from brewblox_sharemycook.circuit_breaker import BreakerSettings, CircuitBreaker, CircuitOpenError, CircuitState
+
+
+def circuit_state(name):
+    return REGISTRY.get_sample_value('sharemycook_circuit_state', {'circuit': name})
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker('account/test', BreakerSettings(threshold=2, min_backoff=10, max_backoff=30, jitter=0))
+
+
+def test_opens_after_threshold(breaker, caplog):
+    breaker.record_failure(now=0)
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.allow(now=0)
+
+    breaker.record_failure(now=0)
+    assert breaker.state == CircuitState.OPEN
+    assert circuit_state('account/test') == CircuitState.OPEN.value
+    assert 'Circuit account/test opened after 2 failure(s), retrying in 10.0s' in caplog.messages
+    assert not breaker.allow(now=9)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(now=9)
+
+
+def test_success_resets_failures(breaker):
+    breaker.record_failure(now=0)
+    breaker.record_success()
+    breaker.record_failure(now=0)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_probe(breaker, caplog):
+    breaker.record_failure(now=0)
+    breaker.record_failure(now=0)
+
+    # A single probe is let through once the backoff has passed
+    assert breaker.allow(now=10)
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert not breaker.allow(now=10)
+
+    # A failed probe doubles the backoff, up to the maximum
+    breaker.record_failure(now=10)
+    assert breaker.retry_at == 30
+    assert breaker.allow(now=30)
+    breaker.record_failure(now=30)
+    assert breaker.retry_at == 60
+    assert breaker.allow(now=60)
+    breaker.record_failure(now=60)
+    assert breaker.retry_at == 90
+
+    assert breaker.allow(now=90)
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.trips == 0
+    assert 'Circuit account/test closed' in caplog.messages
+
+
+def test_jitter():
+    breaker = CircuitBreaker('jittered', BreakerSettings(threshold=1, min_backoff=10, jitter=0.5))
+    delays = set()
+    for _ in range(20):
+        breaker.record_failure(now=0)
+        delays.add(breaker.retry_at)
+        breaker.record_success()
+    assert all(5 <= delay <= 10 for delay in delays)
+    assert len(delays) > 1
+
+
+async def test_protect(breaker):
+    with breaker.protect():
+        pass
+    assert breaker.failures == 0
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            with breaker.protect():
+                raise RuntimeError('Upstream failure')
+    assert breaker.state == CircuitState.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        with breaker.protect():
+            pass
+
+
+@pytest.mark.parametrize('error', [CircuitOpenError('Other circuit is open'), asyncio.CancelledError()])
+def test_protect_neutral(breaker, error):
+    breaker.record_failure(now=0)
+    breaker.record_failure(now=0)
+    breaker.retry_at = 0
+
+    with pytest.raises(type(error)):
+        with breaker.protect():
+            raise error
+    # The probe was not used up
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.allow()
+    assert breaker.failures == 2
+
+
+def test_remove(breaker):
+    assert circuit_state('account/test') is not None
+    breaker.remove()
+    assert circuit_state('account/test') is None
@@ -1,9 +1,14 @@
+import json
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
 
 import pytest
 
-from brewblox_sharemycook.controllers import controller_types, TemperatureUnits
+from brewblox_sharemycook import controllers
+from brewblox_sharemycook.controllers import Controller, State, TemperatureUnits
+from brewblox_sharemycook.controllers import controller, controller_types, decode_controller, scale_converted
+from brewblox_sharemycook.controllers import Field, GenericController, Probe, Schema, SchemaController
 
 
 @pytest.fixture
@@ -93,3 +98,158 @@ def test_controller(model, temperature_units, sample_response, expected_serializ
         device_id=device_id, units=temperature_units, json=sample_response
     )
     assert controller.serialize() == expected_serialized
+
+
+@pytest.mark.parametrize('model, temperature_units, online, expected_temp_units', [
+    ('UltraQ', TemperatureUnits.CELSIUS, True, 'DegC'),
+    ('UltraQ', TemperatureUnits.FAHRENHEIT, True, 'DegF'),
+])
+def test_controller_record(model, temperature_units, sample_response, expected_temp_units):
+    controller = controller_types[model].from_json(
+        device_id=device_id, units=temperature_units, json=sample_response
+    )
+    assert controller.temp_units == expected_temp_units
+    assert not hasattr(controller, '__dict__')
+
+
+@pytest.mark.parametrize('model, online', [('UltraQ', True)])
+def test_decode_controller(model, sample_response, device_id):
+    content = json.dumps({'unusedField': {'nested': [1, 2, 3]}, **sample_response}).encode()
+    controller = decode_controller(device_id, TemperatureUnits.CELSIUS, content)
+    assert controller == controller_types[model].from_json(device_id, TemperatureUnits.CELSIUS, sample_response)
+
+
+@pytest.mark.parametrize('previous, current, converted', [
+    ((107, 95, 60, 0), (225, 203, 140, 32), True),
+    ((225, 203, 140, 32), (107, 95, 60, 0), True),
+    ((107, 95), (107, 95), False),
+    ((107, 95), (110, 95), False),
+    ((107, 95), (225, 95), False),
+    ((), (225,), False),
+    ((107,), (225, 203), False),
+])
+def test_scale_converted(previous, current, converted):
+    assert scale_converted(previous, current) == converted
+
+
+@pytest.mark.parametrize('model, online', [('UltraQ', True)])
+def test_controller_targets(model, sample_response, device_id):
+    controller = controller_types[model].from_json(device_id, TemperatureUnits.CELSIUS, sample_response)
+    assert controller.targets() == (107, 97, 96, 95)
+
+
+def test_controller_without_targets(device_id):
+    class Thermometer(Controller):
+        @classmethod
+        def from_json(cls, device_id, units, json):
+            return cls(device_id, json['name'], State.ONLINE, units, datetime.now())
+
+        def serialize(self):
+            return {}
+
+    thermometer = Thermometer.from_json(device_id, TemperatureUnits.CELSIUS, {'name': 'Thermometer'})
+    assert thermometer.targets() == ()
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(controllers, 'controller_types', dict(controller_types))
+    monkeypatch.setattr(controllers.model_decoder, 'schemas', dict(controllers.model_decoder.schemas))
+    monkeypatch.setattr(controllers.model_decoder, 'decoder', None)
+    monkeypatch.setattr(controllers, 'unknown_models', set())
+
+
+def test_schema_controller(registry, device_id, timestamp_string):
+    @controller
+    @dataclass
+    class Smoker(SchemaController):
+        __slots__ = ('box_temp', 'box_target', 'door')
+
+        SCHEMA = Schema(
+            probes=(Probe('box', 'boxTemp', 'boxSetpoint'),),
+            fields=(Field('doorOpen', 'door', 'Door', bool),),
+        )
+
+        box_temp: float
+        box_target: float
+        door: bool
+
+    content = json.dumps({
+        'bbqGuruDeviceModel': 'Smoker',
+        'customerDeviceName': 'MySmoker',
+        'indicateStatus': 'good',
+        'boxTemp': 120,
+        'boxSetpoint': 125,
+        'doorOpen': 0,
+        'lastDeviceCommunicationTimestamp': timestamp_string,
+    }).encode()
+    smoker = decode_controller(device_id, TemperatureUnits.FAHRENHEIT, content)
+    assert isinstance(smoker, Smoker)
+    assert smoker.targets() == (125,)
+    assert smoker.serialize() == {
+        'MySmoker': {
+            'Active': 1,
+            'Door': False,
+            'Targets': {'box[DegF]': 125},
+            'Values': {'box[DegF]': 120},
+        }
+    }
+
+
+def test_schema_mismatch(registry):
+    with pytest.raises(TypeError, match='do not match the controller fields'):
+        @controller
+        @dataclass
+        class Smoker(SchemaController):
+            __slots__ = ('box_temp',)
+
+            SCHEMA = Schema(probes=(Probe('box', 'boxTemp', 'boxSetpoint'),))
+
+            box_temp: float
+
+    assert 'Smoker' not in controllers.controller_types
+
+
+@pytest.mark.parametrize('model, online', [('UltraQ', True)])
+def test_unknown_model(registry, sample_response, device_id, caplog):
+    content = json.dumps({
+        **sample_response,
+        'bbqGuruDeviceModel': 'UltraQ2',
+        'food4ActualTemp': 55,
+        'ambientActualTemp': 21,
+    }).encode()
+
+    controller = decode_controller(device_id, TemperatureUnits.CELSIUS, content)
+    assert isinstance(controller, GenericController)
+    assert 'Unknown controller model UltraQ2, publishing its probes generically' in caplog.messages
+    assert controller.targets() == (107, 97, 96, 95)
+    assert controller.serialize() == {
+        'MyDeviceName': {
+            'Active': 1,
+            'Fan_Duty[%]': 78,
+            'Targets': {'pit[DegC]': 107, 'food1[DegC]': 97, 'food2[DegC]': 96},
+            'Values': {'pit[DegC]': 106, 'food1[DegC]': 67, 'food2[DegC]': 66, 'food4[DegC]': 55, 'ambient[DegC]': 21},
+        }
+    }
+
+    # Reported only once
+    caplog.clear()
+    decode_controller(device_id, TemperatureUnits.CELSIUS, content)
+    assert not caplog.messages
+
+
+@pytest.mark.parametrize('model, online', [('UltraQ', False)])
+def test_unknown_model_offline(registry, sample_response, device_id):
+    content = json.dumps({
+        'bbqGuruDeviceModel': 'Thermometer',
+        'customerDeviceName': 'MyThermometer',
+        'indicateStatus': 'good',
+        'probeActualTemp': 20,
+        'lastDeviceCommunicationTimestamp': sample_response['lastDeviceCommunicationTimestamp'],
+    }).encode()
+    controller = decode_controller(device_id, TemperatureUnits.CELSIUS, content)
+    assert controller.serialize() == {'MyThermometer': {'Active': 1, 'Targets': {}, 'Values': {'probe[DegC]': 20}}}
+
+    controller = decode_controller(device_id, TemperatureUnits.CELSIUS, json.dumps(sample_response).encode())
+    generic = GenericController.from_json(device_id, TemperatureUnits.CELSIUS, sample_response)
+    assert controller.serialize() == generic.serialize() == {'MyDeviceName': {'Active': 0}}
@@ -0,0 +1,48 @@
+import json
+from typing import Any
+
+import pytest
+
+from brewblox_sharemycook.decoding import dumps, loads, ModelDecoder
+
+
+@pytest.fixture
+def decoder():
+    decoder = ModelDecoder('model')
+    decoder.register('Smoker', {'model': str, 'name': str, 'temp': float, 'door': Any})
+    return decoder
+
+
+def test_dumps_loads():
+    assert loads(dumps(['topic', {'n': 1}])) == ['topic', {'n': 1}]
+
+
+def test_decode_registered_fields(decoder):
+    content = json.dumps({
+        'model': 'Smoker', 'extra': {'nested': [1, 2]}, 'name': 'Big "Smokey"', 'temp': 101, 'door': [0],
+    })
+    assert decoder.decode(content.encode()) == {'model': 'Smoker', 'name': 'Big "Smokey"', 'temp': 101, 'door': [0]}
+
+
+@pytest.mark.parametrize('content', [
+    # Unregistered model
+    {'model': 'Grill', 'name': 'Grill', 'temp': 200},
+    # Missing field
+    {'model': 'Smoker', 'name': 'Smokey', 'door': 0},
+    # Value of another type
+    {'model': 'Smoker', 'name': 'Smokey', 'temp': '101', 'door': 0},
+])
+def test_decode_fallback(decoder, content):
+    assert decoder.decode(json.dumps(content).encode()) == content
+
+
+def test_decode_invalid(decoder):
+    with pytest.raises(ValueError):
+        decoder.decode(b'{"model": "Smoker", ')
+
+
+def test_register_recompiles(decoder):
+    content = json.dumps({'model': 'Grill', 'name': 'Grill', 'temp': 200, 'extra': 1}).encode()
+    decoder.decode(content)
+    decoder.register('Grill', {'name': str})
+    assert decoder.decode(content) == {'model': 'Grill', 'name': 'Grill'}
@@ -0,0 +1,129 @@
+import math
+import sys
+
+import numpy
+import pytest
+
+from brewblox_sharemycook import export
+from brewblox_sharemycook.decoding import dumps
+from brewblox_sharemycook.ring_buffer import RingBuffer
+
+
+def message(name, sample):
+    return {'key': 'ShareMyCook', 'data': {name: sample}}
+
+
+ONLINE = {
+    'Active': 1,
+    'Fan_Duty[%]': 48,
+    # Not numeric, and not exported
+    'Model': 'UltraQ',
+    'Targets': {'pit[DegC]': 107},
+    'Values': {'pit[DegC]': 105.5, 'food1[DegC]': 60.1},
+}
+OFFLINE = {'Active': 0}
+
+
+@pytest.fixture
+def backlog_file(tmp_path):
+    path = str(tmp_path / 'backlog.ring')
+    backlog = RingBuffer(path, 4096)
+    backlog.append(dumps(['topic/UltraQ', message('UltraQ', ONLINE), 1000.0]))
+    backlog.append(dumps(['topic/UltraQ', message('UltraQ', OFFLINE)]))
+    backlog.close()
+    return path
+
+
+def test_to_columns(backlog_file):
+    columns = export.to_columns(export.read_records(backlog_file))
+    assert list(columns) == [
+        'device', 'time', 'Active', 'Fan_Duty[%]', 'Targets/pit[DegC]', 'Values/food1[DegC]', 'Values/pit[DegC]'
+    ]
+    assert columns['device'].tolist() == ['UltraQ', 'UltraQ']
+    assert columns['time'][0] == 1000
+    assert math.isnan(columns['time'][1])
+    assert columns['Active'].dtype == float
+    assert columns['Active'].tolist() == [1, 0]
+    assert columns['Values/pit[DegC]'][0] == 105.5
+    assert math.isnan(columns['Values/pit[DegC]'][1])
+
+    # Fields that only appear later are padded as well
+    columns = export.to_columns(reversed(list(export.read_records(backlog_file))))
+    assert math.isnan(columns['Fan_Duty[%]'][0])
+    assert columns['Fan_Duty[%]'][1] == 48
+
+
+def test_to_columns_interleaved():
+    records = [('', message(f'UltraQ{n % 3}', OFFLINE if n % 2 else ONLINE), float(n)) for n in range(12)]
+    columns = export.to_columns(records)
+    assert columns['device'].tolist() == [f'UltraQ{n % 3}' for n in range(12)]
+    assert columns['time'].tolist() == list(range(12))
+    assert columns['Active'].tolist() == [0 if n % 2 else 1 for n in range(12)]
+    assert numpy.isnan(columns['Fan_Duty[%]'][1::2]).all()
+    assert (columns['Fan_Duty[%]'][::2] == 48).all()
+
+
+def test_to_columns_not_numbers():
+    records = [('', message('UltraQ', {'Active': 1, 'Fan_Duty[%]': duty, 'Model': model}), None)
+               for duty, model in [(48, 'UltraQ'), (None, 'UltraQ'), ('50', 1), ([50], 2)]]
+    columns = export.to_columns(records)
+    assert list(columns) == ['device', 'time', 'Active', 'Fan_Duty[%]']
+    assert columns['Fan_Duty[%]'][0] == 48
+    assert numpy.isnan(columns['Fan_Duty[%]'][1:]).all()
+
+
+def test_to_columns_empty():
+    columns = export.to_columns([('', message('UltraQ', {'Model': 'UltraQ'}), None)])
+    assert list(columns) == ['device', 'time']
+    assert columns['device'].tolist() == ['UltraQ']
+    assert export.to_columns([])['device'].tolist() == []
+
+
+def test_replay_file(tmp_path):
+    path = tmp_path / 'replay.jsonl'
+    path.write_bytes(b'\n'.join([
+        dumps(['topic/UltraQ', message('UltraQ', ONLINE), 1000.0]),
+        b'',
+        dumps(message('Other', OFFLINE)),
+    ]))
+    assert list(export.read_records(str(path))) == [
+        ('topic/UltraQ', message('UltraQ', ONLINE), 1000.0),
+        ('', message('Other', OFFLINE), None),
+    ]
+
+
+def test_export_npz(backlog_file, tmp_path, capsys):
+    output = str(tmp_path / 'cook.npz')
+    export.main([backlog_file, output])
+    assert 'Exported 2 sample(s) with 5 field(s)' in capsys.readouterr().out
+
+    with numpy.load(output) as npz:
+        assert npz['device'].tolist() == ['UltraQ', 'UltraQ']
+        assert npz['Values/food1[DegC]'][0] == 60.1
+        assert npz['Values/pit[DegC]'][0] == 105.5
+    # The backlog is left as is
+    assert len(list(export.read_records(backlog_file))) == 2
+
+
+def test_export_drain(backlog_file, tmp_path):
+    export.main([backlog_file, str(tmp_path / 'cook.npz'), '--drain'])
+    assert list(export.read_records(backlog_file)) == []
+
+    replay_file = tmp_path / 'replay.jsonl'
+    replay_file.write_bytes(dumps(message('UltraQ', OFFLINE)))
+    output = tmp_path / 'replay.npz'
+    with pytest.raises(SystemExit, match='Only archive and backlog files can be drained'):
+        export.main([str(replay_file), str(output), '--drain'])
+    assert replay_file.read_bytes()
+    assert not output.exists()
+
+
+def test_export_unknown_format(backlog_file, tmp_path):
+    with pytest.raises(SystemExit, match='use one of .npz, .parquet'):
+        export.main([backlog_file, str(tmp_path / 'cook.csv')])
+
+
+def test_export_parquet(backlog_file, tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(SystemExit, match='pyarrow is required'):
+        export.main([backlog_file, str(tmp_path / 'cook.parquet')])
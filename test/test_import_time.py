@@ -0,0 +1,48 @@
+"""
+Import-time benchmark of the service entry point, based on `python -X importtime`
+
+Run with `pytest -s test/test_import_time.py` to print the slowest imports.
+"""
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+ENTRY_POINT = 'brewblox_sharemycook.__main__'
+LAZY_MODULES = ['bs4', 'lxml', 'soupsieve']
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    :return: cumulative import time in microseconds per module imported by `module`
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.fixture(scope='module')
+def entry_point_times():
+    return import_times(ENTRY_POINT)
+
+
+def test_import_time(entry_point_times):
+    assert ENTRY_POINT in entry_point_times
+    slowest = sorted(entry_point_times.items(), key=lambda item: item[1], reverse=True)[:10]
+    print(f'\n{ENTRY_POINT} imports in {entry_point_times[ENTRY_POINT] / 1000:.1f}ms, slowest imports:')
+    for name, cumulative in slowest:
+        print(f'{name:<60} {cumulative / 1000:>8.1f}ms')
+
+
+@pytest.mark.parametrize('lazy_module', LAZY_MODULES)
+def test_lazy_imports(entry_point_times, lazy_module):
+    assert not [name for name in entry_point_times if name.split('.')[0] == lazy_module]
@@ -0,0 +1,22 @@
+from unittest.mock import MagicMock
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from brewblox_sharemycook import metrics
+
+
+async def test_metrics_endpoint(app):
+    metrics.setup(app)
+    assert '/metrics' in [resource.canonical for resource in app.router.resources()]
+
+    metrics.CIRCUIT_STATE.labels(circuit='account/0').set(2)
+    metrics.PARSE_TIME.labels(page='login').observe(0.01)
+    response = await metrics.metrics_handler(MagicMock(web.Request))
+    assert response.status == 200
+    assert response.headers['Content-Type'] == CONTENT_TYPE_LATEST
+
+    body = response.body.decode()
+    assert 'sharemycook_circuit_state{circuit="account/0"} 2.0' in body
+    assert 'sharemycook_parse_seconds_count{page="login"}' in body
+    assert 'sharemycook_relogins_total ' in body
@@ -0,0 +1,31 @@
+from brewblox_sharemycook.page_cache import content_digest, CachedPage, PageCache
+
+
+def test_validators():
+    assert CachedPage(b'', None).validators() == {}
+    assert CachedPage(b'', None, etag='"v1"', last_modified='Sun, 18 Oct 2026 10:00:00 GMT').validators() == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Sun, 18 Oct 2026 10:00:00 GMT',
+    }
+
+
+def test_digest():
+    assert content_digest(b'page') == content_digest(b'page')
+    assert content_digest(b'page') != content_digest(b'other page')
+
+
+def test_lru_eviction():
+    cache = PageCache(max_entries=2)
+    first, second, third = (CachedPage(content_digest(v), v) for v in [b'1', b'2', b'3'])
+
+    cache.put('/first', first)
+    cache.put('/second', second)
+    assert cache.get('/first') is first
+    assert cache.get('/missing') is None
+
+    # The second page is the least recently used
+    cache.put('/third', third)
+    assert len(cache) == 2
+    assert cache.get('/second') is None
+    assert cache.get('/first') is first
+    assert cache.get('/third') is third
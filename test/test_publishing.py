@@ -0,0 +1,267 @@
+import asyncio
+import time
+
+import pytest
+from mock import AsyncMock
+from prometheus_client import REGISTRY
+
+from brewblox_sharemycook import publishing
+from brewblox_sharemycook.decoding import loads
+from brewblox_sharemycook.publishing import Publisher
+from brewblox_sharemycook.ring_buffer import HEADER, RingBuffer
+
+TESTED = publishing.__name__
+
+
+@pytest.fixture
+def m_publish(mocker):
+    return mocker.patch(TESTED + '.mqtt.publish', AsyncMock())
+
+
+@pytest.fixture
+def publisher(app):
+    return Publisher(app, buffer_size=3)
+
+
+async def test_flush(app, publisher, m_publish):
+    publisher.enqueue('topic/a', {'n': 1})
+    publisher.enqueue('topic/b', {'n': 2})
+    publisher.enqueue('topic/a', {'n': 3})
+
+    assert await publisher.flush()
+    assert [c.args for c in m_publish.await_args_list] == [
+        (app, 'topic/a', {'n': 1}),
+        (app, 'topic/a', {'n': 3}),
+        (app, 'topic/b', {'n': 2}),
+    ]
+    assert publisher.sent == 3
+    assert not publisher.buffer
+
+
+async def test_overflow(publisher, caplog):
+    for n in range(5):
+        publisher.enqueue('topic', {'n': n})
+
+    assert [message for _, message, _ in publisher.buffer] == [{'n': 2}, {'n': 3}, {'n': 4}]
+    assert publisher.dropped == 2
+    assert 'Publish buffer full, dropped the oldest message (2 dropped in total)' in caplog.messages
+
+
+async def test_broker_outage(publisher, m_publish, caplog):
+    m_publish.side_effect = [None, ConnectionError('Broker unavailable'), None]
+    publisher.enqueue('topic/a', {'n': 1})
+    publisher.enqueue('topic/a', {'n': 2})
+    publisher.enqueue('topic/a', {'n': 3})
+
+    assert not await publisher.flush()
+    assert 'Unable to publish to topic/a, 2 message(s) retained: ConnectionError(Broker unavailable)' in caplog.messages
+
+    # New messages are retained after the failed ones, the oldest are dropped on overflow
+    publisher.enqueue('topic/a', {'n': 4})
+    publisher.enqueue('topic/b', {'n': 5})
+    m_publish.side_effect = ConnectionError('Broker unavailable')
+    assert not await publisher.flush()
+    assert [message for _, message, _ in publisher.buffer] == [{'n': 3}, {'n': 4}, {'n': 5}]
+    assert publisher.dropped == 1
+
+    m_publish.side_effect = None
+    assert await publisher.flush()
+    assert publisher.sent == 4
+
+
+async def test_overflow_during_flush(publisher, m_publish, caplog):
+    async def publish(app, topic, message):
+        for n in range(2, 5):
+            publisher.enqueue('topic/b', {'n': n})
+        raise ConnectionError('Broker unavailable')
+
+    m_publish.side_effect = publish
+    publisher.enqueue('topic/a', {'n': 1})
+
+    assert not await publisher.flush()
+    assert [message for _, message, _ in publisher.buffer] == [{'n': 2}, {'n': 3}, {'n': 4}]
+    assert publisher.dropped == 1
+    assert 'Publish buffer full, dropped the 1 oldest message(s)' in caplog.messages
+
+
+async def test_publish_cancelled(publisher, m_publish):
+    m_publish.side_effect = asyncio.CancelledError
+    publisher.enqueue('topic', {'n': 1})
+
+    with pytest.raises(asyncio.CancelledError):
+        await publisher.flush()
+
+
+async def test_run(publisher, m_publish, monkeypatch):
+    monkeypatch.setattr(TESTED + '.RETRY_MIN_INTERVAL_S', 0.01)
+    monkeypatch.setattr(TESTED + '.RETRY_INTERVAL_S', 0.02)
+    m_publish.side_effect = [ConnectionError('Broker unavailable')] * 3 + [None, None]
+    task = asyncio.create_task(publisher.run())
+
+    # Retried after 0.01, 0.02 and 0.02 seconds
+    publisher.enqueue('topic', {'n': 1})
+    await asyncio.sleep(0.08)
+    assert m_publish.await_count == 4
+    assert publisher.sent == 1
+    assert not publisher.buffer
+
+    # The retry interval is reset after a successful publish
+    publisher.enqueue('topic', {'n': 2})
+    await asyncio.sleep(0.01)
+    assert publisher.sent == 2
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.fixture
+def backlog(tmp_path):
+    backlog = RingBuffer(str(tmp_path / 'backlog.ring'), 4096)
+    yield backlog
+    backlog.close()
+
+
+async def test_backlog_failed(app, backlog, m_publish, caplog):
+    publisher = Publisher(app, buffer_size=3, backlog=backlog, replay_rate=1000)
+    failing = {1}
+
+    async def publish(app, topic, message):
+        if message['n'] in failing:
+            raise ConnectionError('Broker unavailable')
+
+    m_publish.side_effect = publish
+    publisher.enqueue('topic/b', {'n': 0}, timestamp=1000)
+    publisher.enqueue('topic/a', {'n': 1})
+    publisher.enqueue('topic/b', {'n': 2})
+    publisher.enqueue('topic/a', {'n': 3})
+    # Messages that overflow the buffer are kept in the backlog
+    assert [loads(record) for record in backlog] == [['topic/b', {'n': 0}, 1000]]
+    assert publisher.replay_pending.is_set()
+
+    # Messages that fail to publish are kept in the backlog, after the older ones,
+    # and so are new messages for topics with messages in the backlog
+    assert not await publisher.flush()
+    assert not publisher.buffer
+    assert [loads(record)[1]['n'] for record in backlog] == [0, 2, 1, 3]
+    assert REGISTRY.get_sample_value('sharemycook_backlog_messages') == 4
+    publisher.enqueue('topic/a', {'n': 4})
+    publisher.enqueue('topic/c', {'n': 5})
+    assert await publisher.flush()
+    assert [loads(record)[1]['n'] for record in backlog] == [0, 2, 1, 3, 4]
+    assert [c.args[1:] for c in m_publish.await_args_list] == [('topic/a', {'n': 1}), ('topic/c', {'n': 5})]
+
+    failing = {0}
+    assert not await publisher.replay()
+    assert len(backlog) == 5
+    assert 'Unable to publish to topic/b, 5 message(s) retained in the backlog: ' \
+        'ConnectionError(Broker unavailable)' in caplog.messages
+
+    # Replayed in the order they were kept
+    failing = set()
+    assert await publisher.replay()
+    assert [c.args[1:] for c in m_publish.await_args_list[3:]] == [
+        ('topic/b', {'n': 0}),
+        ('topic/b', {'n': 2}),
+        ('topic/a', {'n': 1}),
+        ('topic/a', {'n': 3}),
+        ('topic/a', {'n': 4}),
+    ]
+    assert publisher.sent == 6
+    assert len(backlog) == 0
+    assert REGISTRY.get_sample_value('sharemycook_backlog_messages') == 0
+
+    # Published right away once the backlog is replayed
+    publisher.enqueue('topic/a', {'n': 6})
+    assert await publisher.flush()
+    m_publish.assert_awaited_with(app, 'topic/a', {'n': 6})
+    assert len(backlog) == 0
+
+
+async def test_backlog_rate_limit(app, backlog, m_publish):
+    publisher = Publisher(app, buffer_size=3, backlog=backlog, replay_rate=100)
+    publisher.write_backlog([('topic', {'n': n}, None) for n in range(5)])
+
+    start = time.monotonic()
+    assert await publisher.replay()
+    assert time.monotonic() - start >= 0.04
+    assert m_publish.await_count == 5
+
+
+async def test_backlog_live_messages(app, backlog, m_publish):
+    publisher = Publisher(app, buffer_size=100, backlog=backlog, replay_rate=10)
+    publisher.write_backlog([('topic/a', {'n': n}, None) for n in range(5)])
+    task = asyncio.create_task(publisher.run())
+
+    # New messages for other topics are not held back by the rate limited replay
+    for n in range(5, 55):
+        publisher.enqueue('topic/a' if n % 5 == 0 else 'topic/b', {'n': n})
+    await asyncio.sleep(0.05)
+    published = [c.args[2]['n'] for c in m_publish.await_args_list]
+    assert [n for n in published if n % 5 == 0] == [0]
+    assert [n for n in published if n % 5] == [n for n in range(5, 55) if n % 5]
+    # New messages for the replayed topic are queued behind it
+    assert [loads(record)[1]['n'] for record in backlog] == [1, 2, 3, 4, *range(5, 55, 5)]
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+async def test_backlog_overflow(app, tmp_path, m_publish, caplog):
+    backlog = RingBuffer(str(tmp_path / 'backlog.ring'), HEADER.size + 64)
+    publisher = Publisher(app, buffer_size=3, backlog=backlog)
+    publisher.write_backlog([('topic', {'n': n}, None) for n in range(5)])
+
+    assert publisher.dropped == 2
+    assert 'Publish backlog full, dropped the 1 oldest message(s)' in caplog.messages
+    assert [loads(record)[1] for record in backlog] == [{'n': 2}, {'n': 3}, {'n': 4}]
+    backlog.close()
+
+
+async def test_backlog_restored(app, tmp_path, m_publish):
+    path = str(tmp_path / 'backlog.ring')
+    publisher = Publisher(app, buffer_size=3, backlog=RingBuffer(path, 4096))
+    publisher.enqueue('topic', {'n': 1})
+    # Messages that were not published yet are kept on shutdown
+    publisher.close()
+    publisher.close()
+    assert publisher.backlog is None
+
+    publisher = Publisher(app, buffer_size=3, backlog=RingBuffer(path, 4096), replay_rate=1000)
+    assert publisher.replay_pending.is_set()
+    assert publisher.held('topic')
+    assert not publisher.held('other')
+    task = asyncio.create_task(publisher.run())
+    await asyncio.sleep(0.01)
+    m_publish.assert_awaited_once_with(app, 'topic', {'n': 1})
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    publisher.close()
+
+
+async def test_archive(app, tmp_path, m_publish):
+    archive = RingBuffer(str(tmp_path / 'archive.ring'), 4096)
+    publisher = Publisher(app, buffer_size=3, archive=archive)
+    m_publish.side_effect = [None, ConnectionError('Broker unavailable')]
+    publisher.enqueue('topic', {'n': 1}, timestamp=1000)
+    publisher.enqueue('topic', {'n': 2})
+    assert not await publisher.flush()
+
+    # Published or not, all messages are archived
+    assert [loads(record) for record in archive] == [['topic', {'n': 1}, 1000], ['topic', {'n': 2}]]
+    publisher.close()
+    assert publisher.archive is None
+    assert archive.mm.closed
+
+
+async def test_backlog_cancelled(app, backlog, m_publish):
+    publisher = Publisher(app, buffer_size=3, backlog=backlog)
+    m_publish.side_effect = asyncio.CancelledError
+    publisher.write_backlog([('topic', {'n': 1}, None)])
+
+    with pytest.raises(asyncio.CancelledError):
+        await publisher.replay()
+    assert len(backlog) == 1
@@ -0,0 +1,122 @@
+import pytest
+
+from brewblox_sharemycook.ring_buffer import HEADER, RingBuffer
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'backlog.ring')
+
+
+def test_append_pop(path):
+    ring = RingBuffer(path, HEADER.size + 64)
+    assert ring.peek() is None
+    assert ring.pop() is None
+
+    for record in [b'one', b'two', b'']:
+        assert ring.append(record) == 0
+    assert len(ring) == 3
+    assert list(ring) == [b'one', b'two', b'']
+    assert ring.peek() == b'one'
+    assert [ring.pop() for _ in range(4)] == [b'one', b'two', b'', None]
+    ring.close()
+
+
+def test_wrap_and_evict(path):
+    # Room for two records of 12 bytes, plus length prefixes
+    ring = RingBuffer(path, HEADER.size + 34)
+    ring.append(b'a' * 12)
+    ring.append(b'b' * 12)
+    assert ring.pop() == b'a' * 12
+
+    # Wraps around to the start of the file
+    assert ring.append(b'c' * 12) == 0
+    assert list(ring) == [b'b' * 12, b'c' * 12]
+
+    # Evicts the oldest records to make room
+    assert ring.append(b'd' * 20) == 2
+    assert list(ring) == [b'd' * 20]
+    assert ring.append(b'e' * 2) == 0
+    assert ring.append(b'f' * 10) == 1
+    assert list(ring) == [b'e' * 2, b'f' * 10]
+    ring.close()
+
+
+def test_fill_after_wrap(path):
+    ring = RingBuffer(path, HEADER.size + 50)
+    for record in [b'a' * 10, b'b' * 10, b'c' * 10]:
+        ring.append(record)
+    ring.pop()
+    ring.pop()
+    ring.append(b'd' * 10)
+    # Fills the space between the wrapped tail and the head
+    assert ring.append(b'e' * 6) == 0
+    assert list(ring) == [b'c' * 10, b'd' * 10, b'e' * 6]
+    ring.close()
+
+
+def test_wrap_near_end(path):
+    ring = RingBuffer(path, HEADER.size + 30)
+    ring.append(b'a' * 10)
+    ring.append(b'b' * 12)
+    # Fewer bytes than a length prefix remain at the end of the file
+    ring.pop()
+    ring.append(b'c' * 6)
+    assert list(ring) == [b'b' * 12, b'c' * 6]
+    assert ring.pop() == b'b' * 12
+    assert ring.pop() == b'c' * 6
+    ring.close()
+
+
+def test_persistence(path, caplog):
+    ring = RingBuffer(path, HEADER.size + 64)
+    ring.append(b'kept')
+    ring.append(b'also kept')
+    ring.close()
+
+    ring = RingBuffer(path, HEADER.size + 64)
+    assert list(ring) == [b'kept', b'also kept']
+    assert f'Restored 2 record(s) from {path}' in caplog.messages
+    ring.close()
+
+    # A resized or corrupted file is discarded
+    ring = RingBuffer(path, HEADER.size + 128)
+    assert len(ring) == 0
+    assert f'Discarded the unreadable or resized ring buffer {path}' in caplog.messages
+    ring.append(b'lost')
+    ring.close()
+
+    with open(path, 'r+b') as f:
+        f.write(b'garbage!')
+    ring = RingBuffer(path, HEADER.size + 128)
+    assert len(ring) == 0
+    ring.close()
+
+
+def test_invalid_size(path):
+    with pytest.raises(ValueError):
+        RingBuffer(path, HEADER.size)
+
+    ring = RingBuffer(path, HEADER.size + 16)
+    with pytest.raises(ValueError):
+        ring.append(b'x' * 13)
+    ring.close()
+
+
+def test_readonly(path):
+    ring = RingBuffer(path, HEADER.size + 64)
+    ring.append(b'first')
+    ring.append(b'second')
+
+    # Readable while the buffer is in use
+    reader = RingBuffer(path, HEADER.size + 64, readonly=True)
+    assert list(reader) == [b'first', b'second']
+    reader.close()
+    ring.close()
+
+    with pytest.raises(ValueError):
+        RingBuffer(path, HEADER.size + 128, readonly=True)
+    with open(path, 'r+b') as f:
+        f.write(b'garbage!')
+    with pytest.raises(ValueError):
+        RingBuffer(path, HEADER.size + 64, readonly=True)
@@ -4,10 +4,12 @@ from textwrap import dedent
 import pytest
 from brewblox_service import repeater
 
-from brewblox_sharemycook.scraping import bs_ify, get_csrf_token, glean_device_ids
-from brewblox_sharemycook.scraping import glean_temperature_units, get_login_form
+from brewblox_sharemycook.scraping import bs_ify, bs_ify_elements, extract_elements, get_csrf_token, glean_device_ids
+from brewblox_sharemycook.scraping import glean_temperature_units, get_login_form, strain_elements
+from brewblox_sharemycook.scraping import DEVICE_INFO_LISTS, LOGIN_FORM, PARSER, TEMPERATURE_UNITS
 
 device_id = uuid.uuid4()
+other_device_id = uuid.uuid4()
 
 login_page = dedent("""\
     <html>
@@ -38,11 +40,19 @@ device_ids_page = dedent(f"""\
         <ul class="device-info-list">
             <a>link contents</a>
         </ul>
+        <!-- This is a device link outside of a device list -->
+        <ul class="other-list">
+            <a href="https://doesnt.matter/for/path/{uuid.uuid4()}">link contents</a>
+        </ul>
+        <!-- This is a second device list with multiple classes -->
+        <ul class="nav device-info-list">
+            <a href="https://doesnt.matter/for/path/{other_device_id}">link contents</a>
+        </ul>
     </html>""")
 
 
 def test_glean_device_ids():
-    assert glean_device_ids(bs_ify(device_ids_page)) == {device_id}
+    assert glean_device_ids(bs_ify(device_ids_page)) == {device_id, other_device_id}
 
 
 profile_page_c = dedent("""\
@@ -80,3 +90,56 @@ def test_get_csrf_token_raises():
     </html>""")
     with pytest.raises(repeater.RepeaterCancelled):
         get_csrf_token(bs_ify(content))
+
+
+@pytest.mark.parametrize('features', ['html.parser', PARSER])
+@pytest.mark.parametrize('scraper, content, tag, parse_only', [
+    (get_csrf_token, login_page, 'form', LOGIN_FORM),
+    (glean_device_ids, device_ids_page, 'ul', DEVICE_INFO_LISTS),
+    (glean_temperature_units, profile_page_c, 'input', TEMPERATURE_UNITS),
+    (glean_temperature_units, profile_page_f, 'input', TEMPERATURE_UNITS),
+], ids=['csrf_token', 'device_ids', 'Celsius', 'Fahrenheit'])
+def test_strained_results_identical(scraper, content, tag, parse_only, features):
+    expected = scraper(bs_ify(content, features='html.parser'))
+    assert scraper(bs_ify(content, parse_only, features)) == expected
+    assert scraper(bs_ify_elements(content, tag, parse_only, features)) == expected
+
+
+@pytest.mark.parametrize('content, tag, expected', [
+    ('<p><input a="1"><INPUT b="2" /></p>', 'input', '<input a="1"><INPUT b="2" />'),
+    ('<form action="/a">1</form><p/><form>2</form >', 'form', '<form action="/a">1</form><form>2</form >'),
+    ('<!-- <form>commented</form> --><form>1</form>', 'form', '<form>1</form>'),
+    ('<p></p>', 'form', None),
+    ('<form>1</form><form>unclosed', 'form', None),
+    ('<ul>1<ul>2</ul>3</ul>', 'ul', None),
+], ids=['void', 'container', 'comment', 'missing', 'unclosed', 'nested'])
+def test_extract_elements(content, tag, expected):
+    assert extract_elements(content, tag) == expected
+
+
+@pytest.mark.parametrize('content, parse_only, count', [
+    (login_page, LOGIN_FORM, 1),
+    (device_ids_page, DEVICE_INFO_LISTS, 4),
+    (profile_page_c.replace('<html>', '<input name="__RequestVerificationToken" value="TOKEN" />'),
+     TEMPERATURE_UNITS, 2),
+], ids=['login_form', 'device_info_lists', 'temperature_units'])
+def test_strain_elements(content, parse_only, count):
+    elements = strain_elements(content, parse_only)
+    assert elements.count(f'<{parse_only.name}') == count
+    assert 'other-list' not in elements
+    assert 'TOKEN' not in elements or parse_only is LOGIN_FORM
+
+
+def test_strain_elements_fallback():
+    content = '<ul class="device-info-list">1<ul>2</ul>3</ul>'
+    assert strain_elements(content, DEVICE_INFO_LISTS) == content
+
+
+def test_bs_ify_elements_fallback():
+    content = dedent(f"""\
+        <ul class="device-info-list">
+            <li><a href="https://doesnt.matter/for/path/{device_id}">link contents</a></li>
+            <ul><li>nested</li></ul>
+            <li><a href="https://doesnt.matter/for/path/{other_device_id}">link contents</a></li>
+        </ul>""")
+    assert glean_device_ids(bs_ify_elements(content, 'ul', DEVICE_INFO_LISTS)) == {device_id, other_device_id}
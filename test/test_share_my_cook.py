@@ -1,15 +1,20 @@
+import asyncio
 import json
 import uuid
 from textwrap import dedent
-from unittest.mock import MagicMock
 
 import pytest
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientResponseError, ClientSession
 from aresponses import ResponsesMockServer
+from mock import AsyncMock, MagicMock
+from prometheus_client import REGISTRY
+from yarl import URL
 from brewblox_service import repeater
 
+from brewblox_sharemycook.circuit_breaker import BreakerSettings, CircuitOpenError, CircuitState
 from brewblox_sharemycook.controllers import UltraQ, controller_types, TemperatureUnits
-from brewblox_sharemycook.share_my_cook import ShareMyCook, SHARE_MY_COOK
+from brewblox_sharemycook import share_my_cook as share_my_cook_module
+from brewblox_sharemycook.share_my_cook import ShareMyCook, SHARE_MY_COOK, PollResult, create_connector, create_session
 
 pytestmark = [pytest.mark.asyncio]
 
@@ -26,6 +31,18 @@ main_page_content = dedent("""\
     """)
 
 
+def profile_page(checked: str) -> str:
+    return ''.join(
+        f'<input {"checked=checked" if units == checked else ""} id="TemperatureUnit" '
+        f'name="TemperatureUnit" type="radio" value="{units}" /> {units}'
+        for units in ['Fahrenheit', 'Celsius']
+    )
+
+
+def page_cache_hits(page='customerdevice'):
+    return REGISTRY.get_sample_value('sharemycook_page_cache_hits_total', {'page': page})
+
+
 @pytest.fixture
 def smc_username():
     return 'username'
@@ -75,10 +92,12 @@ def add_successful_login_responses(aresponses: ResponsesMockServer):
     )
 
 
-async def test_login_success(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+async def test_login_success(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer, tmp_path):
     add_successful_login_responses(aresponses)
+    share_my_cook.cookie_file = str(tmp_path / 'cookies.pickle')
 
     await share_my_cook.login()
+    assert (tmp_path / 'cookies.pickle').exists()
     aresponses.assert_plan_strictly_followed()
 
 
@@ -165,6 +184,7 @@ async def test_authenticate_not_required(share_my_cook: ShareMyCook, aresponses:
 
     response = await share_my_cook.get(f'{SHARE_MY_COOK}{client_devices_location}')
     assert await response.text() == 'Already Authenticated'
+    assert share_my_cook.last_authenticated is not None
     aresponses.assert_plan_strictly_followed()
 
 
@@ -208,18 +228,391 @@ async def test_poll(monkeypatch, share_my_cook: ShareMyCook, aresponses: Respons
         )
     )
 
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Celsius'))
+
+    assert await share_my_cook.discover() == ({device_uuid}, set())
+    assert share_my_cook.discovered.is_set()
+
+    results = await share_my_cook.poll()
+    assert [r.device_id for r in results] == [device_uuid]
+    assert results[0].controller is ultra_q.from_json.return_value
+    assert results[0].error is None
+    assert results[0].duration >= 0
+    ultra_q.from_json.assert_called_once_with(device_uuid, TemperatureUnits.CELSIUS, poll_device_data)
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_poll_concurrency(monkeypatch, smc_username, smc_password):
+    device_ids = {uuid.uuid4() for _ in range(6)}
+    in_flight = 0
+    max_in_flight = 0
+
+    async def poll_device(device_id):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if device_id == failing_id:
+            raise RuntimeError('Device failure')
+        return device_id
+
+    failing_id = sorted(device_ids)[0]
+    share_my_cook = ShareMyCook(MagicMock(ClientSession), smc_username, smc_password, concurrency=2)
+    share_my_cook.device_ids = device_ids
+    monkeypatch.setattr(share_my_cook, 'poll_device', poll_device)
+
+    results = await share_my_cook.poll()
+
+    assert max_in_flight == 2
+    assert {r.device_id for r in results} == device_ids
+    for result in results:
+        assert isinstance(result, PollResult)
+        if result.device_id == failing_id:
+            assert isinstance(result.error, RuntimeError)
+            assert result.controller is None
+        else:
+            assert result.error is None
+            assert result.controller == result.device_id
+
+
+async def test_poll_cancelled(monkeypatch, smc_username, smc_password):
+    share_my_cook = ShareMyCook(MagicMock(ClientSession), smc_username, smc_password)
+    monkeypatch.setattr(share_my_cook, 'poll_device', AsyncMock(side_effect=asyncio.CancelledError))
+
+    with pytest.raises(asyncio.CancelledError):
+        await share_my_cook.timed_poll_device(uuid.uuid4())
+
+
+async def test_discover_changes(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer, caplog):
+    retained, retired, added = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    share_my_cook.device_ids = {retained, retired}
+
     aresponses.add(
         share_my_cook_host,
-        '/Account/Profile',
+        client_devices_location,
         'GET',
-        response=dedent("""
+        response=dedent(f"""
         <html>
-            <input id="TemperatureUnit" name="TemperatureUnit" type="radio" value="Fahrenheit" /> Fahrenheit
-            <input checked="checked" id="TemperatureUnit" name="TemperatureUnit" type="radio" value="Celsius" /> Celsius
+            <ul class="device-info-list">
+                <a href="https://doesnt.matter/for/path/{retained}">link contents</a>
+                <a href="https://doesnt.matter/for/path/{added}">link contents</a>
+            </ul>
         </html>
         """)
     )
 
-    await share_my_cook.poll()
-    ultra_q.from_json.assert_called_once_with(device_uuid, TemperatureUnits.CELSIUS, poll_device_data)
+    assert await share_my_cook.discover() == ({added}, {retired})
+    assert share_my_cook.device_ids == {retained, added}
+    assert f'Added device {added}' in caplog.messages
+    assert f'Retired device {retired}' in caplog.messages
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_discover_page_cache(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer, monkeypatch):
+    device_id = uuid.uuid4()
+    devices_page = f'<ul class="device-info-list"><a href="/path/{device_id}">link</a></ul>'
+    parse = MagicMock(wraps=share_my_cook_module.parse_device_ids)
+    monkeypatch.setattr(share_my_cook_module, 'parse_device_ids', parse)
+    requests = []
+
+    def respond(**kwargs):
+        async def handler(request: web.Request) -> web.Response:
+            requests.append(request.headers)
+            return web.Response(**kwargs)
+        return handler
+
+    hits = page_cache_hits() or 0
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET',
+                   respond(text=devices_page, headers={'ETag': '"v1"'}))
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET', respond(status=304))
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET', respond(text=devices_page))
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET',
+                   respond(text=f'<input name="__RequestVerificationToken" value="{uuid.uuid4()}" />{devices_page}'))
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET',
+                   respond(text=devices_page.replace('link</a>', 'link</a><a href="/path/other">')))
+
+    assert await share_my_cook.discover() == ({device_id}, set())
+    # Not modified
+    assert await share_my_cook.discover() == (set(), set())
+    assert requests[1]['If-None-Match'] == '"v1"'
+    # No validators, but the same content, apart from a new anti-forgery token
+    assert await share_my_cook.discover() == (set(), set())
+    assert await share_my_cook.discover() == (set(), set())
+    assert 'If-None-Match' not in requests[3]
+    assert parse.call_count == 1
+    assert page_cache_hits() == hits + 3
+
+    # Changed content is parsed again
+    assert await share_my_cook.discover() == (set(), set())
+    assert parse.call_count == 2
+    assert share_my_cook.device_ids == {device_id}
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_cookie_persistence(smc_username, smc_password, tmp_path, caplog):
+    cookie_file = str(tmp_path / 'cookies.pickle')
+
+    async with ClientSession() as session:
+        session.cookie_jar.update_cookies({'session': 'value'}, URL(SHARE_MY_COOK))
+        ShareMyCook(session, smc_username, smc_password, cookie_file=cookie_file).save_cookies()
+
+    async with ClientSession() as session:
+        ShareMyCook(session, smc_username, smc_password, cookie_file=cookie_file).load_cookies()
+        assert session.cookie_jar.filter_cookies(URL(SHARE_MY_COOK))['session'].value == 'value'
+    assert f'Restored session cookies from {cookie_file}' in caplog.messages
+
+
+async def test_cookie_persistence_disabled(smc_username, smc_password):
+    session = MagicMock(ClientSession)
+    share_my_cook = ShareMyCook(session, smc_username, smc_password)
+    share_my_cook.load_cookies()
+    share_my_cook.save_cookies()
+    assert not session.mock_calls
+
+
+async def test_cookie_persistence_errors(smc_username, smc_password, tmp_path, caplog):
+    cookie_file = tmp_path / 'cookies.pickle'
+    cookie_file.write_text('not a pickle')
+
+    async with ClientSession() as session:
+        share_my_cook = ShareMyCook(session, smc_username, smc_password, cookie_file=str(cookie_file))
+        share_my_cook.load_cookies()
+        share_my_cook.cookie_file = str(tmp_path / 'missing' / 'cookies.pickle')
+        share_my_cook.load_cookies()
+        share_my_cook.save_cookies()
+
+    assert f'Unable to restore session cookies from {cookie_file}: ' in caplog.text
+    assert 'Unable to save session cookies to ' in caplog.text
+
+
+async def test_keep_alive(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Celsius'), repeat=2)
+
+    assert await share_my_cook.keep_alive(max_idle=60)
+    # The profile page revalidated the temperature units
+    assert share_my_cook.units == TemperatureUnits.CELSIUS
+    assert not await share_my_cook.keep_alive(max_idle=60)
+    assert await share_my_cook.keep_alive(max_idle=0)
+    assert share_my_cook.units == TemperatureUnits.CELSIUS
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_concurrent_relogin(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+    logged_in = False
+    logins = 0
+
+    async def devices_page(request):
+        if logged_in:
+            return web.Response(status=200, body='Authenticated')
+        await asyncio.sleep(0.01)
+        return web.Response(status=302, headers={'Location': '/Login?ReturnUrl=%2Faccount%2Fcustomerdevice'})
+
+    async def login(request):
+        nonlocal logged_in, logins
+        logins += 1
+        await asyncio.sleep(0.01)
+        logged_in = True
+        return web.Response(status=302, headers={'Location': '/'})
+
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET', devices_page, repeat=aresponses.INFINITY)
+    aresponses.add(share_my_cook_host, '/Login', 'GET', 'login page', repeat=aresponses.INFINITY)
+    aresponses.add(share_my_cook_host, '/Login', 'POST', login, repeat=aresponses.INFINITY)
+    aresponses.add(share_my_cook_host, '/', 'GET', main_page_content, repeat=aresponses.INFINITY)
+
+    responses = await asyncio.gather(*(share_my_cook.get(f'{SHARE_MY_COOK}{client_devices_location}')
+                                       for _ in range(5)))
+
+    assert [await r.text() for r in responses] == ['Authenticated'] * 5
+    assert logins == 1
+    assert share_my_cook.login_generation == 1
+
+
+async def test_client_settings():
+    connector = create_connector(pool_size=3, keepalive_timeout=20, dns_ttl=100)
+    session = create_session(connector, connect_timeout=5, read_timeout=15)
+    try:
+        assert connector.limit == connector.limit_per_host == 3
+        assert connector.use_dns_cache
+        assert session.connector is connector
+        assert session.timeout.connect == 5
+        assert session.timeout.sock_read == 15
+    finally:
+        await session.close()
+        assert not connector.closed
+        await connector.close()
+
+
+async def test_read_timeout(aresponses: ResponsesMockServer, smc_username, smc_password):
+    async def hung_device(request):
+        await asyncio.sleep(1)
+
+    aresponses.add(share_my_cook_host, '/account/customerdevice/temperatures_read', 'GET', hung_device)
+    connector = create_connector()
+    async with create_session(connector, read_timeout=0.01) as session:
+        share_my_cook = ShareMyCook(session, smc_username, smc_password)
+        result = await share_my_cook.timed_poll_device(uuid.uuid4())
+    await connector.close()
+
+    assert isinstance(result.error, asyncio.TimeoutError)
+    assert result.duration < 1
+
+
+async def test_responses_released(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET', '<html></html>')
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Celsius'))
+
+    await share_my_cook.discover()
+    await share_my_cook.keep_alive(max_idle=0)
+    assert share_my_cook.session.connector._acquired == set()
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_upstream_circuit_breaker(aresponses: ResponsesMockServer, smc_username, smc_password):
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET',
+                   web.Response(status=503), repeat=2)
+    settings = BreakerSettings(threshold=2, min_backoff=60)
+
+    async with ClientSession(raise_for_status=True) as session:
+        share_my_cook = ShareMyCook(session, smc_username, smc_password, breaker_settings=settings, account_index=1)
+        for _ in range(2):
+            with pytest.raises(ClientResponseError):
+                await share_my_cook.discover()
+
+        # Requests are no longer sent while the circuit is open
+        with pytest.raises(CircuitOpenError):
+            await share_my_cook.discover()
+        device_id = uuid.uuid4()
+        result = await share_my_cook.timed_poll_device(device_id)
+        assert isinstance(result.error, CircuitOpenError)
+        # Devices are not blamed for an upstream outage
+        assert share_my_cook.device_breakers[device_id].failures == 0
+
+    assert share_my_cook.breaker.state == CircuitState.OPEN
+    # Usernames are not exposed in metrics
+    assert REGISTRY.get_sample_value('sharemycook_circuit_state', {'circuit': 'account/1'}) == CircuitState.OPEN.value
+    assert share_my_cook.account_index == 1
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_device_circuit_breaker(monkeypatch, smc_username, smc_password, aresponses: ResponsesMockServer):
+    failing, healthy = uuid.uuid4(), uuid.uuid4()
+    settings = BreakerSettings(threshold=2, min_backoff=60)
+    share_my_cook = ShareMyCook(MagicMock(ClientSession), smc_username, smc_password, breaker_settings=settings)
+    share_my_cook.device_ids = {failing, healthy}
+
+    async def poll_device(device_id):
+        if device_id == failing:
+            raise RuntimeError('Device failure')
+        return device_id
+
+    monkeypatch.setattr(share_my_cook, 'poll_device', AsyncMock(side_effect=poll_device))
+    for _ in range(3):
+        await share_my_cook.poll()
+
+    # The failing device was polled until its circuit opened, the healthy device every time
+    polled = [call.args[0] for call in share_my_cook.poll_device.await_args_list]
+    assert polled.count(failing) == 2
+    assert polled.count(healthy) == 3
+    assert share_my_cook.device_breakers[failing].state == CircuitState.OPEN
+    assert share_my_cook.breaker.state == CircuitState.CLOSED
+
+    # Breakers of retired devices are dropped
+    aresponses.add(share_my_cook_host, client_devices_location, 'GET', '<html></html>')
+    async with ClientSession() as session:
+        share_my_cook.session = session
+        await share_my_cook.discover()
+    assert share_my_cook.device_breakers == {}
+    assert REGISTRY.get_sample_value('sharemycook_circuit_state', {'circuit': f'device/{failing}'}) is None
+
+
+async def test_start(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+    add_successful_login_responses(aresponses)
+
+    # No session to resume, login right away
+    await share_my_cook.start()
+    assert share_my_cook.login_generation == 1
+
+    share_my_cook.session.cookie_jar.update_cookies({'session': 'value'}, URL(SHARE_MY_COOK))
+    await share_my_cook.start()
+    assert share_my_cook.login_generation == 1
+    aresponses.assert_plan_strictly_followed()
+
+
+async def test_temperature_units_ttl(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer, caplog):
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Celsius'))
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', web.Response(status=500))
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Fahrenheit'))
+    share_my_cook.units_ttl = 0.01
+
+    # The first lookup is waited for
+    assert await share_my_cook.temperature_units() == TemperatureUnits.CELSIUS
+    assert 'Temperature units are in CELSIUS' in caplog.messages
+    assert await share_my_cook.temperature_units() == TemperatureUnits.CELSIUS
+
+    # Expired units are revalidated in the background, failures keep the previous units
+    await asyncio.sleep(0.01)
+    assert await share_my_cook.temperature_units() == TemperatureUnits.CELSIUS
+    await asyncio.wait([share_my_cook.units_task])
+    assert any(m.startswith('Unable to refresh temperature units: ') for m in caplog.messages)
+
+    await asyncio.sleep(0.01)
+    assert await share_my_cook.temperature_units() == TemperatureUnits.CELSIUS
+    assert await share_my_cook.units_task == TemperatureUnits.FAHRENHEIT
+    assert await share_my_cook.temperature_units() == TemperatureUnits.FAHRENHEIT
+    assert 'Temperature units changed from CELSIUS to FAHRENHEIT' in caplog.messages
     aresponses.assert_plan_strictly_followed()
+
+
+async def test_temperature_units_first_lookup_failed(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer):
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', '<html></html>')
+
+    with pytest.raises(repeater.RepeaterCancelled):
+        await share_my_cook.temperature_units()
+    assert share_my_cook.units is None
+
+
+async def test_temperature_scale_converted(share_my_cook: ShareMyCook, aresponses: ResponsesMockServer, caplog):
+    device_id = uuid.uuid4()
+    celsius_targets = {'pitTargetTemp': 107, 'food1TargetTemp': 95, 'food2TargetTemp': 60, 'food3TargetTemp': 0}
+    fahrenheit_targets = {'pitTargetTemp': 225, 'food1TargetTemp': 203, 'food2TargetTemp': 140, 'food3TargetTemp': 32}
+
+    def device_response(targets):
+        return web.json_response({
+            'bbqGuruDeviceModel': 'UltraQ',
+            'customerDeviceName': 'MyDeviceName',
+            'indicateStatus': 'good',
+            'pitActualTemp': 106,
+            'food1ActualTemp': 67,
+            'food2ActualTemp': 66,
+            'food3ActualTemp': -500,
+            'currentOutputPercent': 78,
+            'lastDeviceCommunicationTimestamp': '2026-10-18T12:00:00',
+            **targets,
+        })
+
+    temperatures_read = f'/account/customerdevice/temperatures_read?id={device_id}'
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Celsius'))
+    for targets in [celsius_targets, fahrenheit_targets, fahrenheit_targets]:
+        aresponses.add(share_my_cook_host, temperatures_read, 'GET', device_response(targets), match_querystring=True)
+    aresponses.add(share_my_cook_host, '/Account/Profile', 'GET', profile_page('Fahrenheit'))
+
+    assert (await share_my_cook.poll_device(device_id)).units == TemperatureUnits.CELSIUS
+    # The units were changed in the web UI: the units are refreshed before the sample is returned
+    assert (await share_my_cook.poll_device(device_id)).units == TemperatureUnits.FAHRENHEIT
+    assert 'Temperatures of MyDeviceName were converted to another scale, refreshing temperature units' \
+        in caplog.messages
+    assert (await share_my_cook.poll_device(device_id)).units == TemperatureUnits.FAHRENHEIT
+    assert share_my_cook.last_targets[device_id] == (TemperatureUnits.FAHRENHEIT, (225, 203, 140, 32))
+    # The first units lookup runs alongside the first poll
+    aresponses.assert_no_unused_routes()
+    aresponses.assert_all_requests_matched()
+
+
+async def test_close(share_my_cook: ShareMyCook):
+    share_my_cook.units_task = asyncio.create_task(asyncio.Event().wait())
+    await share_my_cook.close()
+    assert share_my_cook.session.closed
+    with pytest.raises(asyncio.CancelledError):
+        await share_my_cook.units_task
+    await ShareMyCook(ClientSession(), 'username', 'password').close()